@@ -0,0 +1,163 @@
+import re
+import threading
+from concurrent.futures import Future
+
+# In the append-only layout, the Records sheet is stored oldest first and new
+# visits are appended at the bottom, so no existing row ever moves. Closing a
+# visit updates its row in place, using a local index of person to open-visit
+# row. The index is rebuilt from every read of the tail of the sheet (unless a
+# write happened during the read), so it recovers from manual edits.
+
+
+def get_first_appended_row(response):
+    """Returns the first row number written by an append request."""
+    updated_range = response["updates"]["updatedRange"]
+    return int(re.search(r"![A-Z]+(\d+)", updated_range).group(1))
+
+
+def is_newest_first(rows):
+    """Returns whether the rows of a Records sheet are in the original (newest first) order, based on the start times of the first and last visits."""
+    start_times = [int(x[1]) for x in rows if len(x) > 1 and len(x[0]) > 0 and len(x[1]) > 0]
+    return len(start_times) > 1 and start_times[0] > start_times[-1]
+
+
+class AppendOnlyRecords:
+    """Tracks the Records sheet in the append-only layout, batching sign-ins and sign-outs into one append and one update request."""
+
+    _TAIL_SLACK_ROWS = 100  # Extra rows read past the known end, in case rows were added elsewhere
+
+    def __init__(self, recent_count):
+        """
+        Creates a new AppendOnlyRecords.
+
+        Parameters:
+            recent_count: The number of records to read from the tail of the sheet.
+        """
+
+        self._RECENT_COUNT = recent_count
+        self._lock = threading.Lock()
+        self._last_row = None  # Last row with data, None until the layout is prepared
+        self._open_rows = {}  # Key = person, value = dict of row to start manual
+        self._generation = 0  # Incremented by writes, so a read that overlaps a write can't revert the index
+        self._pending = []  # Queued sign-ins and sign-outs (action, person, is_manual, event_time, Future)
+
+    def is_ready(self):
+        """Returns whether the end of the sheet is known."""
+        return self._last_row != None
+
+    def load(self, rows):
+        """Sets the initial state from every data row of the sheet (starting at row 2), in the append-only order."""
+        with self._lock:
+            self._generation += 1
+            self._last_row = len(rows) + 1
+            self._open_rows = {}
+            self._index_rows(rows, 2)
+
+    def _index_rows(self, rows, start_row):
+        """Adds the open visits in a list of rows to the index."""
+        for offset, row in enumerate(rows):
+            if len(row) > 1 and len(row[0]) > 0 and len(row[1]) > 0 and (len(row) < 3 or len(row[2]) == 0):
+                self._open_rows.setdefault(int(row[0]), {})[
+                    start_row + offset] = len(row) > 3 and row[3] == "TRUE"
+
+    def begin_read(self):
+        """Returns the A1 range of the tail to read, its first row, and the current write generation."""
+        with self._lock:
+            start_row = max(2, self._last_row - self._RECENT_COUNT + 1)
+            end_row = self._last_row + self._TAIL_SLACK_ROWS
+            return "A" + str(start_row) + ":E" + str(end_row), start_row, self._generation
+
+    def finish_read(self, rows, start_row, generation):
+        """Updates the end of the sheet and the open-visit index from a tail read. Returns the rows newest first (the order used by the data cache)."""
+        with self._lock:
+            if generation == self._generation:
+                self._last_row = max(start_row - 1, start_row + len(rows) - 1)
+                for person in list(self._open_rows.keys()):
+                    rows_before = {x: y for x, y in self._open_rows[person].items() if x < start_row}
+                    if len(rows_before) > 0:
+                        self._open_rows[person] = rows_before
+                    else:
+                        del self._open_rows[person]
+                self._index_rows(rows, start_row)
+        return list(reversed(rows))
+
+    def submit(self, action, person, is_manual, event_time):
+        """Queues a sign-in or sign-out to be written by the next flush. Returns a Future with the boolean result."""
+        future = Future()
+        with self._lock:
+            self._pending.append((action, person, is_manual, event_time, future))
+        return future
+
+    def fail_pending(self):
+        """Completes every queued sign-in and sign-out as failed without writing them. Returns the number of operations."""
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        for _, _, _, _, future in pending:
+            future.set_result(False)
+        return len(pending)
+
+    def flush(self, sheet):
+        """Writes every queued sign-in and sign-out using at most one update and one append request. Must only be called from one thread at a time. Returns a tuple with the number of operations and whether they were written successfully."""
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._generation += 1
+            open_rows = {x: dict(y) for x, y in self._open_rows.items()}
+        if len(pending) == 0:
+            return 0, True
+
+        # Plan writes in order (later operations see the rows planned by earlier ones)
+        updates = {}  # Key = row, value = values for columns B-E (None = unchanged)
+        appends = []  # [person, start_time, end_time, start_manual, end_manual]
+        appended_open = {}  # Key = person, value = index in appends
+        for action, person, is_manual, event_time, _ in pending:
+            if action == "sign_in":
+                if person in appended_open:
+                    appends[appended_open[person]][1] = event_time
+                    appends[appended_open[person]][3] = is_manual
+                elif person in open_rows and len(open_rows[person]) > 0:
+                    row = max(open_rows[person].keys())
+                    updates[row] = [event_time, "", is_manual, None]
+                    open_rows[person][row] = is_manual
+                else:
+                    appended_open[person] = len(appends)
+                    appends.append([person, event_time, "", is_manual, False])
+            else:
+                if person in appended_open:
+                    index = appended_open.pop(person)
+                    appends[index][2] = event_time
+                    appends[index][4] = is_manual
+                for row, start_manual in open_rows.pop(person, {}).items():
+                    start_time = updates[row][0] if row in updates else None
+                    updates[row] = [start_time, event_time,
+                                    start_manual, is_manual]
+
+        success = True
+        try:
+            if len(updates) > 0:
+                data = []
+                for row, values in sorted(updates.items()):
+                    first = min(x for x in range(4) if values[x] != None)
+                    last = max(x for x in range(4) if values[x] != None)
+                    data.append({"range": "BCDE"[first] + str(row) + ":" + "BCDE"[last] + str(row),
+                                 "values": [values[first:last + 1]]})
+                sheet.batch_update(data)
+            if len(appends) > 0:
+                first_row = get_first_appended_row(
+                    sheet.append_rows(appends, table_range="A1"))
+                for person, index in appended_open.items():
+                    open_rows.setdefault(person, {})[
+                        first_row + index] = appends[index][3]
+        except:
+            success = False
+
+        with self._lock:
+            self._generation += 1
+            if success:
+                self._open_rows = open_rows
+                if len(appends) > 0:
+                    self._last_row = max(self._last_row, first_row + len(appends) - 1)
+        for _, _, _, _, future in pending:
+            future.set_result(success)
+        return len(pending), success
@@ -7,8 +7,8 @@ valid_mac_address_pattern = re.compile(r"^([0-9a-f]{2}[:]){5}([0-9a-f]{2})$")
 random_mac_address_pattern = re.compile(r"^.[26ae]")
 
 
-def get_mac_address(ip_address):
-    """Uses arp to retrieve the MAC address for the specified IP address (Linux, macOS, and Windows)."""
+def get_mac_address(ip_address, timeout_secs=None):
+    """Uses arp to retrieve the MAC address for the specified IP address (Linux, macOS, and Windows). Returns None if arp doesn't finish within the optional timeout."""
 
     mac_address = None
 
@@ -17,8 +17,8 @@ def get_mac_address(ip_address):
                                                                              ip_address]
     try:
         output = subprocess.check_output(
-            args, stderr=subprocess.DEVNULL).decode("utf-8")
-    except subprocess.CalledProcessError:
+            args, stderr=subprocess.DEVNULL, timeout=timeout_secs).decode("utf-8")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
         pass
     else:
         # Parse arp output
@@ -42,7 +42,11 @@ def get_mac_address(ip_address):
                 if len(words) >= 2:
                     mac_address = words[1]
 
-    # Clean up & verify result
+    return _clean_mac_address(mac_address)
+
+
+def _clean_mac_address(mac_address):
+    """Converts a MAC address to lowercase with colons and two digits per byte, returning None if it is not valid."""
     if mac_address != None:
         mac_address = mac_address.lower().replace("-", ":")
         mac_address = ":".join([x.zfill(2) for x in mac_address.split(":")])
@@ -50,3 +54,75 @@ def get_mac_address(ip_address):
             mac_address = None
 
     return mac_address
+
+
+def get_reachable_ipv4_neighbors(timeout_secs=None):
+    """Reads the IPv4 neighbor entries that were confirmed reachable within the last few seconds, returning a dict of IP address to MAC address (Linux only, other platforms or a read that exceeds the optional timeout return an empty dict)."""
+
+    neighbors = {}
+    if platform.system() != "Linux":
+        return neighbors
+    try:
+        output = subprocess.check_output(
+            ["ip", "-4", "neigh", "show", "nud", "reachable"], stderr=subprocess.DEVNULL, timeout=timeout_secs).decode("utf-8", "replace")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        return neighbors
+
+    for line in output.splitlines():
+        # Example: "10.0.0.5 dev wlan0 lladdr 00:11:22:33:44:55 REACHABLE"
+        words = [x for x in line.split(" ") if len(x) > 0]
+        if "lladdr" in words:
+            mac_address = _clean_mac_address(
+                words[words.index("lladdr") + 1])
+            if mac_address != None:
+                neighbors[words[0]] = mac_address
+    return neighbors
+
+
+def get_ipv6_neighbors(interface):
+    """Reads the IPv6 neighbor table for the specified interface, returning a dict of IPv6 address to MAC address for recently confirmed neighbors (Linux, macOS, and Windows)."""
+
+    neighbors = {}
+    if platform.system() == "Linux":
+        args = ["ip", "-6", "neigh", "show", "dev", interface]
+    elif platform.system() == "Darwin":
+        args = ["ndp", "-an"]
+    elif platform.system() == "Windows":
+        args = ["netsh", "interface", "ipv6",
+                "show", "neighbors", interface]
+    else:
+        return neighbors
+    try:
+        output = subprocess.check_output(
+            args, stderr=subprocess.DEVNULL).decode("utf-8", "replace")
+    except (subprocess.CalledProcessError, OSError):
+        return neighbors
+
+    for line in output.splitlines():
+        words = [x for x in line.split(" ") if len(x) > 0]
+        ip_address = None
+        mac_address = None
+
+        if platform.system() == "Linux":
+            # Example: "fe80::1 lladdr 00:11:22:33:44:55 router REACHABLE"
+            if "lladdr" in words and words[-1] in ["REACHABLE", "DELAY", "PROBE"]:
+                ip_address = words[0]
+                mac_address = words[words.index("lladdr") + 1]
+
+        elif platform.system() == "Darwin":
+            # Example: "fe80::1%en0 0:11:22:33:44:55 en0 23h59m58s R R"
+            if len(words) >= 5 and words[2] == interface and words[4] in ["R", "D", "P"]:
+                ip_address = words[0].split("%")[0]
+                mac_address = words[1]
+
+        elif platform.system() == "Windows":
+            # Example: "fe80::1    00-11-22-33-44-55    Reachable"
+            if len(words) >= 3 and words[2] in ["Reachable", "Probe", "Delay"]:
+                ip_address = words[0]
+                mac_address = words[1]
+
+        mac_address = _clean_mac_address(mac_address)
+        if ip_address != None and mac_address != None:
+            neighbors[ip_address] = mac_address
+
+    return neighbors
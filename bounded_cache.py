@@ -0,0 +1,90 @@
+import collections
+import threading
+from collections.abc import MutableMapping
+
+from util import *
+
+
+class BoundedCache(MutableMapping):
+    """Dict-like cache with an optional size limit (least recently used entries are evicted) and age limit (entries expire after a fixed time since they were last set)."""
+
+    def __init__(self, max_size=None, max_age_secs=None):
+        """
+        Creates a new BoundedCache.
+
+        Parameters:
+            max_size: The maximum number of entries, or None for no limit.
+            max_age_secs: The number of seconds before an entry expires, or None for no limit.
+        """
+
+        self._MAX_SIZE = max_size
+        self._MAX_AGE_SECS = max_age_secs
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()  # Key = key, value = [set time, value], least recently used first
+        self._last_sweep = time.time()
+        self._evicted_count = 0
+        self._expired_count = 0
+
+    def _is_expired(self, entry, current_time):
+        return self._MAX_AGE_SECS != None and current_time - entry[0] > self._MAX_AGE_SECS
+
+    def _sweep(self, current_time):
+        """Removes all expired entries (at most a few times per max age, since it scans every entry)."""
+        if self._MAX_AGE_SECS == None or current_time - self._last_sweep < self._MAX_AGE_SECS / 4:
+            return
+        self._last_sweep = current_time
+        for key in [x for x, y in self._entries.items() if self._is_expired(y, current_time)]:
+            del self._entries[key]
+            self._expired_count += 1
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            if self._is_expired(entry, time.time()):
+                del self._entries[key]
+                self._expired_count += 1
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            current_time = time.time()
+            self._entries[key] = [current_time, value]
+            self._entries.move_to_end(key)
+            self._sweep(current_time)
+            if self._MAX_SIZE != None:
+                while len(self._entries) > self._MAX_SIZE:
+                    self._entries.popitem(last=False)
+                    self._evicted_count += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry != None and not self._is_expired(entry, time.time())
+
+    def __iter__(self):
+        with self._lock:
+            current_time = time.time()
+            keys = [x for x, y in self._entries.items()
+                    if not self._is_expired(y, current_time)]
+        return iter(keys)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get_state(self):
+        """Returns a JSON-compatible dict with the size, limits, and eviction counts."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self._MAX_SIZE,
+                "max_age_secs": self._MAX_AGE_SECS,
+                "evicted": self._evicted_count,
+                "expired": self._expired_count
+            }
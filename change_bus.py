@@ -0,0 +1,208 @@
+import threading
+from enum import Enum
+
+from util import *
+
+# A ChangeBus wraps a SnapshotStore and turns each publish into a list of
+# typed change events, found in a single pass over the old and new values.
+# Subscribers register for the event types they care about, so (for example)
+# an edit to an old record doesn't rebroadcast the here-now list.
+
+
+class ChangeType(Enum):
+    """The type of a single change to the config or data cache."""
+
+    # Config cache
+    PERSON_ADDED = 0
+    PERSON_REMOVED = 1
+    PERSON_UPDATED = 2
+    CONFIG_KEY_CHANGED = 3
+
+    # Data cache
+    DEVICE_REGISTERED = 4
+    DEVICE_REMOVED = 5
+    DEVICE_SEEN = 6  # Last seen date changed
+    VISIT_OPENED = 7
+    VISIT_CLOSED = 8  # Includes open visits that were deleted (new is None)
+    RECORD_UPDATED = 9  # Any other change to a record (e.g. an edit in the sheet)
+    RECORD_REMOVED = 10  # Closed record deleted or no longer in the recent window
+
+
+CONFIG_CHANGE_TYPES = [ChangeType.PERSON_ADDED, ChangeType.PERSON_REMOVED,
+                       ChangeType.PERSON_UPDATED, ChangeType.CONFIG_KEY_CHANGED]
+PEOPLE_CHANGE_TYPES = [ChangeType.PERSON_ADDED,
+                       ChangeType.PERSON_REMOVED, ChangeType.PERSON_UPDATED]
+DEVICE_CHANGE_TYPES = [ChangeType.DEVICE_REGISTERED,
+                       ChangeType.DEVICE_REMOVED, ChangeType.DEVICE_SEEN]
+VISIT_CHANGE_TYPES = [ChangeType.VISIT_OPENED, ChangeType.VISIT_CLOSED]
+RECORD_CHANGE_TYPES = VISIT_CHANGE_TYPES + \
+    [ChangeType.RECORD_UPDATED, ChangeType.RECORD_REMOVED]
+
+
+class ChangeEvent:
+    """A single change, with the key of the changed item (person ID, config key, (person, MAC), or (person, start time)) and its old and new values (None if added or removed)."""
+
+    def __init__(self, type, key, old=None, new=None):
+        self.type = type
+        self.key = key
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return "ChangeEvent(" + self.type.name + ", " + repr(self.key) + ")"
+
+
+def diff_config(old, new):
+    """Returns the list of ChangeEvents between two config caches."""
+    events = []
+    old_general = old["general"] if old != None else {}
+    for key, value in new["general"].items():
+        if key not in old_general or old_general[key] != value:
+            events.append(ChangeEvent(
+                ChangeType.CONFIG_KEY_CHANGED, key, old_general.get(key), value))
+    for key, value in old_general.items():
+        if key not in new["general"]:
+            events.append(ChangeEvent(
+                ChangeType.CONFIG_KEY_CHANGED, key, value, None))
+
+    old_people = {x["id"]: x for x in old["people"]} if old != None else {}
+    new_people = set()
+    for person in new["people"]:
+        new_people.add(person["id"])
+        old_person = old_people.get(person["id"])
+        if old_person == None:
+            events.append(ChangeEvent(
+                ChangeType.PERSON_ADDED, person["id"], None, person))
+        elif old_person != person:
+            events.append(ChangeEvent(
+                ChangeType.PERSON_UPDATED, person["id"], old_person, person))
+    for person_id, person in old_people.items():
+        if person_id not in new_people:
+            events.append(ChangeEvent(
+                ChangeType.PERSON_REMOVED, person_id, person, None))
+
+    # The order of people is shown to clients, so a reorder counts as an update
+    if len(events) == 0 and old != None and [x["id"] for x in old["people"]] != [x["id"] for x in new["people"]]:
+        events.append(ChangeEvent(ChangeType.PERSON_UPDATED, None))
+    return events
+
+
+def _diff_records(old_records, new_records):
+    """Returns the list of ChangeEvents between two RecordTables, keyed by person and start time."""
+    if old_records == new_records:  # Compares the underlying arrays
+        return []
+    events = []
+    old_by_key = {(x["person"], x["start_time"]): x for x in old_records}
+    for record in new_records:
+        key = (record["person"], record["start_time"])
+        old_record = old_by_key.pop(key, None)
+        if old_record == None:
+            events.append(ChangeEvent(ChangeType.VISIT_OPENED if record["end_time"] == None else ChangeType.VISIT_CLOSED,
+                                      key, None, record))
+        elif old_record != record:
+            if old_record["end_time"] == None and record["end_time"] != None:
+                change_type = ChangeType.VISIT_CLOSED
+            elif old_record["end_time"] != None and record["end_time"] == None:
+                change_type = ChangeType.VISIT_OPENED
+            else:
+                change_type = ChangeType.RECORD_UPDATED
+            events.append(ChangeEvent(change_type, key, old_record, record))
+    for key, record in old_by_key.items():
+        events.append(ChangeEvent(ChangeType.VISIT_CLOSED if record["end_time"] == None else ChangeType.RECORD_REMOVED,
+                                  key, record, None))
+
+    # Duplicate keys or a reorder, which can only come from an edit in the sheet
+    if len(events) == 0:
+        events.append(ChangeEvent(ChangeType.RECORD_UPDATED, None))
+    return events
+
+
+def diff_data(old, new):
+    """Returns the list of ChangeEvents between two data caches."""
+    events = []
+    old_devices = {(x["person"], x["mac"]): x for x in old["devices"]}
+    for device in new["devices"]:
+        key = (device["person"], device["mac"])
+        old_device = old_devices.pop(key, None)
+        if old_device == None:
+            events.append(ChangeEvent(
+                ChangeType.DEVICE_REGISTERED, key, None, device))
+        elif old_device != device:
+            events.append(ChangeEvent(
+                ChangeType.DEVICE_SEEN, key, old_device, device))
+    for key, device in old_devices.items():
+        events.append(ChangeEvent(
+            ChangeType.DEVICE_REMOVED, key, device, None))
+
+    events.extend(_diff_records(old["records"], new["records"]))
+    return events
+
+
+class ChangeBus:
+    """Publishes new values to a SnapshotStore only when they changed, and sends the typed change events to subscribers."""
+
+    def __init__(self, store, diff_function):
+        """
+        Creates a new ChangeBus.
+
+        Parameters:
+            store: The SnapshotStore to publish to. Values published to the store directly are also diffed.
+            diff_function: A function that accepts the old and new values and returns a list of ChangeEvents.
+        """
+
+        self._store = store
+        self._diff_function = diff_function
+        self._lock = threading.RLock()
+        snapshot = store.get_snapshot()
+        self._last_value = snapshot.value
+        self._last_version = snapshot.version
+        self._pending_events = None  # Events already computed by update, for the publish in progress
+        self._subscribers = []  # [callback, set of ChangeTypes or None]
+        store.subscribe(self._published)
+
+    def subscribe(self, callback, types=None, init=None):
+        """
+        Registers a function that accepts a list of ChangeEvents and the new Snapshot, called only with events of the specified types. Returns the current Snapshot.
+
+        Parameters:
+            callback: The function to call with each list of matching events.
+            types: The list of ChangeTypes to send (all types if None).
+            init: An optional function that accepts the current Snapshot to build the subscriber's initial state. It's called before any change is sent, so no change is missed or applied twice.
+        """
+
+        with self._lock:
+            self._subscribers.append(
+                [callback, set(types) if types != None else None])
+            snapshot = self._store.get_snapshot()
+            if init != None:
+                init(snapshot)
+            return snapshot
+
+    def update(self, new_value):
+        """Diffs a new value against the current one and publishes it if anything changed. Returns the list of ChangeEvents."""
+        with self._lock:
+            events = self._diff_function(self._last_value, new_value)
+            if len(events) > 0:
+                self._pending_events = events
+                self._store.publish(new_value)
+            return events
+
+    def _published(self, snapshot):
+        """Subscriber for the store, which sends the events for each new snapshot (in order, since the lock is held)."""
+        with self._lock:
+            if snapshot.version <= self._last_version:
+                return  # A direct publish that was overtaken, already covered by the newer diff
+            self._last_version = snapshot.version
+            events = self._pending_events
+            self._pending_events = None
+            if events == None:
+                events = self._diff_function(self._last_value, snapshot.value)
+            self._last_value = snapshot.value
+            for callback, types in self._subscribers:
+                matching = [
+                    x for x in events if types == None or x.type in types]
+                if len(matching) > 0:
+                    try:
+                        callback(matching, snapshot)
+                    except:
+                        log("Error in change subscriber")
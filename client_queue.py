@@ -0,0 +1,87 @@
+import collections
+import threading
+
+from util import *
+
+
+class ClientQueue:
+    """Bounded outbound message queue for a single WebSocket client.
+
+    Messages are keyed by query, so a new message replaces any queued message
+    of the same type (only the latest data or status is sent). The depth is
+    therefore bounded by the number of query types, and a slow client shows up
+    as lag instead. A single sender thread takes messages with get() and
+    reports each send with done().
+    """
+
+    def __init__(self):
+        """Creates a new ClientQueue."""
+        self._condition = threading.Condition()
+        self._messages = collections.OrderedDict()  # Key = query, value = [queued time, text]
+        self._sending_since = None
+        self._closed = False
+        self._sent_count = 0
+        self._coalesced_count = 0
+        self._dropped_count = 0
+
+    def put(self, key, text):
+        """Queues a message, replacing a queued message with the same key. Returns False if the message was dropped because the queue is closed."""
+        with self._condition:
+            if self._closed:
+                return False
+            if key in self._messages:
+                self._messages[key][1] = text  # Keeps the original time so lag is still visible
+                self._coalesced_count += 1
+                return True
+            self._messages[key] = [time.time(), text]
+            self._condition.notify()
+            return True
+
+    def get(self):
+        """Waits for the next message, returning its text (or None once the queue is closed)."""
+        with self._condition:
+            while len(self._messages) == 0 and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+            queued_time, text = self._messages.popitem(last=False)[1]
+            self._sending_since = queued_time
+            return text
+
+    def done(self):
+        """Records that the last message from get() was sent."""
+        with self._condition:
+            self._sending_since = None
+            self._sent_count += 1
+
+    def close(self):
+        """Discards queued messages and wakes the sender thread."""
+        with self._condition:
+            self._closed = True
+            self._dropped_count += len(self._messages)
+            self._messages.clear()
+            self._condition.notify_all()
+
+    def get_lag_secs(self):
+        """Returns how long the oldest unsent message (including one being sent) has been waiting."""
+        with self._condition:
+            times = [x[0] for x in self._messages.values()]
+            if self._sending_since != None:
+                times.append(self._sending_since)
+            if len(times) == 0:
+                return 0
+            return time.time() - min(times)
+
+    def get_state(self):
+        """Returns a JSON-compatible dict with the queue depth and message counts."""
+        lag_secs = self.get_lag_secs()
+        with self._condition:
+            return {
+                "depth": len(self._messages),
+                "sending": self._sending_since != None,
+                "lag_secs": round(lag_secs, 3),
+                "sent": self._sent_count,
+                "coalesced": self._coalesced_count,
+                "dropped": self._dropped_count,
+                "closed": self._closed
+            }
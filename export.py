@@ -0,0 +1,139 @@
+import csv
+import datetime
+import importlib.util
+import io
+
+from util import *
+
+# Exports stream records (from the record archive or an immutable data
+# snapshot) in fixed-size chunks, so memory use doesn't depend on the size of
+# the history. Parquet output requires the optional "pyarrow" package.
+
+CSV_COLUMNS = ["person", "name", "start_time",
+               "end_time", "start_manual", "end_manual"]
+_CHUNK_ROWS = 1000  # Rows per CSV chunk or Parquet row group
+
+
+def is_parquet_available():
+    """Returns whether Parquet exports are supported (pyarrow is installed)."""
+    return importlib.util.find_spec("pyarrow") != None
+
+
+def parse_date_range(start_date=None, end_date=None):
+    """Converts optional "YYYY-MM-DD" dates (local time, inclusive) to a range of timestamps. Raises ValueError if a date is invalid."""
+    start_time = None
+    end_time = None
+    if start_date != None and start_date != "":
+        start_time = round(datetime.datetime.strptime(
+            start_date, "%Y-%m-%d").timestamp())
+    if end_date != None and end_date != "":
+        end_time = round((datetime.datetime.strptime(
+            end_date, "%Y-%m-%d") + datetime.timedelta(days=1)).timestamp())
+    return start_time, end_time
+
+
+def iter_records(records, person=None, start_time=None, end_time=None):
+    """Yields the matching records of a RecordTable oldest first (the table is newest first), filtered by person and by start time."""
+    for index in range(len(records) - 1, -1, -1):
+        record = records[index]
+        if person != None and record["person"] != person:
+            continue
+        if start_time != None and record["start_time"] < start_time:
+            continue
+        if end_time != None and record["start_time"] >= end_time:
+            continue
+        yield record
+
+
+def _iter_chunks(records):
+    """Yields lists of up to _CHUNK_ROWS records."""
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= _CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _format_time(timestamp):
+    """Formats a timestamp as a local time string (empty for open visits)."""
+    if timestamp == None:
+        return ""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def generate_csv(records, get_name):
+    """Yields the CSV export of an iterable of records as encoded chunks."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for chunk in _iter_chunks(records):
+        for record in chunk:
+            name = get_name(record["person"])
+            writer.writerow([record["person"], name if name != None else "", _format_time(record["start_time"]),
+                             _format_time(record["end_time"]), record["start_manual"], record["end_manual"]])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell() > 0:  # No matching records
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """Write-only file that collects bytes until they are taken by the generator."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        """Returns and clears the bytes written since the last call."""
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def generate_parquet(records, get_name):
+    """Yields the Parquet export of an iterable of records as chunks, writing one row group per chunk of records."""
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([
+        ("person", pyarrow.int32()),
+        ("name", pyarrow.string()),
+        ("start_time", pyarrow.timestamp("s", tz="UTC")),
+        ("end_time", pyarrow.timestamp("s", tz="UTC")),
+        ("start_manual", pyarrow.bool_()),
+        ("end_manual", pyarrow.bool_())
+    ])
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for chunk in _iter_chunks(records):
+        writer.write_table(pyarrow.table({
+            "person": [x["person"] for x in chunk],
+            "name": [get_name(x["person"]) for x in chunk],
+            "start_time": [x["start_time"] for x in chunk],
+            "end_time": [x["end_time"] for x in chunk],
+            "start_manual": [x["start_manual"] for x in chunk],
+            "end_manual": [x["end_manual"] for x in chunk]
+        }, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
@@ -0,0 +1,323 @@
+import argparse
+import hmac
+import http.server
+import json
+import threading
+import time
+import urllib.request
+import zlib
+
+from bounded_cache import BoundedCache
+from scanner import create_last_seen_ips, scan
+from util import *
+
+# Several AdvantageTrack instances can share the work of scanning a building
+# with multiple L2 segments (ARP doesn't cross routers). Scanner nodes run only
+# the probe and resolve stages and POST batches of MAC-seen events to the
+# aggregator's "/federation" endpoint. The aggregator merges and deduplicates
+# them, and its Monitor treats remote MACs the same as local detections.
+#
+# Batch format (zlib-compressed JSON):
+#   {"node": str, "session": int, "sequence": int, "sent_time": int,
+#    "events": [[mac, ip, seen_time], ...]}
+#
+# The sent time is stamped when each request is made (including retries), so
+# the aggregator can convert seen times to its own clock. A shared key is
+# required, since the endpoint also returns the general config.
+#
+# Run "python federation.py aggregate" and several "python federation.py scan"
+# processes to test federation locally without Google or fping.
+
+FEDERATION_KEY_HEADER = "X-Federation-Key"
+
+
+def encode_batch(node_id, session, sequence, events, sent_time=None):
+    """Serializes and compresses a batch of MAC-seen events."""
+    return zlib.compress(json.dumps({
+        "node": node_id,
+        "session": session,
+        "sequence": sequence,
+        "sent_time": round(time.time()) if sent_time == None else sent_time,
+        "events": events
+    }).encode("utf-8"))
+
+
+def decode_batch(body):
+    """Decompresses and parses a batch of MAC-seen events."""
+    return json.loads(zlib.decompress(body).decode("utf-8"))
+
+
+class FederationAggregator:
+    """Merges and deduplicates MAC-seen events from scanner nodes."""
+
+    _MAX_AGE_SECS = 60  # Remote detections older than this are ignored
+    _MAX_MACS = 65536
+    _MAX_NODES = 256
+    _NODE_EXPIRE_SECS = 7 * 24 * 3600  # Sequences of inactive nodes are forgotten after this time
+
+    def __init__(self, key=""):
+        """
+        Creates a new FederationAggregator.
+
+        Parameters:
+            key: The shared key that scanner nodes must send (required).
+        """
+
+        if key == None or key == "":
+            raise ValueError("A federation key is required")
+        self._KEY = key
+        self._lock = threading.Lock()
+        self._last_seen_macs = BoundedCache(
+            self._MAX_MACS, self._MAX_AGE_SECS)  # Key = MAC, value = [last seen time, IP, node]
+        self._node_sequences = BoundedCache(
+            self._MAX_NODES, self._NODE_EXPIRE_SECS)  # Key = node, value = [session, last sequence]
+
+    def check_key(self, key):
+        """Returns whether the key sent by a scanner node matches the shared key."""
+        return hmac.compare_digest(self._KEY.encode("utf-8"), (key if key != None else "").encode("utf-8"))
+
+    def receive(self, body, key=""):
+        """Processes a compressed batch from a scanner node. Returns a boolean indicating whether the batch was accepted."""
+        if not self.check_key(key):
+            return False
+
+        try:
+            batch = decode_batch(body)
+            node = str(batch["node"])
+            session = int(batch["session"])
+            sequence = int(batch["sequence"])
+            # Timestamps are converted to local time using their age so clock skew between nodes doesn't matter
+            clock_offset = round(time.time()) - int(batch["sent_time"])
+            events = []
+            for mac_address, ip_address, seen_time in batch["events"]:
+                if not isinstance(mac_address, str) or not (ip_address == None or isinstance(ip_address, str)):
+                    raise ValueError("invalid event")
+                events.append([mac_address, ip_address,
+                               int(seen_time) + clock_offset])
+        except:
+            log("Received invalid batch from scanner node")
+            return False
+
+        with self._lock:
+            # Skip duplicate or replayed batches
+            node_sequence = self._node_sequences.get(node)
+            if node_sequence != None:
+                last_session, last_sequence = node_sequence
+                if session == last_session and sequence <= last_sequence:
+                    return True
+                if session < last_session:
+                    return True
+
+            # Merge events, keeping the newest detection of each MAC
+            current_time = round(time.time())
+            for mac_address, ip_address, seen_time in events:
+                if current_time - seen_time > self._MAX_AGE_SECS:  # Delayed by a retry
+                    continue
+                last_seen = self._last_seen_macs.get(mac_address)
+                if last_seen == None or last_seen[0] < seen_time:
+                    self._last_seen_macs[mac_address] = [
+                        seen_time, ip_address, node]
+            self._node_sequences[node] = [session, sequence]
+        return True
+
+    def get_detected_macs(self, current_time=None):
+        """Returns the set of MAC addresses detected by any scanner node recently, removing expired entries."""
+        current_time = round(time.time()) if current_time == None else current_time
+        with self._lock:
+            for mac_address in [x for x, y in self._last_seen_macs.items() if current_time - y[0] > self._MAX_AGE_SECS]:
+                del self._last_seen_macs[mac_address]
+            return set(self._last_seen_macs.keys())
+
+    def get_cache_state(self):
+        """Returns a JSON-compatible dict with the size and evictions of each cache."""
+        return {"last_seen_macs": self._last_seen_macs.get_state(), "node_sequences": self._node_sequences.get_state()}
+
+    def get_state(self):
+        """Returns a JSON-compatible description of the merged detections and node sequences."""
+        with self._lock:
+            return {
+                "macs": {x: {"last_seen": y[0], "ip": y[1], "node": y[2]} for x, y in self._last_seen_macs.items()},
+                "nodes": {x: {"session": y[0], "sequence": y[1]} for x, y in self._node_sequences.items()}
+            }
+
+
+class ScannerNode:
+    """Runs the probe and resolve stages on a remote segment and streams MAC-seen events to an aggregator."""
+
+    _MAX_PENDING_BATCHES = 100  # Unsent batches are dropped beyond this (oldest first)
+    _SEND_TIMEOUT_SECS = 5
+
+    def __init__(self, aggregator_url, node_id, key, ip_range_start=None, ip_range_end=None, simulated_macs=None, ipv6_interface=None):
+        """
+        Creates a new ScannerNode.
+
+        Parameters:
+            aggregator_url: The base URL of the aggregator (e.g. "http://10.0.0.2:8000").
+            node_id: A unique name for this node.
+            key: The shared key expected by the aggregator.
+            ip_range_start: Overrides the first IP address to scan (otherwise from the aggregator config).
+            ip_range_end: Overrides the last IP address to scan (otherwise from the aggregator config).
+            simulated_macs: A list of MAC addresses to report every cycle instead of scanning (for local testing).
+            ipv6_interface: Overrides the network interface for IPv6 neighbor discovery (otherwise from the aggregator config).
+        """
+
+        self._URL = aggregator_url.rstrip("/") + "/federation"
+        self._NODE_ID = node_id
+        self._KEY = key
+        self._IP_RANGE_START = ip_range_start
+        self._IP_RANGE_END = ip_range_end
+        self._SIMULATED_MACS = simulated_macs
+        self._IPV6_INTERFACE = ipv6_interface
+
+        self._session = round(time.time() * 1000)
+        self._sequence = 0
+        self._pending_batches = []  # [sequence, events], encoded when sent
+        self._last_seen_ips = create_last_seen_ips()
+        self._general_config = None
+
+    def _fetch_config(self):
+        """Retrieves the general config from the aggregator, keeping the previous config if it fails."""
+        try:
+            request = urllib.request.Request(
+                self._URL, headers={FEDERATION_KEY_HEADER: self._KEY})
+            with urllib.request.urlopen(request, timeout=self._SEND_TIMEOUT_SECS) as response:
+                self._general_config = json.loads(response.read())
+        except:
+            if self._general_config == None:
+                log("Failed to retrieve config from aggregator")
+                return
+        if self._IP_RANGE_START != None:
+            self._general_config["ip_range_start"] = self._IP_RANGE_START
+        if self._IP_RANGE_END != None:
+            self._general_config["ip_range_end"] = self._IP_RANGE_END
+        if self._IPV6_INTERFACE != None:
+            self._general_config["ipv6_interface"] = self._IPV6_INTERFACE
+
+    def _collect_events(self, current_time):
+        """Runs a single scan, returning a list of [MAC, IP, time] events."""
+        if self._SIMULATED_MACS != None:
+            return [[x, None, current_time] for x in self._SIMULATED_MACS]
+        if self._general_config == None:
+            return []
+        detected, _ = scan(self._general_config,
+                           self._last_seen_ips, current_time)
+        return [[y, x, current_time] for x, y in detected.items()]
+
+    def _send_pending(self):
+        """Sends all pending batches in order, stopping at the first failure so they are retried next cycle."""
+        while len(self._pending_batches) > 0:
+            sequence, events = self._pending_batches[0]
+            try:
+                body = encode_batch(self._NODE_ID, self._session,
+                                    sequence, events)  # Stamped with the current time
+                request = urllib.request.Request(self._URL, data=body, headers={
+                    FEDERATION_KEY_HEADER: self._KEY,
+                    "Content-Type": "application/octet-stream"
+                })
+                urllib.request.urlopen(
+                    request, timeout=self._SEND_TIMEOUT_SECS).close()
+            except:
+                log("Failed to send " + str(len(self._pending_batches)) +
+                    " batch" + ("" if len(self._pending_batches) == 1 else "es") + " to aggregator")
+                return
+            self._pending_batches.pop(0)
+
+    def run_cycle(self):
+        """Scans once, queues the resulting batch, and sends all pending batches."""
+        current_time = round(time.time())
+        self._fetch_config()
+        try:
+            events = self._collect_events(current_time)
+        except:
+            log("Unknown error during scanner node cycle")
+            events = []
+
+        if len(events) > 0:
+            self._sequence += 1
+            self._pending_batches.append([self._sequence, events])
+            if len(self._pending_batches) > self._MAX_PENDING_BATCHES:
+                self._pending_batches.pop(0)
+        self._send_pending()
+
+    def run(self):
+        """Runs scan cycles forever."""
+        while True:
+            self.run_cycle()
+            delay = 1
+            if self._general_config != None and "ping_cycle_delay_secs" in self._general_config:
+                delay = self._general_config["ping_cycle_delay_secs"]
+            time.sleep(delay)
+
+
+def _serve_test_aggregator(port, key, general_config):
+    """Runs a standalone aggregator (without Google or a monitor) that logs the merged detections."""
+    aggregator = FederationAggregator(key)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not aggregator.check_key(self.headers.get(FEDERATION_KEY_HEADER, "")):
+                self.send_response(403)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps(general_config).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            accepted = aggregator.receive(
+                body, self.headers.get(FEDERATION_KEY_HEADER, ""))
+            self.send_response(200 if accepted else 403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log("Test aggregator listening on port " + str(port))
+    while True:
+        time.sleep(general_config["ping_cycle_delay_secs"])
+        state = aggregator.get_state()
+        log("Detected " + str(len(aggregator.get_detected_macs())) + " MAC address(es) from " +
+            str(len(state["nodes"])) + " node(s): " + json.dumps(state))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="AdvantageTrack scanner node federation")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    scan_parser = subparsers.add_parser(
+        "scan", help="run a scanner node that reports to an aggregator")
+    scan_parser.add_argument("aggregator_url")
+    scan_parser.add_argument("node_id")
+    scan_parser.add_argument("--key", required=True)
+    scan_parser.add_argument("--ip-range-start")
+    scan_parser.add_argument("--ip-range-end")
+    scan_parser.add_argument("--ipv6-interface",
+                             help="network interface for IPv6 neighbor discovery")
+    scan_parser.add_argument("--simulate", nargs="+", metavar="MAC",
+                             help="report these MAC addresses instead of scanning")
+
+    aggregate_parser = subparsers.add_parser(
+        "aggregate", help="run a standalone test aggregator")
+    aggregate_parser.add_argument("--port", type=int, default=8001)
+    aggregate_parser.add_argument("--key", required=True)
+    aggregate_parser.add_argument("--cycle-secs", type=float, default=5)
+
+    args = parser.parse_args()
+    if args.mode == "scan":
+        ScannerNode(args.aggregator_url, args.node_id, args.key,
+                    args.ip_range_start, args.ip_range_end, args.simulate, args.ipv6_interface).run()
+    else:
+        _serve_test_aggregator(args.port, args.key, {
+            "ping_cycle_delay_secs": args.cycle_secs,
+            "ping_timeout_secs": 1,
+            "ping_backoff_length_secs": 0
+        })
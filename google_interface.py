@@ -4,14 +4,12 @@ import json
 import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
-import gspread
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from PIL import Image, ImageOps
-
+from append_layout import AppendOnlyRecords, is_newest_first
+from memory import get_folder_bytes
+from records import RecordTable
 from util import *
 
 
@@ -42,12 +40,23 @@ class GoogleInterface:
                "https://spreadsheets.google.com/feeds"]
     _CONFIG_KEYS = ["welcome_message", "background_folder", "ip_range_start", "ip_range_end", "ping_cycle_delay_secs",
                     "ping_timeout_secs", "ping_backoff_length_secs", "auto_grace_period_mins", "auto_timeout_mins",
-                    "auto_extension_mins", "manual_timeout_hours", "manual_extension_hours"]
+                    "auto_extension_mins", "manual_timeout_hours", "manual_extension_hours", "ipv6_interface",
+                    "probe_tcp_ports", "probe_udp_ports", "probe_budget_secs"]
     _RECENT_RECORDS = 500  # Number of records to retrieve
     _CONFIG_CACHE_TIMES = [30, 60]
     _DATA_CACHE_TIMES = [10, 20, 30, 40, 50, 60]
     _STATUS_UPDATE_TIMES = [60]
     _BACKGROUND_HEIGHT = 1200  # Backgrounds are downscaled for fast loading
+    _BACKGROUND_MAX_FILES = 100  # Limits for the local background cache
+    _BACKGROUND_MAX_BYTES = 200 * 1024 * 1024
+    _RECORDS_LAYOUT_FILENAME = "records_layout.json"  # Marks that the Records sheet was migrated to the append-only layout
+    _RANGES = {
+        SheetType.CONFIG_GENERAL: "C2:C" + str(len(_CONFIG_KEYS) + 1),
+        SheetType.CONFIG_PEOPLE: "A:F",
+        SheetType.DATA_DEVICES: "A:C",
+        SheetType.DATA_RECORDS: "A2:E" + str(_RECENT_RECORDS + 1),
+        SheetType.DATA_STATUS: "A2"
+    }
 
     _start_time = round(time.time())
     _connection_status = ConnectionStatus.DISCONNECTED
@@ -57,7 +66,7 @@ class GoogleInterface:
     _gspread_sheets = {}
     _gdrive_client = None
 
-    def __init__(self, data_folder, cred_file_path, background_cache_folder, spreadsheet_id, status_callback, config_callback, data_callback, backgrounds_callback):
+    def __init__(self, data_folder, cred_file_path, background_cache_folder, spreadsheet_id, status_callback, config_callback, data_callback, backgrounds_callback, recorder=None, append_only=False):
         """
         Creates a new GoogleInterface.
 
@@ -70,6 +79,8 @@ class GoogleInterface:
             config_callback: A function that accepts a single argument for config data.
             data_callback: A function that accepts a single argument for general data.
             backgrounds_callback: A function that is called when the set of backgrounds changes.
+            recorder: An optional TraceRecorder that captures outgoing mutations for replay.
+            append_only: Whether to use the append-only layout, where new rows are added at the bottom of the Records sheet (migrated once). The Devices and Status sheets always insert new rows at the top.
         """
 
         self._DATA_FOLDER = data_folder
@@ -80,6 +91,17 @@ class GoogleInterface:
         self._config_callback = config_callback
         self._data_callback = data_callback
         self._backgrounds_callback = backgrounds_callback
+        self._recorder = recorder
+        self._last_raw = {}  # Key = SheetType, value = rows from the last refresh that was sent
+        self._last_config = None
+        self._records_layout = AppendOnlyRecords(
+            self._RECENT_RECORDS) if append_only else None
+        self._records_layout_lock = threading.Lock()
+        self._backgrounds_lock = threading.Lock()  # Held for a whole background sync
+
+        # Mutations run in order on one thread per sheet, so each write sees the rows left by the previous one
+        self._mutation_executors = {x: ThreadPoolExecutor(max_workers=1, thread_name_prefix="mutation-" + x.name.lower())
+                                    for x in [SheetType.DATA_DEVICES, SheetType.DATA_RECORDS, SheetType.DATA_STATUS]}
 
     def _set_connection_status(self, status):
         """Sets the current connection status and updates it externally if necessary."""
@@ -87,6 +109,18 @@ class GoogleInterface:
             self._connection_status = status
             self._status_callback(self._connection_status)
 
+    def _submit_mutation(self, sheet_type, function, *args):
+        """Queues a mutation on the executor for its sheet, returning a Future with the result."""
+        return self._mutation_executors[sheet_type].submit(function, *args)
+
+    def _run_mutation(self, sheet_type, function, *args):
+        """Queues a mutation on the executor for its sheet and waits for the boolean result."""
+        try:
+            return self._submit_mutation(sheet_type, function, *args).result()
+        except:
+            log("Unknown error while sending data to Google")
+            return False
+
     def _auth(self):
         """Connect to Google and reauthorize if necessary. Returns a boolean indicating whether the connection was successful."""
 
@@ -96,8 +130,12 @@ class GoogleInterface:
         if self._connection_status == ConnectionStatus.CONNECTED:
             log("Invalid credentials, reconnecting to Google")
 
-        # Authenticate to Google
+        # Authenticate to Google (libraries are imported here to keep startup fast)
         try:
+            import gspread
+            from google.oauth2.service_account import Credentials
+            from googleapiclient.discovery import build
+
             self._creds = Credentials.from_service_account_info(
                 json.load(open(get_absolute_path(self._DATA_FOLDER, self._CRED_FILE_PATH))), scopes=self._SCOPES)
             self._gspread_client = gspread.authorize(self._creds)
@@ -105,8 +143,7 @@ class GoogleInterface:
                 "drive", "v3", credentials=self._creds)
         except Exception as e:
             log("Failed to connect to Google using cred file \"" +
-                self._CRED_FILE_PATH + "\". The full message is displayed below.")
-            print(e)
+                self._CRED_FILE_PATH + "\" (" + type(e).__name__ + ", full message in log file)", details=str(e))
             self._set_connection_status(ConnectionStatus.DISCONNECTED)
             return False
 
@@ -118,8 +155,7 @@ class GoogleInterface:
             sheets = self._gspread_spreadsheet.worksheets()
         except Exception as e:
             log("Failed to open Google Sheet with ID \"" +
-                self._SPREADSHEET_ID + "\". The full message is displayed below.")
-            print(e)
+                self._SPREADSHEET_ID + "\" (" + type(e).__name__ + ", full message in log file)", details=str(e))
             self._set_connection_status(ConnectionStatus.DISCONNECTED)
             return False
 
@@ -145,83 +181,163 @@ class GoogleInterface:
         self._set_connection_status(ConnectionStatus.CONNECTED)
         return True
 
-    def _update_config(self, update_general=True, update_people=True, send_result=True):
-        """Retrieves the current general config data and people list, sending it to the callback if valid."""
+    def _prepare_records_layout(self):
+        """Reads the whole Records sheet once to find its end and open visits, first reversing it into the append-only order if it hasn't been migrated."""
+        with self._records_layout_lock:
+            if self._records_layout.is_ready():
+                return
+            sheet = self._gspread_sheets[SheetType.DATA_RECORDS]
+            rows = sheet.get("A2:E")
+            marker_path = get_absolute_path(
+                self._DATA_FOLDER, self._RECORDS_LAYOUT_FILENAME)
+            if not os.path.isfile(marker_path):
+                if is_newest_first(rows):
+                    log("Migrating " + str(len(rows)) +
+                        " records to the append-only layout")
+                    rows = [(x + [""] * 5)[:5] for x in reversed(rows)]
+                    sheet.update("A2:E" + str(len(rows) + 1), rows, raw=False)
+                write_json_atomic(marker_path, {
+                                  "layout": "append_only", "migrated_time": round(time.time())})
+            self._records_layout.load(rows)
+
+    def _read_sheets(self, types):
+        """Reads the ranges for the specified sheet types with a single batch request. Returns a dict of SheetType to a list of rows (records are newest first in either layout)."""
+        records_read = None
+        ranges = []
+        for type in types:
+            sheet_range = self._RANGES[type]
+            if type == SheetType.DATA_RECORDS and self._records_layout != None:
+                self._prepare_records_layout()
+                records_read = self._records_layout.begin_read()
+                sheet_range = records_read[0]
+            ranges.append("'" + type.get_friendly_name() + "'!" + sheet_range)
+        value_ranges = self._gspread_spreadsheet.values_batch_get(ranges)[
+            "valueRanges"]
+        raw = {x: y.get("values", []) for x, y in zip(types, value_ranges)}
+        if records_read != None:
+            raw[SheetType.DATA_RECORDS] = self._records_layout.finish_read(
+                raw[SheetType.DATA_RECORDS], records_read[1], records_read[2])
+        return raw
+
+    def _parse_config(self, raw):
+        """Parses the general config and people list from the raw rows of the config sheets."""
+        config = {"general": {}, "people": []}
+
+        # Get general config
+        for i, row in enumerate(raw[SheetType.CONFIG_GENERAL]):
+            key = self._CONFIG_KEYS[i]
+            if len(row) > 0:
+                value = row[0]
+            else:
+                value = None
+            if key == "ping_cycle_delay_secs" or key == "ping_timeout_secs" or key == "ping_backoff_length_secs" or key == "auto_grace_period_mins" or key == "auto_timeout_mins" or key == "auto_extension_mins" or key == "manual_timeout_hours" or key == "manual_extension_hours":
+                value = float(value)
+            config["general"][key] = value
+
+        # Get people
+        for row in raw[SheetType.CONFIG_PEOPLE][1:]:
+            if len(row[1]) > 0 and len(row[2]) > 0:
+                config["people"].append({
+                    "id": int(row[0]),
+                    "first_name": row[1],
+                    "last_name": row[2],
+                    "is_student": row[3] == "TRUE",
+                    "is_active": row[4] == "TRUE",
+                    "graduation_year": int(row[5]) if len(row) >= 6 and row[5] != "" else None
+                })
+        return config
+
+    def _parse_data(self, raw):
+        """Parses the devices and records from the raw rows of the data sheets (either may be missing from the dict)."""
+        data = {"devices": [], "records": RecordTable()}
+
+        # Get devices
+        if SheetType.DATA_DEVICES in raw:
+            for row in raw[SheetType.DATA_DEVICES][1:]:
+                if len(row[0]) > 0 and len(row[1]) > 0:
+                    data["devices"].append({
+                        "person": int(row[0]),
+                        "mac": row[1],
+                        "last_seen": int(row[2]) if len(row) > 2 else None
+                    })
+
+        # Get records
+        if SheetType.DATA_RECORDS in raw:
+            for row in raw[SheetType.DATA_RECORDS]:
+                if len(row[0]) > 0 and len(row[1]) > 0:
+                    data["records"].append(int(row[0]), int(row[1]),
+                                           int(row[2]) if len(row[2]) > 0 else None,
+                                           row[3] == "TRUE", row[4] == "TRUE")
+        return data
+
+    def _refresh(self, update_config=True, update_data=True, update_status=True):
+        """Reads every requested sheet with a single batch request. The config and data are only parsed and sent to the callbacks when their ranges changed since the last refresh."""
         if not self._auth():
             return None
 
-        config = {"general": {}, "people": []}
+        types = []
+        if update_config:
+            types += [SheetType.CONFIG_GENERAL, SheetType.CONFIG_PEOPLE]
+        if update_data:
+            types += [SheetType.DATA_DEVICES, SheetType.DATA_RECORDS]
+        if update_status:
+            types.append(SheetType.DATA_STATUS)
         try:
-            # Get general config
-            if update_general:
-                raw_data = self._gspread_sheets[SheetType.CONFIG_GENERAL].get(
-                    "C2:C" + str(len(self._CONFIG_KEYS) + 1))
-                for i, row in enumerate(raw_data):
-                    key = self._CONFIG_KEYS[i]
-                    if len(row) > 0:
-                        value = row[0]
-                    else:
-                        value = None
-                    if key == "ping_cycle_delay_secs" or key == "ping_timeout_secs" or key == "ping_backoff_length_secs" or key == "auto_grace_period_mins" or key == "auto_timeout_mins" or key == "auto_extension_mins" or key == "manual_timeout_hours" or key == "manual_extension_hours":
-                        value = float(value)
-                    config["general"][key] = value
-
-            # Get people
-            if update_people:
-                raw_data = self._gspread_sheets[SheetType.CONFIG_PEOPLE].get(
-                    "A:F")
-                for row in raw_data[1:]:
-                    if len(row[1]) > 0 and len(row[2]) > 0:
-                        config["people"].append({
-                            "id": int(row[0]),
-                            "first_name": row[1],
-                            "last_name": row[2],
-                            "is_student": row[3] == "TRUE",
-                            "is_active": row[4] == "TRUE",
-                            "graduation_year": int(row[5]) if len(row) >= 6 and row[5] != "" else None
-                        })
+            raw = self._read_sheets(types)
         except:
-            log("Failed to read config from Google")
+            log("Failed to read sheets from Google")
             self._set_connection_status(ConnectionStatus.WARNING)
             return None
-        else:
-            if send_result:
+
+        # Parse and send config
+        config_types = [SheetType.CONFIG_GENERAL, SheetType.CONFIG_PEOPLE]
+        if update_config and any(raw[x] != self._last_raw.get(x) for x in config_types):
+            try:
+                config = self._parse_config(raw)
+            except:
+                log("Failed to read config from Google")
+                self._set_connection_status(ConnectionStatus.WARNING)
+            else:
                 log("Updated config from Google")
                 self._config_callback(config)
-            return config
+                self._last_config = config
+                for type in config_types:
+                    self._last_raw[type] = raw[type]
+
+        # Parse and send data
+        data_types = [SheetType.DATA_DEVICES, SheetType.DATA_RECORDS]
+        if update_data and any(raw[x] != self._last_raw.get(x) for x in data_types):
+            try:
+                data = self._parse_data(raw)
+            except:
+                log("Failed to read data from Google")
+                self._set_connection_status(ConnectionStatus.WARNING)
+            else:
+                log("Updated data from Google")
+                self._data_callback(data)
+                for type in data_types:
+                    self._last_raw[type] = raw[type]
+
+        # Write status
+        if update_status:
+            self._submit_mutation(SheetType.DATA_STATUS, self._update_status,
+                                  raw[SheetType.DATA_STATUS]).result()
+
+        return raw
 
     def _update_data(self, update_devices=True, update_records=True, send_result=True):
         """Retrievess a list of registered devices ("devices"), with keys "person", "mac", and "last_seen", and a list of recent records ("records"), with keys "person", "start_time", "end_time", "start_manual", "end_manual". The result is sent to the callback if valid. This data does not include the status table."""
         if not self._auth():
             return None
 
-        data = {"devices": [], "records": []}
+        types = []
+        if update_devices:
+            types.append(SheetType.DATA_DEVICES)
+        if update_records:
+            types.append(SheetType.DATA_RECORDS)
         try:
-            # Get devices
-            if update_devices:
-                raw_data = self._gspread_sheets[SheetType.DATA_DEVICES].get(
-                    "A:C")
-                for row in raw_data[1:]:
-                    if len(row[0]) > 0 and len(row[1]) > 0:
-                        data["devices"].append({
-                            "person": int(row[0]),
-                            "mac": row[1],
-                            "last_seen": int(row[2]) if len(row) > 2 else None
-                        })
-
-            # Get records
-            if update_records:
-                raw_data = self._gspread_sheets[SheetType.DATA_RECORDS].get(
-                    "A2:E" + str(self._RECENT_RECORDS + 1))
-                for row in raw_data:
-                    if len(row[0]) > 0 and len(row[1]) > 0:
-                        data["records"].append({
-                            "person": int(row[0]),
-                            "start_time": int(row[1]),
-                            "end_time": int(row[2]) if len(row[2]) > 0 else None,
-                            "start_manual": row[3] == "TRUE",
-                            "end_manual": row[4] == "TRUE"
-                        })
+            raw = self._read_sheets(types)
+            data = self._parse_data(raw)
         except:
             log("Failed to read data from Google")
             self._set_connection_status(ConnectionStatus.WARNING)
@@ -230,16 +346,22 @@ class GoogleInterface:
             if send_result:
                 log("Updated data from Google")
                 self._data_callback(data)
+                for type in types:
+                    self._last_raw[type] = raw[type]
             return data
 
-    def _update_status(self):
+    def _update_status(self, status_rows=None):
+        """Adds or updates the row for this server's start time on the status sheet. The rows may be provided from an earlier batch read."""
         if not self._auth():
             return False
 
         try:
-            # Get last start time
             sheet = self._gspread_sheets[SheetType.DATA_STATUS]
-            last_start_time = int(sheet.get("A2")[0][0])
+
+            # Get last start time
+            if status_rows == None:
+                status_rows = sheet.get(self._RANGES[SheetType.DATA_STATUS])
+            last_start_time = int(status_rows[0][0])
 
             # Add new row / update end time
             current_time = round(time.time())
@@ -257,7 +379,16 @@ class GoogleInterface:
             return True
 
     def add_sign_in(self, person, is_manual, event_time=None):
-        """Creates a new visit (or updates an existing visit), then updates the data cache."""
+        """Creates a new visit (or updates an existing visit), then updates the data cache. Waits for earlier mutations to the records sheet."""
+        if self._recorder != None:
+            self._recorder.record_mutation("add_sign_in", person, is_manual, event_time)
+        event_time = round(time.time()) if event_time == None else event_time
+        if self._records_layout != None:
+            return self._run_layout_mutation("sign_in", person, is_manual, event_time)
+        return self._run_mutation(SheetType.DATA_RECORDS, self._add_sign_in, person, is_manual, event_time)
+
+    def _add_sign_in(self, person, is_manual, event_time):
+        """Writes a sign-in, locating the person's open visit from a read just before writing."""
         if not self._auth():
             return False
 
@@ -269,11 +400,10 @@ class GoogleInterface:
 
         # Search for existing visit
         existing_row = None
-        for index, record in enumerate(current_data["records"]):
-            if record["person"] == person and record["end_time"] == None:
+        for index in current_data["records"].person_indices(person):
+            if current_data["records"][index]["end_time"] == None:
                 existing_row = index + 2
 
-        event_time = round(time.time()) if event_time == None else event_time
         try:
             sheet = self._gspread_sheets[SheetType.DATA_RECORDS]
             if existing_row == None:
@@ -292,7 +422,46 @@ class GoogleInterface:
             return True
 
     def add_sign_out(self, person, is_manual, event_time=None):
-        """Closes all visits for the specified person, then updates the data cache."""
+        """Closes all visits for the specified person, then updates the data cache. Waits for earlier mutations to the records sheet."""
+        if self._recorder != None:
+            self._recorder.record_mutation("add_sign_out", person, is_manual, event_time)
+        event_time = round(time.time()) if event_time == None else event_time
+        if self._records_layout != None:
+            return self._run_layout_mutation("sign_out", person, is_manual, event_time)
+        return self._run_mutation(SheetType.DATA_RECORDS, self._add_sign_out, person, is_manual, event_time)
+
+    def _run_layout_mutation(self, action, person, is_manual, event_time):
+        """Queues a sign-in or sign-out for the append-only layout and waits for the batch that writes it."""
+        result = self._records_layout.submit(
+            action, person, is_manual, event_time)
+        self._submit_mutation(SheetType.DATA_RECORDS, self._flush_records)
+        return result.result()
+
+    def _flush_records(self):
+        """Writes all queued sign-ins and sign-outs in the append-only layout as a single batch, then updates the data cache."""
+        if not self._auth():
+            self._records_layout.fail_pending()
+            return
+        try:
+            self._prepare_records_layout()
+        except:
+            pass
+        if not self._records_layout.is_ready():
+            log("Failed to send visit data to Google (layout not ready)")
+            self._records_layout.fail_pending()
+            return
+        count, success = self._records_layout.flush(
+            self._gspread_sheets[SheetType.DATA_RECORDS])
+        if not success:
+            log("Failed to send visit data to Google")
+            self._set_connection_status(ConnectionStatus.WARNING)
+        elif count > 0:
+            log("Sent " + str(count) + " sign-in/sign-out operation" +
+                ("" if count == 1 else "s") + " to Google")
+            self._update_data()
+
+    def _add_sign_out(self, person, is_manual, event_time):
+        """Writes a sign-out, locating the person's open visits from a read just before writing."""
         if not self._auth():
             return False
 
@@ -304,14 +473,14 @@ class GoogleInterface:
 
         # Find all visits
         visits = []
-        for index, record in enumerate(current_data["records"]):
-            if record["person"] == person and record["end_time"] == None:
+        for index in current_data["records"].person_indices(person):
+            record = current_data["records"][index]
+            if record["end_time"] == None:
                 visits.append({
                     "row": index + 2,
                     "start_manual": record["start_manual"]
                 })
 
-        event_time = round(time.time()) if event_time == None else event_time
         try:
             sheet = self._gspread_sheets[SheetType.DATA_RECORDS]
             for visit in visits:
@@ -328,7 +497,13 @@ class GoogleInterface:
             return True
 
     def add_device(self, person, mac):
-        """Registers a new device to the specified person, then updates the data cache."""
+        """Registers a new device to the specified person, then updates the data cache. Waits for earlier mutations to the devices sheet."""
+        if self._recorder != None:
+            self._recorder.record_mutation("add_device", person, mac)
+        return self._run_mutation(SheetType.DATA_DEVICES, self._add_device, person, mac)
+
+    def _add_device(self, person, mac):
+        """Writes a device registration unless a read just before writing finds it already registered."""
         if not self._auth():
             return False
 
@@ -361,7 +536,13 @@ class GoogleInterface:
             return True
 
     def remove_device(self, person, mac):
-        """Removes the specified device, then updates the data cache."""
+        """Removes the specified device, then updates the data cache. Waits for earlier mutations to the devices sheet."""
+        if self._recorder != None:
+            self._recorder.record_mutation("remove_device", person, mac)
+        return self._run_mutation(SheetType.DATA_DEVICES, self._remove_device, person, mac)
+
+    def _remove_device(self, person, mac):
+        """Deletes the rows for a device, located from a read just before writing."""
         if not self._auth():
             return False
 
@@ -379,7 +560,7 @@ class GoogleInterface:
 
         try:
             sheet = self._gspread_sheets[SheetType.DATA_DEVICES]
-            for row in rows:
+            for row in reversed(rows):  # Bottom first so earlier rows don't shift
                 sheet.delete_rows(row)
 
         except:
@@ -392,7 +573,15 @@ class GoogleInterface:
             return True
 
     def update_device_last_seen(self, person, mac):
-        """Sets the "last seen" time for the specified device to today, then updates the data cache."""
+        """Sets the "last seen" time for the specified device to today, then updates the data cache. Waits for earlier mutations to the devices sheet."""
+        if self._recorder != None:
+            self._recorder.record_mutation("update_device_last_seen", person, mac)
+        event_time = round(datetime.datetime.combine(
+            datetime.datetime.today(), datetime.time.min).timestamp())
+        return self._run_mutation(SheetType.DATA_DEVICES, self._update_device_last_seen, person, mac, event_time)
+
+    def _update_device_last_seen(self, person, mac, event_time):
+        """Writes the "last seen" time to the rows for a device, located from a read just before writing."""
         if not self._auth():
             return False
 
@@ -408,8 +597,6 @@ class GoogleInterface:
             if device["person"] == person and device["mac"] == mac:
                 rows.append(index + 2)
 
-        event_time = round(datetime.datetime.combine(
-            datetime.datetime.today(), datetime.time.min).timestamp())
         try:
             sheet = self._gspread_sheets[SheetType.DATA_DEVICES]
             for row in rows:
@@ -425,12 +612,25 @@ class GoogleInterface:
             return True
 
     def _update_backgrounds(self, folder_id):
-        """Syncs the local cache of backgrounds to Google Drive."""
+        """Syncs the local cache of backgrounds to Google Drive, unless a sync is already running (e.g. the initial sync on its own thread)."""
+        if not self._backgrounds_lock.acquire(blocking=False):
+            log("Skipping background sync (already in progress)")
+            return True
+        try:
+            return self._sync_backgrounds(folder_id)
+        finally:
+            self._backgrounds_lock.release()
+
+    def _sync_backgrounds(self, folder_id):
+        """Downloads new backgrounds and deletes old ones. Must only be called with the backgrounds lock held."""
         if not self._auth():
             return False
 
         changed = False
         try:
+            from googleapiclient.http import MediaIoBaseDownload
+            from PIL import Image, ImageOps
+
             # Get list from local cache
             local_images = os.listdir(get_absolute_path(
                 self._DATA_FOLDER, self._BACKGROUND_CACHE_FOLDER))
@@ -443,6 +643,11 @@ class GoogleInterface:
             for google_image in raw_data:
                 google_images.append(google_image["id"] + "." +
                                      google_image["mimeType"].split("/")[1])
+            if len(google_images) > self._BACKGROUND_MAX_FILES:
+                log("Using " + str(self._BACKGROUND_MAX_FILES) + " of " +
+                    str(len(google_images)) + " backgrounds (limit reached)")
+                google_images = sorted(google_images)[
+                    :self._BACKGROUND_MAX_FILES]
 
             # Delete old images
             for image in local_images:
@@ -453,8 +658,13 @@ class GoogleInterface:
                     log("Deleted background \"" + image + "\"")
 
             # Download new images
+            cache_bytes = get_folder_bytes(get_absolute_path(
+                self._DATA_FOLDER, self._BACKGROUND_CACHE_FOLDER))
             for image in google_images:
                 if image not in local_images:
+                    if cache_bytes >= self._BACKGROUND_MAX_BYTES:
+                        log("Background cache is full, skipping remaining downloads")
+                        break
                     changed = True
 
                     # Download data
@@ -476,6 +686,8 @@ class GoogleInterface:
                         (new_width, self._BACKGROUND_HEIGHT))
                     pillow_image.save(get_absolute_path(self._DATA_FOLDER,
                                                         self._BACKGROUND_CACHE_FOLDER, image))
+                    cache_bytes += os.path.getsize(get_absolute_path(self._DATA_FOLDER,
+                                                                     self._BACKGROUND_CACHE_FOLDER, image))
                     log("Downloaded background \"" + image + "\"")
 
         except:
@@ -487,30 +699,44 @@ class GoogleInterface:
                 self._backgrounds_callback()
             return True
 
-    def _cache_thread(self):
+    def _initial_refresh(self, ready_callback):
+        """Connects to Google, then reads the config and data and writes the status concurrently. Backgrounds are synced afterwards in a separate thread as this could take some time."""
+        if not self._auth():
+            return
+
+        status_result = self._submit_mutation(
+            SheetType.DATA_STATUS, self._update_status)
+        self._refresh(True, True, False)
+        status_result.result()
+        if ready_callback != None:
+            ready_callback()
+
+        config = self._last_config
+        if config != None and "background_folder" in config["general"] and config["general"]["background_folder"] != None:
+            threading.Thread(target=self._update_backgrounds, args=(
+                config["general"]["background_folder"],), daemon=True).start()
+
+    def _cache_thread(self, ready_callback):
         """Thread to regularly update config and data."""
+        self._initial_refresh(ready_callback)
+
         while True:
             current_secs = datetime.datetime.now().second
             next_update = next(x for x in sorted(
                 set(self._CONFIG_CACHE_TIMES + self._DATA_CACHE_TIMES + self._STATUS_UPDATE_TIMES)) if x > current_secs)
             time.sleep(next_update - current_secs)
 
-            if next_update in self._CONFIG_CACHE_TIMES:
-                config = self._update_config()
+            update_config = next_update in self._CONFIG_CACHE_TIMES
+            raw = self._refresh(update_config, next_update in self._DATA_CACHE_TIMES,
+                                next_update in self._STATUS_UPDATE_TIMES)
+
+            if update_config and raw != None:
+                config = self._last_config
                 if config != None and "background_folder" in config["general"] and config["general"]["background_folder"] != None:
                     self._update_backgrounds(
                         config["general"]["background_folder"])
 
-            if next_update in self._DATA_CACHE_TIMES:
-                self._update_data()
-
-            if next_update in self._STATUS_UPDATE_TIMES:
-                self._update_status()
-
-    def start(self):
-        """Updates the config and data immediately, then starts the caching thread."""
-        self._update_config()  # Don't update backgrounds immediately as this could take some time
-        self._update_data()
-        self._update_status()
-
-        threading.Thread(target=self._cache_thread, daemon=True).start()
+    def start(self, ready_callback=None):
+        """Starts the caching thread, which updates the config and data immediately. The optional callback is called after the first update."""
+        threading.Thread(target=self._cache_thread, args=(
+            ready_callback,), daemon=True).start()
@@ -0,0 +1,527 @@
+import argparse
+import contextlib
+import io
+import json
+import random
+import re
+import shutil
+import tempfile
+import threading
+
+from change_bus import DEVICE_CHANGE_TYPES, VISIT_CHANGE_TYPES, ChangeBus, diff_config, diff_data
+from google_interface import GoogleInterface, SheetType
+from records import RecordTable
+from snapshot_store import SnapshotStore
+from util import *
+from web_server import WebServer
+
+# Runs the real WebServer and GoogleInterface against an in-process fake of
+# the Sheets and Drive APIs, then drives simulated kiosk clients over
+# WebSockets. Each command is timed until the first "data" broadcast that
+# reflects it (e.g. the person appears in the here-now list).
+
+
+class FakeApiError(Exception):
+    """Error raised by the fake API when an error is injected."""
+
+
+def _column_index(letters):
+    """Converts column letters (e.g. "C") to a zero-based index."""
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def _parse_range(a1_range):
+    """Parses an A1 range (e.g. "A2:E501", "A:F", "C2", or "A2:E") into zero-based first/last columns and rows (None if open-ended)."""
+    a1_range = a1_range.split("!")[-1]
+    parts = []
+    for cell in a1_range.split(":"):
+        match = re.match(r"^([A-Z]*)(\d*)$", cell)
+        parts.append((_column_index(match.group(1)) if match.group(1) != "" else None,
+                      int(match.group(2)) - 1 if match.group(2) != "" else None))
+    first = parts[0]
+    last = parts[-1] if len(parts) > 1 else parts[0]
+    return first[0], first[1] if first[1] != None else 0, last[0], last[1]
+
+
+def _to_cell(value):
+    """Converts a written value to the string returned by later reads."""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return str(value)
+
+
+class FakeSpreadsheet:
+    """In-memory spreadsheet implementing the gspread calls used by GoogleInterface, with injected latency and errors."""
+
+    def __init__(self, sheets, latency_secs=0.1, jitter_secs=0.05, error_rate=0, seed=None):
+        """
+        Creates a new FakeSpreadsheet.
+
+        Parameters:
+            sheets: A dict of sheet title to a list of rows (lists of strings).
+            latency_secs: The mean delay added to every API call.
+            jitter_secs: The maximum random variation of the delay.
+            error_rate: The probability that an API call raises a FakeApiError.
+            seed: An optional seed for the random latency and errors.
+        """
+
+        self._LATENCY_SECS = latency_secs
+        self._JITTER_SECS = jitter_secs
+        self._ERROR_RATE = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}  # Key = method name, value = count
+        self.worksheets_by_title = {x: FakeWorksheet(self, x, y, [3, 4] if x == SheetType.DATA_RECORDS.get_friendly_name() else [])
+                                    for x, y in sheets.items()}
+
+    def _call(self, method):
+        """Counts an API call, then waits and possibly raises an error as configured."""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            delay = max(0, self._LATENCY_SECS +
+                        self._random.uniform(-self._JITTER_SECS, self._JITTER_SECS))
+            fail = self._random.random() < self._ERROR_RATE
+        time.sleep(delay)
+        if fail:
+            raise FakeApiError("Injected error in " + method)
+
+    def reset_calls(self):
+        """Clears the call counts."""
+        with self._lock:
+            self.calls = {}
+
+    def worksheets(self):
+        return list(self.worksheets_by_title.values())
+
+    def values_batch_get(self, ranges):
+        self._call("values_batch_get")
+        value_ranges = []
+        for sheet_range in ranges:
+            title = sheet_range.split("!")[0].strip("'")
+            values = self.worksheets_by_title[title].read(sheet_range)
+            value_range = {"range": sheet_range}
+            if len(values) > 0:
+                value_range["values"] = values
+            value_ranges.append(value_range)
+        return {"valueRanges": value_ranges}
+
+
+class FakeWorksheet:
+    """Single sheet of a FakeSpreadsheet."""
+
+    def __init__(self, spreadsheet, title, rows, checkbox_columns=[]):
+        self._spreadsheet = spreadsheet
+        self.title = title
+        self._rows = [list(x) for x in rows]
+        self._CHECKBOX_COLUMNS = checkbox_columns  # Empty cells read as "FALSE" in rows with data
+
+    def _get_row(self, index):
+        """Returns the values of a row, filling in unchecked checkboxes."""
+        row = list(self._rows[index])
+        if index > 0 and any(x != "" for x in row):
+            for column in self._CHECKBOX_COLUMNS:
+                while len(row) <= column:
+                    row.append("")
+                if row[column] == "":
+                    row[column] = "FALSE"
+        return row
+
+    def read(self, sheet_range):
+        """Returns the values in a range, trimming empty cells at the end of each row and empty rows at the end (like the Sheets API)."""
+        first_column, first_row, last_column, last_row = _parse_range(
+            sheet_range)
+        with self._spreadsheet._lock:
+            values = []
+            for index in range(first_row, len(self._rows) if last_row == None else min(len(self._rows), last_row + 1)):
+                row = self._get_row(index)
+                row = row[first_column if first_column != None else 0:
+                          None if last_column == None else last_column + 1]
+                while len(row) > 0 and row[-1] == "":
+                    row = row[:-1]
+                values.append(row)
+            while len(values) > 0 and len(values[-1]) == 0:
+                values.pop()
+            return values
+
+    def _write(self, sheet_range, values):
+        """Writes a block of values starting at the first cell of the range (None leaves a cell unchanged)."""
+        first_column, first_row, _, _ = _parse_range(sheet_range)
+        first_column = first_column if first_column != None else 0
+        with self._spreadsheet._lock:
+            for row_offset, row_values in enumerate(values):
+                while len(self._rows) <= first_row + row_offset:
+                    self._rows.append([])
+                row = self._rows[first_row + row_offset]
+                for column_offset, value in enumerate(row_values):
+                    if value == None:
+                        continue
+                    while len(row) <= first_column + column_offset:
+                        row.append("")
+                    row[first_column + column_offset] = _to_cell(value)
+
+    def get(self, sheet_range):
+        self._spreadsheet._call("get")
+        return self.read(sheet_range)
+
+    def update(self, sheet_range, values, **kwargs):
+        self._spreadsheet._call("update")
+        self._write(sheet_range, values)
+
+    def batch_update(self, data, **kwargs):
+        self._spreadsheet._call("batch_update")
+        for item in data:
+            self._write(item["range"], item["values"])
+
+    def insert_row(self, values, index=1, **kwargs):
+        self._spreadsheet._call("insert_row")
+        with self._spreadsheet._lock:
+            self._rows.insert(
+                index - 1, ["" if x == None else _to_cell(x) for x in values])
+
+    def delete_rows(self, index, **kwargs):
+        self._spreadsheet._call("delete_rows")
+        with self._spreadsheet._lock:
+            if index - 1 < len(self._rows):
+                del self._rows[index - 1]
+
+    def append_rows(self, values, **kwargs):
+        self._spreadsheet._call("append_rows")
+        with self._spreadsheet._lock:
+            while len(self._rows) > 0 and all(x == "" for x in self._rows[-1]):
+                self._rows.pop()
+            first_row = len(self._rows) + 1
+            for row in values:
+                self._rows.append(
+                    ["" if x == None else _to_cell(x) for x in row])
+        return {"updates": {"updatedRange": "'" + self.title + "'!A" + str(first_row) + ":E" + str(first_row + len(values) - 1)}}
+
+
+class _FakeDriveRequest:
+    def __init__(self, spreadsheet, result):
+        self._spreadsheet = spreadsheet
+        self._result = result
+
+    def execute(self):
+        self._spreadsheet._call("drive")
+        return self._result
+
+
+class _FakeDriveFiles:
+    def __init__(self, spreadsheet):
+        self._spreadsheet = spreadsheet
+
+    def list(self, **kwargs):
+        return _FakeDriveRequest(self._spreadsheet, {"files": []})
+
+
+class _FakeDrive:
+    """Fake Drive client with an empty backgrounds folder."""
+
+    def __init__(self, spreadsheet):
+        self._spreadsheet = spreadsheet
+
+    def files(self):
+        return _FakeDriveFiles(self._spreadsheet)
+
+
+class _FakeCredentials:
+    valid = True
+
+
+class LoadTestGoogleInterface(GoogleInterface):
+    """GoogleInterface connected to a FakeSpreadsheet instead of Google."""
+
+    def __init__(self, spreadsheet, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fake_spreadsheet = spreadsheet
+
+    def _auth(self):
+        if self._connection_status == ConnectionStatus.CONNECTED:
+            return True
+        self._creds = _FakeCredentials()
+        self._gspread_spreadsheet = self._fake_spreadsheet
+        self._gspread_sheets = {x: self._fake_spreadsheet.worksheets_by_title[x.get_friendly_name()]
+                                for x in SheetType}
+        self._gdrive_client = _FakeDrive(self._fake_spreadsheet)
+        self._set_connection_status(ConnectionStatus.CONNECTED)
+        return True
+
+
+def create_sheets(people_count, devices_per_person):
+    """Returns the initial rows of each sheet for a team of the specified size."""
+    general = {
+        "welcome_message": "Load test",
+        "background_folder": "",
+        "ip_range_start": "10.0.0.1",
+        "ip_range_end": "10.0.0.254",
+        "ping_cycle_delay_secs": "5",
+        "ping_timeout_secs": "1",
+        "ping_backoff_length_secs": "0",
+        "auto_grace_period_mins": "5",
+        "auto_timeout_mins": "15",
+        "auto_extension_mins": "5",
+        "manual_timeout_hours": "4",
+        "manual_extension_hours": "1"
+    }
+    people = [["ID", "First Name", "Last Name", "Is Student", "Is Active", "Graduation Year"]]
+    devices = [["Person", "MAC", "Last Seen"]]
+    for person in range(1, people_count + 1):
+        people.append([str(person), "Person", str(person),
+                       "TRUE", "TRUE", "2030"])
+        for device in range(devices_per_person):
+            devices.append([str(person), "02:00:00:%02x:%02x:%02x" %
+                           (person >> 8 & 255, person & 255, device)])
+    return {
+        "Config - General": [["Key", "Description", "Value"]] + [[x, "", y] for x, y in general.items()],
+        "Config - People": people,
+        "Data - Devices": devices,
+        "Data - Records": [["Person", "Start Time", "End Time", "Start Manual", "End Manual"]],
+        "Data - Status": [["Start Time", "End Time"], ["0", "0"]]
+    }
+
+
+def _percentile(values, percentile):
+    """Returns the percentile of a list of values (nearest rank)."""
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+class _FanOutTracker:
+    """Records when each client received each "data" broadcast."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._receipts = {}  # Key = message text, value = list of receive times
+
+    def received(self, text, receive_time):
+        with self._lock:
+            self._receipts.setdefault(text, []).append(receive_time)
+
+    def get_fan_out_times(self, client_count):
+        """Returns the time from the first to the last client for each broadcast received by every client."""
+        with self._lock:
+            return [max(x) - min(x) for x in self._receipts.values() if len(x) >= client_count]
+
+
+def run_load_test(clients=10, commands=20, people_count=100, devices_per_person=1, port=8010, latency_secs=0.1,
+                  jitter_secs=0.05, error_rate=0, think_secs=0.1, timeout_secs=30, append_only=False, seed=None):
+    """Runs a load test and returns a dict describing the results."""
+    from ws4py.client.threadedclient import WebSocketClient
+
+    random_generator = random.Random(seed)
+    spreadsheet = FakeSpreadsheet(create_sheets(
+        people_count, devices_per_person), latency_secs, jitter_secs, error_rate, seed)
+    data_folder = tempfile.mkdtemp(prefix="advantagetrack_load_test_")
+    os.makedirs(os.path.join(data_folder, "backgrounds"))
+
+    # Set up the same components as main.py
+    config_store = SnapshotStore({"general": {}, "people": []})
+    data_store = SnapshotStore({"devices": [], "records": RecordTable()})
+    config_bus = ChangeBus(config_store, diff_config)
+    data_bus = ChangeBus(data_store, diff_data)
+    web_server = None
+
+    google_interface = LoadTestGoogleInterface(spreadsheet, data_folder, "", "backgrounds", "",
+                                               lambda status: web_server.new_google_status(
+                                                   status),
+                                               lambda new_config: config_bus.update(
+                                                   new_config),
+                                               lambda new_data: data_bus.update(
+                                                   new_data),
+                                               lambda: web_server.new_backgrounds(),
+                                               append_only=append_only)
+    web_server = WebServer(data_folder, "backgrounds", config_store, data_store,
+                           lambda person: google_interface.add_sign_in(
+                               person, True),
+                           lambda person: google_interface.add_sign_out(
+                               person, True),
+                           lambda person, mac: google_interface.add_device(
+                               person, mac),
+                           lambda person, mac: google_interface.remove_device(person, mac))
+    web_server._PORT = port
+    config_bus.subscribe(
+        lambda events, snapshot: web_server.config_changed(events))
+    data_bus.subscribe(lambda events, snapshot: web_server.new_data(),
+                       DEVICE_CHANGE_TYPES + VISIT_CHANGE_TYPES)
+
+    fan_out = _FanOutTracker()
+    samples = []  # [query, latency secs or None for timeouts]
+    samples_lock = threading.Lock()
+
+    class KioskClient(WebSocketClient):
+        """Simulated kiosk that waits for the data broadcast confirming each command."""
+
+        def __init__(self, url):
+            super().__init__(url)
+            self._condition = threading.Condition()
+            self._data = None
+
+        def received_message(self, message):
+            receive_time = time.perf_counter()
+            text = str(message)
+            message = json.loads(text)
+            if message["query"] == "data":
+                fan_out.received(text, receive_time)
+                with self._condition:
+                    self._data = message["data"]
+                    self._condition.notify_all()
+
+        def command(self, query, data, predicate):
+            """Sends a query and waits for a data broadcast matching the predicate. Returns the latency in seconds (None on timeout)."""
+            with self._condition:
+                self._data = None  # Only broadcasts after sending count
+            start_time = time.perf_counter()
+            self.send(json.dumps({"query": query, "data": data}))
+            if predicate == None:
+                return None
+            with self._condition:
+                while self._data == None or not predicate(self._data):
+                    remaining = timeout_secs - \
+                        (time.perf_counter() - start_time)
+                    if remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+            return time.perf_counter() - start_time
+
+    def run_client(client, people, devices):
+        signed_in = set()
+        for i in range(commands):
+            person = people[i % len(people)]
+            if i % 10 == 9 and len(devices) > 0:
+                device = devices.pop()
+                query = "remove_device"
+                latency = client.command(query, device, lambda data, device=device: not any(
+                    x["person"] == device["person"] and x["mac"] == device["mac"] for x in data["devices"]))
+            elif i % 7 == 6:
+                query = "auto_add"
+                latency = client.command(query, person, None)
+            elif person not in signed_in:
+                query = "sign_in"
+                signed_in.add(person)
+                latency = client.command(query, person, lambda data, person=person: any(
+                    x["person"] == person for x in data["here_now"]))
+            else:
+                query = "sign_out"
+                signed_in.discard(person)
+                latency = client.command(query, person, lambda data, person=person: not any(
+                    x["person"] == person for x in data["here_now"]))
+            with samples_lock:
+                samples.append([query, latency])
+            time.sleep(random_generator.uniform(0, 2 * think_secs))
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        import cherrypy
+        cherrypy.config.update({"log.screen": False})
+        ready = threading.Event()
+        web_server.start(ready.set)
+        ready.wait()
+        google_interface._initial_refresh(None)  # No background refreshes, so every later API call is from a command
+        time.sleep(0.5)
+
+        kiosks = []
+        for _ in range(clients):
+            kiosk = KioskClient("ws://127.0.0.1:" + str(port) + "/ws")
+            kiosk.connect()
+            kiosks.append(kiosk)
+        time.sleep(0.5)
+        spreadsheet.reset_calls()
+
+        # Each client works on its own people and devices so commands don't conflict
+        device_rows = spreadsheet.worksheets_by_title["Data - Devices"].read("A2:B")
+        threads = []
+        wall_start = time.perf_counter()
+        for index, kiosk in enumerate(kiosks):
+            people = list(range(index + 1, people_count + 1, clients))
+            devices = [{"person": int(x[0]), "mac": x[1]}
+                       for x in device_rows if int(x[0]) in people]
+            thread = threading.Thread(
+                target=run_client, args=(kiosk, people, devices))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        wall_secs = time.perf_counter() - wall_start
+
+        for kiosk in kiosks:
+            kiosk.close()
+        cherrypy.engine.exit()
+        log_writer.flush(5)  # Logs are written by a background thread
+    shutil.rmtree(data_folder, ignore_errors=True)
+
+    latencies = {}
+    timeouts = 0
+    for query, latency in samples:
+        if latency != None:
+            latencies.setdefault(query, []).append(latency)
+        elif query != "auto_add":
+            timeouts += 1
+    all_latencies = [y for x in latencies.values() for y in x]
+    fan_out_times = fan_out.get_fan_out_times(clients)
+    sheets_calls = {x: y for x, y in spreadsheet.calls.items() if x != "drive"}
+
+    def summarize(values):
+        return {
+            "count": len(values),
+            "p50_ms": _percentile(values, 50) * 1000,
+            "p99_ms": _percentile(values, 99) * 1000,
+            "p999_ms": _percentile(values, 99.9) * 1000,
+            "max_ms": max(values) * 1000 if len(values) > 0 else 0
+        }
+
+    return {
+        "commands": len(samples),
+        "timeouts": timeouts,
+        "wall_secs": wall_secs,
+        "latency": summarize(all_latencies),
+        "latency_by_query": {x: summarize(y) for x, y in latencies.items()},
+        "fan_out": summarize(fan_out_times),
+        "api_calls": sheets_calls,
+        "api_calls_per_command": sum(sheets_calls.values()) / len(samples) if len(samples) > 0 else 0
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test the AdvantageTrack web server against a fake Google backend")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--commands", type=int, default=20,
+                        help="commands sent by each client")
+    parser.add_argument("--people", type=int, default=100)
+    parser.add_argument("--devices-per-person", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="mean API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05,
+                        help="maximum API latency variation in seconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="probability of an injected API error")
+    parser.add_argument("--think", type=float, default=0.1,
+                        help="mean delay between commands from a client in seconds")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--append-only", action="store_true",
+                        help="use the append-only sheet layout")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    result = run_load_test(args.clients, args.commands, args.people, args.devices_per_person, args.port, args.latency,
+                           args.jitter, args.error_rate, args.think, args.timeout, args.append_only, args.seed)
+
+    def format_summary(summary):
+        return "p50 " + str(round(summary["p50_ms"], 1)) + " ms, p99 " + str(round(summary["p99_ms"], 1)) + " ms, p999 " + \
+            str(round(summary["p999_ms"], 1)) + " ms, max " + \
+            str(round(summary["max_ms"], 1)) + \
+            " ms (" + str(summary["count"]) + ")"
+    print("Sent " + str(result["commands"]) + " commands from " + str(args.clients) + " clients in " +
+          str(round(result["wall_secs"], 2)) + "s (" + str(result["timeouts"]) + " unconfirmed)")
+    print("Command to data broadcast: " + format_summary(result["latency"]))
+    for query, summary in sorted(result["latency_by_query"].items()):
+        print("  " + query + ": " + format_summary(summary))
+    print("Broadcast fan-out: " + format_summary(result["fan_out"]))
+    print("API calls per command: " + str(round(result["api_calls_per_command"], 2)) +
+          " " + json.dumps(result["api_calls"]))
@@ -0,0 +1,196 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# Log messages are handed to a background thread through a queue, so callers
+# never wait on stdout (often journald on an SD card) or the log file. The
+# writer batches console output, optionally writes JSON lines to rotating
+# files, and rate limits repeated messages. A forked child (the scan process)
+# gets a fresh queue and thread, and appends to the same log file without
+# rotating it, reopening the file when the parent rotates it. This module
+# can't import util, since util.log is built on it.
+
+
+class LogWriter:
+    """Writes log messages from a queue on a background thread."""
+
+    _QUEUE_SIZE = 10000  # Messages beyond this are dropped (and counted) instead of blocking
+    _RATE_LIMIT_COUNT = 5  # Identical messages allowed per window
+    _RATE_LIMIT_WINDOW_SECS = 60
+    _IDLE_PERIOD_SECS = 1  # How often to report suppressed messages when the queue is idle
+    _EXIT_TIMEOUT_SECS = 2
+
+    def __init__(self):
+        """Creates a new LogWriter. The thread is started by the first message."""
+        self._file_handler = None
+        self._file_path = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.flush, self._EXIT_TIMEOUT_SECS)
+
+    def _reset(self):
+        """Creates the lock, queue, and counters, with no thread running."""
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=self._QUEUE_SIZE)
+        self._pid = None  # Process that owns the thread
+        self._rate_limits = {}  # Key = (source, message), value = [window start, count, suppressed count]
+        self._dropped_count = 0
+        self._written_count = 0
+        self._suppressed_count = 0
+
+    def _after_fork(self):
+        """Runs in a forked child, where the parent's thread is gone and its locks may be held."""
+        self._reset()
+        if self._file_path != None:
+            # The parent's handler (and its lock) can't be used, and only the parent rotates the file
+            handler = logging.handlers.WatchedFileHandler(
+                self._file_path, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._file_handler = handler
+
+    def configure_file(self, path, max_bytes, backup_count):
+        """Also writes every message as a JSON line to a file, rotated when it reaches max_bytes."""
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        with self._lock:
+            old_handler = self._file_handler
+            self._file_handler = handler
+            self._file_path = path
+        if old_handler != None:
+            old_handler.close()
+
+    def _ensure_started(self):
+        """Starts the writer thread if it isn't running yet."""
+        if self._pid != None:
+            return
+        with self._lock:
+            if self._pid == None:
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def write(self, output, source=None, details=None):
+        """Queues a message without blocking.
+
+        Parameters:
+            output: The text of the message.
+            source: An optional prefix identifying the source (e.g. a client IP address).
+            details: An optional JSON-compatible value written only to the log file.
+        """
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.time(), output, source, details))
+        except queue.Full:
+            with self._lock:
+                self._dropped_count += 1
+
+    def flush(self, timeout_secs=None):
+        """Waits until every queued message has been written (or the timeout expires)."""
+        if self._pid != os.getpid():
+            return
+        done = threading.Event()
+        try:
+            self._queue.put((None, done), timeout=timeout_secs)
+        except queue.Full:
+            return
+        done.wait(timeout_secs)
+
+    def _check_rate_limit(self, key, timestamp):
+        """Returns whether a message should be written, counting it against its window."""
+        entry = self._rate_limits.get(key)
+        if entry == None or timestamp - entry[0] >= self._RATE_LIMIT_WINDOW_SECS:
+            self._rate_limits[key] = [timestamp, 1, 0]
+            return True
+        entry[1] += 1
+        if entry[1] <= self._RATE_LIMIT_COUNT:
+            return True
+        entry[2] += 1
+        return False
+
+    def _expire_rate_limits(self, timestamp, lines):
+        """Removes finished windows, adding a summary line for each one that suppressed messages."""
+        for key, entry in list(self._rate_limits.items()):
+            if timestamp - entry[0] >= self._RATE_LIMIT_WINDOW_SECS:
+                del self._rate_limits[key]
+                if entry[2] > 0:
+                    lines.append((timestamp, "Suppressed " + str(entry[2]) + " repeat" + ("" if entry[2] == 1 else "s") +
+                                  " of \"" + key[1] + "\"", key[0], None))
+
+    def _format_console(self, timestamp, output, source):
+        if source == None:
+            return time.strftime("[%d/%b/%Y:%H:%M:%S] ", time.localtime(timestamp)) + output
+        else:
+            return source + time.strftime(" - - [%d/%b/%Y:%H:%M:%S] ", time.localtime(timestamp)) + output
+
+    def _format_json(self, timestamp, output, source, details):
+        line = {"timestamp": round(timestamp, 3), "message": output}
+        if source != None:
+            line["source"] = source
+        if details != None:
+            line["details"] = details
+        return json.dumps(line)
+
+    def _write_lines(self, lines):
+        """Writes a batch of messages to the console and log file."""
+        if len(lines) == 0:
+            return
+        try:
+            sys.stdout.write("".join(self._format_console(
+                x[0], x[1], x[2]) + "\n" for x in lines))
+            sys.stdout.flush()
+        except:
+            pass
+        with self._lock:
+            file_handler = self._file_handler
+            self._written_count += len(lines)
+        if file_handler != None:
+            for line in lines:
+                file_handler.handle(logging.makeLogRecord(
+                    {"msg": self._format_json(*line)}))
+
+    def _run(self):
+        """Writes queued messages forever, batching whatever is available."""
+        message_queue = self._queue
+        while True:
+            try:
+                items = [message_queue.get(timeout=self._IDLE_PERIOD_SECS)]
+            except queue.Empty:
+                items = []
+            while len(items) < self._QUEUE_SIZE:
+                try:
+                    items.append(message_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            flush_events = []
+            for item in items:
+                if item[0] == None:
+                    flush_events.append(item[1])
+                elif self._check_rate_limit((item[2], item[1]), item[0]):
+                    lines.append(item)
+                else:
+                    with self._lock:
+                        self._suppressed_count += 1
+            self._expire_rate_limits(time.time(), lines)
+            self._write_lines(lines)
+            for event in flush_events:
+                event.set()
+
+    def get_state(self):
+        """Returns a JSON-compatible dict with the queue depth and message counts."""
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "written": self._written_count,
+                "suppressed": self._suppressed_count,
+                "dropped": self._dropped_count,
+                "file": self._file_handler.baseFilename if self._file_handler != None else None
+            }
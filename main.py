@@ -1,26 +1,58 @@
 import json
 import os
+import threading
 import time
 
+from change_bus import CONFIG_CHANGE_TYPES, DEVICE_CHANGE_TYPES, RECORD_CHANGE_TYPES, VISIT_CHANGE_TYPES, ChangeBus, ChangeType, diff_config, diff_data
+from federation import FederationAggregator
 from google_interface import GoogleInterface
+from memory import MemoryMonitor, get_folder_bytes
 from monitor import Monitor
+from pending_operations import PendingOperations
+from record_archive import RecordArchive
+from records import RecordTable
+from simulation import TraceRecorder
+from snapshot_store import SnapshotStore
 from util import *
 from web_server import WebServer
 
 # Config
 SPREADSHEET_ID = ""
 ENABLE_MONITOR = True
+ENABLE_SCAN_PROCESS = False  # Run network scans in a separate process (avoids competing for the GIL)
+ENABLE_FEDERATION = False  # Accept MAC-seen events from scanner nodes (see federation.py)
+FEDERATION_KEY = ""  # Shared key required from scanner nodes (federation stays disabled if empty)
+RECORD_TRACE_PATH = None  # Set to a path to record a trace for replay (see simulation.py)
+EXPORT_KEY = ""  # Key required to download records from /export (exports are disabled if empty)
+RECORDS_APPEND_ONLY = False  # Append new rows at the bottom of the records sheet instead of inserting at the top (see README)
 
 # Cache paths
 DATA_FOLDER = "data"
 CRED_FILE_PATH = "google_credentials.json"
-CONFIG_CACHE_FILENAME = "config_cache.json"
+CONFIG_CACHE_FILENAME = "config_cache.json"  # Legacy, read if no snapshot exists
+SNAPSHOT_FILENAME = "cache_snapshot.json"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DELAY_SECS = 10  # Changes within this time are written as a single snapshot
+RECORD_ARCHIVE_FILENAME = "record_archive.jsonl"  # Every closed record seen, for exports
 BACKGROUND_CACHE_FOLDER = "backgrounds"
+LOG_FILENAME = "log.jsonl"  # JSON lines, or None to only log to stdout
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
 
 # Global variables
-config_cache = {"general": {}, "people": []}
-data_cache = {"devices": [], "records": []}
+config_store = SnapshotStore({"general": {}, "people": []})
+data_store = SnapshotStore({"devices": [], "records": RecordTable()})
+config_bus = ChangeBus(config_store, diff_config)
+data_bus = ChangeBus(data_store, diff_data)
 google_interface = None
+federation_aggregator = None
+record_archive = None
+pending_operations = PendingOperations()
+memory_monitor = MemoryMonitor()
+trace_recorder = None
+startup_timer = PhaseTimer()
+snapshot_lock = threading.Lock()
+snapshot_timer = None  # Pending snapshot write
 web_server = None
 monitor = None
 
@@ -38,26 +70,123 @@ monitor = None
 #           CONNECTED = There are no issues with the connection.
 
 
-def update_config_cache(new_config):
-    """Callback to update the config cache from Google, writing to disk and pushing to all modules."""
-    global config_cache
+def save_snapshot():
+    """Writes the config and data caches to disk atomically so the next startup can serve them immediately."""
+    config_cache = config_store.get()
+    data_cache = data_store.get()
+    try:
+        write_json_atomic(get_absolute_path(DATA_FOLDER, SNAPSHOT_FILENAME), {
+            "version": SNAPSHOT_VERSION,
+            "timestamp": round(time.time()),
+            "config": config_cache,
+            "data": {
+                "devices": data_cache["devices"],
+                "records": data_cache["records"].to_list()
+            }
+        })
+    except:
+        log("Failed to save cache snapshot")
+
+
+def load_snapshot():
+    """Reads the config and data caches from the last snapshot (or the legacy config cache) if available."""
+    snapshot_path = get_absolute_path(DATA_FOLDER, SNAPSHOT_FILENAME)
+    if os.path.isfile(snapshot_path):
+        try:
+            snapshot = json.load(open(snapshot_path))
+            if snapshot["version"] != SNAPSHOT_VERSION:
+                log("Ignoring cache snapshot with unknown version " +
+                    str(snapshot["version"]))
+            else:
+                config_bus.update(snapshot["config"])
+                data_bus.update({
+                    "devices": snapshot["data"]["devices"],
+                    "records": RecordTable(snapshot["data"]["records"])
+                })
+                log("Loaded cache snapshot from " + time.strftime("%d/%b/%Y:%H:%M:%S",
+                                                                  time.localtime(snapshot["timestamp"])))
+                return
+        except:
+            log("Failed to read cache snapshot")
 
-    if new_config != config_cache:
-        log("Config cache has changed, saving to file and sending to web server")
-        config_cache = new_config
-        json.dump(config_cache, open(
-            get_absolute_path(DATA_FOLDER, CONFIG_CACHE_FILENAME), "w"))
-        web_server.new_config()
+    config_path = get_absolute_path(DATA_FOLDER, CONFIG_CACHE_FILENAME)
+    if os.path.isfile(config_path):
+        config_bus.update(json.load(open(config_path)))
+
+
+def update_config_cache(new_config):
+    """Callback to update the config cache from Google, publishing a new snapshot if it changed."""
+    events = config_bus.update(new_config)
+    if len(events) > 0:
+        log("Config cache has changed (" + str(len(events)) + " change" +
+            ("" if len(events) == 1 else "s") + ")", details=[x.type.name for x in events])
 
 
 def update_data_cache(new_data):
-    """Callback to update the data cache from Google, pushing to all modules."""
-    global data_cache
+    """Callback to update the data cache from Google, publishing a new snapshot if it changed."""
+    events = data_bus.update(new_data)
+    if len(events) > 0:
+        log("Data cache has changed (" + str(len(events)) + " change" +
+            ("" if len(events) == 1 else "s") + ")", details=[x.type.name for x in events])
+
+
+def write_pending_snapshot():
+    """Writes the snapshot scheduled by cache_changed."""
+    global snapshot_timer
+    with snapshot_lock:
+        snapshot_timer = None
+    save_snapshot()
+
 
-    if new_data != data_cache:
-        log("Data cache has changed, sending to web sever")
-        data_cache = new_data
-        web_server.new_data()
+def cache_changed(events, snapshot):
+    """Change subscriber for both caches, scheduling a snapshot write so a burst of changes is written once."""
+    global snapshot_timer
+    with snapshot_lock:
+        if snapshot_timer == None:
+            snapshot_timer = threading.Timer(
+                SNAPSHOT_DELAY_SECS, write_pending_snapshot)
+            snapshot_timer.daemon = True
+            snapshot_timer.start()
+
+
+def archive_records(events, snapshot):
+    """Change subscriber for records, adding newly closed or edited records to the local archive."""
+    record_archive.add([x.new for x in events if x.new != None])
+
+
+def get_debug_state():
+    """Returns a JSON-compatible dict with the internal state of each module, for debugging."""
+    state = {"startup": startup_timer.get_phases(),
+             "cache_versions": {"config": config_store.get_version(), "data": data_store.get_version()},
+             "pending_operations": pending_operations.get_state(),
+             "websocket_clients": web_server.get_client_state(),
+             "log": log_writer.get_state()}
+    if federation_aggregator != None:
+        state["federation"] = federation_aggregator.get_state()
+    return state
+
+
+def register_memory_gauges():
+    """Adds a size gauge for each cache to the memory monitor."""
+    memory_monitor.register_gauge(
+        "config_people", lambda: len(config_store.get()["people"]))
+    memory_monitor.register_gauge(
+        "data_devices", lambda: len(data_store.get()["devices"]))
+    memory_monitor.register_gauge(
+        "data_records", lambda: len(data_store.get()["records"]))
+    memory_monitor.register_gauge(
+        "data_records_bytes", lambda: data_store.get()["records"].get_size_bytes())
+    memory_monitor.register_gauge(
+        "pending_operations", lambda: len(pending_operations.get_state()))
+    memory_monitor.register_gauge(
+        "monitor", lambda: monitor.get_cache_state())
+    memory_monitor.register_gauge("websocket_queued_messages", lambda: sum(
+        x["depth"] for x in web_server.get_client_state()))
+    memory_monitor.register_gauge("background_cache_bytes", lambda: get_folder_bytes(
+        get_absolute_path(DATA_FOLDER, BACKGROUND_CACHE_FOLDER)))
+    if federation_aggregator != None:
+        memory_monitor.register_gauge(
+            "federation", lambda: federation_aggregator.get_cache_state())
 
 
 if __name__ == "__main__":
@@ -68,13 +197,28 @@ if __name__ == "__main__":
     backgrounds_path = get_absolute_path(DATA_FOLDER, BACKGROUND_CACHE_FOLDER)
     if not os.path.isdir(backgrounds_path):
         os.makedirs(backgrounds_path)
+    if LOG_FILENAME != None:
+        log_writer.configure_file(get_absolute_path(
+            DATA_FOLDER, LOG_FILENAME), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
 
-    # Read initial config cache
-    config_path = get_absolute_path(DATA_FOLDER, CONFIG_CACHE_FILENAME)
-    if os.path.isfile(config_path):
-        config_cache = json.load(open(config_path))
+    startup_timer.mark("imports")
+
+    # Read initial caches (refreshed from Google in the background)
+    load_snapshot()
+    startup_timer.mark("snapshot loaded")
 
     # Instantiate components
+    record_archive = RecordArchive(
+        get_absolute_path(DATA_FOLDER, RECORD_ARCHIVE_FILENAME))
+    data_bus.subscribe(archive_records, RECORD_CHANGE_TYPES,
+                       init=lambda snapshot: record_archive.add(snapshot.value["records"]))
+    if ENABLE_FEDERATION:
+        if FEDERATION_KEY == "":
+            log("Federation is disabled because FEDERATION_KEY is empty")
+        else:
+            federation_aggregator = FederationAggregator(FEDERATION_KEY)
+    if RECORD_TRACE_PATH != None:
+        trace_recorder = TraceRecorder(RECORD_TRACE_PATH)
     google_interface = GoogleInterface(DATA_FOLDER, CRED_FILE_PATH, BACKGROUND_CACHE_FOLDER, SPREADSHEET_ID,
                                        lambda status: web_server.new_google_status(
                                            status),
@@ -82,29 +226,52 @@ if __name__ == "__main__":
                                            new_config),
                                        lambda new_data: update_data_cache(
                                            new_data),
-                                       lambda: web_server.new_backgrounds())
-    web_server = WebServer(DATA_FOLDER, BACKGROUND_CACHE_FOLDER, lambda: config_cache,
-                           lambda: data_cache,
+                                       lambda: web_server.new_backgrounds(),
+                                       trace_recorder,
+                                       RECORDS_APPEND_ONLY)
+    web_server = WebServer(DATA_FOLDER, BACKGROUND_CACHE_FOLDER, config_store,
+                           data_store,
                            lambda person: google_interface.add_sign_in(
                                person, True),
                            lambda person: google_interface.add_sign_out(
                                person, True),
                            lambda person, mac: google_interface.add_device(
                                person, mac),
-                           lambda person, mac: google_interface.remove_device(person, mac))
-    monitor = Monitor(lambda: config_cache,
-                      lambda: data_cache,
+                           lambda person, mac: google_interface.remove_device(
+                               person, mac),
+                           federation_aggregator,
+                           get_debug_state,
+                           memory_monitor,
+                           record_archive,
+                           EXPORT_KEY)
+    monitor = Monitor(config_store,
+                      data_store,
+                      data_bus,
                       lambda status: web_server.new_monitor_status(status),
-                      lambda person, event_time: google_interface.add_sign_in(
-                          person, False, event_time),
-                      lambda person, event_time: google_interface.add_sign_out(
-                          person, False, event_time),
-                      lambda person, mac: google_interface.update_device_last_seen(person, mac))
-    # Start components
-    google_interface.start()
-    web_server.start()
+                      lambda person, event_time: pending_operations.submit(
+                          person, "sign_in", None, lambda: google_interface.add_sign_in(person, False, event_time)),  # Sign-in times change every cycle, so key by person only
+                      lambda person, event_time: pending_operations.submit(
+                          person, "sign_out", event_time, lambda: google_interface.add_sign_out(person, False, event_time)),
+                      lambda person, mac: pending_operations.submit(
+                          person, "last_seen " + mac, time.strftime("%Y-%m-%d"), lambda: google_interface.update_device_last_seen(person, mac)),
+                      federation_aggregator.get_detected_macs if federation_aggregator != None else None,
+                      ENABLE_SCAN_PROCESS,
+                      trace_recorder)
+    config_bus.subscribe(cache_changed, CONFIG_CHANGE_TYPES)
+    data_bus.subscribe(cache_changed, [ChangeType.DEVICE_REGISTERED, ChangeType.DEVICE_REMOVED] +
+                       RECORD_CHANGE_TYPES)  # Last seen dates are refreshed from Google, so they don't need a write
+    config_bus.subscribe(
+        lambda events, snapshot: web_server.config_changed(events))
+    data_bus.subscribe(lambda events, snapshot: web_server.new_data(),
+                       DEVICE_CHANGE_TYPES + VISIT_CHANGE_TYPES)
+    register_memory_gauges()
+    memory_monitor.start()
+
+    # Start components (serving from the snapshot until Google responds)
+    web_server.start(lambda: startup_timer.mark("web server ready"))
     if ENABLE_MONITOR:
         monitor.start()
+    google_interface.start(lambda: startup_timer.mark("first Google refresh"))
 
     # Loop forever
     while True:
@@ -0,0 +1,145 @@
+import collections
+import os
+import threading
+import tracemalloc
+
+from util import *
+
+
+def get_rss_bytes():
+    """Returns the resident set size of this process in bytes (None if unavailable)."""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if os.uname().sysname == "Darwin" else 1024)  # Peak, not current
+    except:
+        return None
+
+
+def get_folder_bytes(path):
+    """Returns the total size of the files in a folder."""
+    total = 0
+    for name in os.listdir(path):
+        try:
+            total += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return total
+
+
+class MemoryMonitor:
+    """Tracks the memory used by the process and its caches.
+
+    RSS is sampled periodically into a fixed-length history, so a leak shows up
+    as a positive trend over days or weeks. Tracemalloc is only enabled on
+    demand (it slows down allocations), after which each diff compares against
+    the previous snapshot.
+    """
+
+    _SAMPLE_PERIOD_SECS = 600
+    _HISTORY_LENGTH = 6 * 24 * 28  # Four weeks of samples
+    _TRACE_FRAMES = 5
+
+    def __init__(self):
+        """Creates a new MemoryMonitor."""
+        self._lock = threading.Lock()
+        self._gauges = {}  # Key = name, value = function returning a JSON-compatible size
+        self._rss_history = collections.deque(
+            maxlen=self._HISTORY_LENGTH)  # [time, bytes]
+        self._last_snapshot = None
+
+    def register_gauge(self, name, function):
+        """Adds a size gauge, which is a function that returns the current size of a cache (e.g. a number of entries or bytes)."""
+        self._gauges[name] = function
+
+    def get_gauges(self):
+        """Returns the current value of every gauge."""
+        gauges = {}
+        for name, function in self._gauges.items():
+            try:
+                gauges[name] = function()
+            except:
+                gauges[name] = None
+        return gauges
+
+    def _get_rss_trend(self):
+        """Returns the least-squares slope of the RSS history in bytes per day (None with too few samples)."""
+        with self._lock:
+            samples = list(self._rss_history)
+        if len(samples) < 2:
+            return None
+        mean_time = sum(x[0] for x in samples) / len(samples)
+        mean_rss = sum(x[1] for x in samples) / len(samples)
+        variance = sum((x[0] - mean_time) ** 2 for x in samples)
+        if variance == 0:
+            return None
+        slope = sum((x[0] - mean_time) * (x[1] - mean_rss)
+                    for x in samples) / variance
+        return round(slope * 86400)
+
+    def get_state(self):
+        """Returns a JSON-compatible dict with the current RSS, its trend, and the cache gauges."""
+        with self._lock:
+            history = list(self._rss_history)
+        return {
+            "rss_bytes": get_rss_bytes(),
+            "rss_trend_bytes_per_day": self._get_rss_trend(),
+            "rss_samples": len(history),
+            "rss_min_bytes": min(x[1] for x in history) if len(history) > 0 else None,
+            "rss_max_bytes": max(x[1] for x in history) if len(history) > 0 else None,
+            "tracing": tracemalloc.is_tracing(),
+            "gauges": self.get_gauges()
+        }
+
+    def _take_snapshot(self):
+        """Takes a tracemalloc snapshot, excluding tracemalloc's own allocations."""
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def get_snapshot_diff(self, limit=20):
+        """Takes a tracemalloc snapshot and returns the largest changes since the previous one (starting tracing on the first call)."""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self._TRACE_FRAMES)
+                self._last_snapshot = self._take_snapshot()
+                return {"started": True, "diff": []}
+            snapshot = self._take_snapshot()
+            previous = self._last_snapshot
+            self._last_snapshot = snapshot
+        stats = snapshot.compare_to(previous, "traceback")
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "started": False,
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "diff": [{
+                "size_diff_bytes": x.size_diff,
+                "size_bytes": x.size,
+                "count_diff": x.count_diff,
+                "traceback": x.traceback.format()
+            } for x in stats[:limit]]
+        }
+
+    def stop_tracing(self):
+        """Stops tracemalloc and discards the previous snapshot."""
+        with self._lock:
+            tracemalloc.stop()
+            self._last_snapshot = None
+
+    def _run(self):
+        """Samples the RSS forever."""
+        while True:
+            rss = get_rss_bytes()
+            if rss != None:
+                with self._lock:
+                    self._rss_history.append([round(time.time()), rss])
+            time.sleep(self._SAMPLE_PERIOD_SECS)
+
+    def start(self):
+        """Starts sampling the RSS in a separate thread."""
+        threading.Thread(target=self._run, daemon=True).start()
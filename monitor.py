@@ -1,37 +1,115 @@
 import datetime
-import subprocess
 import threading
 
-from arp import get_mac_address
+from change_bus import RECORD_CHANGE_TYPES
+from records import get_open_visits
+from scan_process import ScanProcess
+from scanner import create_last_known_ips, create_last_seen_ips, get_ip_range, probe_missing_devices, scan
 from util import *
 
 
+def _get_ip_range(config):
+    """Returns the list of IP addresses to scan (used as a memoized snapshot view)."""
+    return get_ip_range(config["general"])
+
+
+def _get_device_map(data):
+    """Returns a dict of MAC address to the list of registered devices with that address (used as a memoized snapshot view)."""
+    device_map = {}
+    for device in data["devices"]:
+        device_map.setdefault(device["mac"], []).append(device)
+    return device_map
+
+
+def _get_registered_macs(data):
+    """Returns the frozenset of registered MAC addresses (used as a memoized snapshot view)."""
+    return frozenset(x["mac"] for x in data["devices"])
+
+
 class Monitor:
     """Manages automatic sign-ins and sign-outs by scanning the local network for registered devices."""
 
+    _REQUIRED_CONFIG_KEYS = ["ip_range_start", "ip_range_end", "ping_timeout_secs", "ping_backoff_length_secs", "auto_grace_period_mins",
+                             "auto_timeout_mins", "auto_extension_mins", "manual_timeout_hours", "manual_extension_hours"]
+
     _connection_status = ConnectionStatus.DISCONNECTED
-    _last_seen_ips = {}
-    _last_seen_people = {}
 
-    def __init__(self, get_config, get_data, status_callback, sign_in_callback, sign_out_callback, update_last_seen_callback):
+    def __init__(self, config_store, data_store, data_bus, status_callback, sign_in_callback, sign_out_callback, update_last_seen_callback, get_remote_macs=None, use_scan_process=False, recorder=None):
         """
         Creates a new Monitor.
 
         Parameters:
-            get_config: A function that returns the current config cache.
-            get_data: A function that returns the current data cache.
+            config_store: The SnapshotStore for the config cache.
+            data_store: The SnapshotStore for the data cache.
+            data_bus: The ChangeBus for the data cache, used to track visits incrementally.
             status_callback: A function that takes a single ConnectionStatus argument.
             sign_in_callback: A function that accepts a person ID and timestamp.
             sign_out_callback: A function that accepts a person ID and timestamp.
             update_last_seen_callback: A funcation that accepts a person ID and MAC address.
+            get_remote_macs: An optional function that returns the set of MAC addresses recently detected by scanner nodes.
+            use_scan_process: Whether to run the probe and resolve stages in a separate process.
+            recorder: An optional TraceRecorder that captures scan results and cache snapshots for replay.
         """
 
-        self._get_config = get_config
-        self._get_data = get_data
+        self._config_store = config_store
+        self._data_store = data_store
         self._status_callback = status_callback
         self._sign_in_callback = sign_in_callback
         self._sign_out_callback = sign_out_callback
         self._update_last_seen_callback = update_last_seen_callback
+        self._get_remote_macs = get_remote_macs
+        self._scan_process = ScanProcess() if use_scan_process else None
+        self._recorder = recorder
+        self._last_seen_ips = create_last_seen_ips()
+        self._last_known_ips = create_last_known_ips()  # Key = MAC address, value = last IPv4 address
+        self._last_seen_people = {}
+
+        # Visit state from Google, updated only for the people in each change
+        self._visits_lock = threading.Lock()
+        self._auto_people = set()  # People with an open automatic visit
+        self._last_manual_sign_outs = {}  # Key = person, value = end time of the latest manual sign-out
+        data_bus.subscribe(self._records_changed, RECORD_CHANGE_TYPES,
+                           init=lambda snapshot: self._index_records(snapshot.value["records"]))
+
+    def _index_records(self, records, people=None):
+        """Rebuilds the visit state for a set of people (or everyone if None) from a RecordTable."""
+        if people == None:
+            auto_people = set()
+            last_manual_sign_outs = {}
+            for record in records:  # Newest first, so the first manual sign-out is the latest
+                if record["end_time"] == None:
+                    if not record["start_manual"]:
+                        auto_people.add(record["person"])
+                elif record["end_manual"] and record["person"] not in last_manual_sign_outs:
+                    last_manual_sign_outs[record["person"]] = record["end_time"]
+            with self._visits_lock:
+                self._auto_people = auto_people
+                self._last_manual_sign_outs = last_manual_sign_outs
+            return
+
+        for person in people:
+            person_records = records.for_person(person)
+            is_auto = any(x["end_time"] == None and not x["start_manual"]
+                          for x in person_records)
+            last_manual_sign_out = next((x["end_time"] for x in person_records
+                                         if x["end_time"] != None and x["end_manual"]), None)
+            with self._visits_lock:
+                if is_auto:
+                    self._auto_people.add(person)
+                else:
+                    self._auto_people.discard(person)
+                if last_manual_sign_out != None:
+                    self._last_manual_sign_outs[person] = last_manual_sign_out
+                else:
+                    self._last_manual_sign_outs.pop(person, None)
+
+    def _records_changed(self, events, snapshot):
+        """Change subscriber for records, updating the visit state of the affected people."""
+        if any(x.key == None for x in events):
+            self._index_records(snapshot.value["records"])
+        else:
+            self._index_records(snapshot.value["records"], set(
+                x.key[0] for x in events))
 
     def _set_connection_status(self, status):
         """Sets the current connection status and updates it externally if necessary."""
@@ -39,130 +117,144 @@ class Monitor:
             self._connection_status = status
             self._status_callback(self._connection_status)
 
-    def _run(self):
-        """Main thread for scanning the network and triggering sign-ins and sign-outs."""
-        while True:
-            current_time = round(time.time())
-            config = self._get_config()
-            data = self._get_data()
-
-            try:
-                # Get list of all IP addresses
-                all_ips = []
-                ip_range_start = config["general"]["ip_range_start"]
-                ip_range_end = config["general"]["ip_range_end"]
-                for i in range(int(ip_range_start.split(".")[-1]), int(ip_range_end.split(".")[-1]) + 1):
-                    all_ips.append(
-                        ".".join(ip_range_start.split(".")[:-1] + [str(i)]))
-
-                # Determine IP addresses to remove
-                skipped_ips = []
-                for ip_address in all_ips:
-                    if ip_address in self._last_seen_ips.keys():
-                        if current_time - self._last_seen_ips[ip_address] < config["general"]["ping_backoff_length_secs"]:
-                            skipped_ips.append(ip_address)
-
-                # Run flood ping
-                log("Running flood ping with " + str(len(skipped_ips)) +
-                    " skipped IP address" + ("" if len(skipped_ips) == 1 else "es"))
-                ping_list = [x for x in all_ips if x not in skipped_ips]
-                fping = subprocess.Popen(
-                    ["fping", "-C", "1", "-r", "0", "-t", str(config["general"]["ping_timeout_secs"] * 1000), "-q"] + ping_list, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-                fping_lines = []
-                for line in fping.stderr.readlines():
-                    fping_lines.append(line.decode("utf-8")[:-1])
-                fping.wait()
-
-                # Find successful detections
-                detected_macs = set()
-                detected_people = set()
-                for line in fping_lines:
-                    line_split = line.split(" : ")
-                    if len(line_split) != 2:
-                        continue
-                    ip_address = line_split[0].rstrip()
-                    success = line_split[1] != "-"
-
-                    if success:
-                        mac_address = get_mac_address(ip_address)
-                        if mac_address != None:
-                            self._last_seen_ips[ip_address] = current_time
-                            detected_macs.add(mac_address)
-
-                            for device in data["devices"]:
-                                if device["mac"] == mac_address:
-                                    detected_people.add(device["person"])
-
-                            log("Found device \"" + mac_address +
-                                "\" at \"" + ip_address + "\"")
-
-                # Set status based on device count
-                if len(detected_macs) == 0 and len(skipped_ips) == 0:
-                    log("No devices found with flood ping. Is there a network problem?")
-                    self._set_connection_status(ConnectionStatus.WARNING)
-                else:
-                    self._set_connection_status(ConnectionStatus.CONNECTED)
-
-                # Update last seen time for Google
-                for device in data["devices"]:
-                    if device["mac"] in detected_macs:
-                        if device["last_seen"] == None or datetime.datetime.fromtimestamp(device["last_seen"]).date() != datetime.datetime.today().date():
-                            self._update_last_seen_callback(
-                                device["person"], device["mac"])
-
-                # Update local list based on active visits from Google
-                active_people_google = [
-                    x["person"] for x in data["records"] if x["end_time"] == None and not x["start_manual"]]
-                for person in active_people_google:  # Add new people
-                    if person not in self._last_seen_people.keys():
-                        self._last_seen_people[person] = current_time
-                last_seen_people_keys = list(
-                    self._last_seen_people.keys()).copy()
-                for person in last_seen_people_keys:  # Remove old people
-                    if person not in active_people_google:
-                        del self._last_seen_people[person]
-
-                # Sign in / update last seen times based on detected people
-                for person in detected_people:
-                    if person in self._last_seen_people.keys():  # Already signed in, update time
+    def _read_scan_process(self, config, registered_macs):
+        """Reads the devices detected by the latest cycle of the scan process (which is usually slower than the monitor cycle, so the same result may be read several times). Returns a tuple with the set of MAC addresses and the number of skipped IP addresses."""
+        self._scan_process.update_config(config["general"], registered_macs)
+        if not self._scan_process.is_alive():
+            log("Starting scan process")
+            self._scan_process.start()
+
+        detected, skipped_count, cycle_time = self._scan_process.table.get_last_cycle()
+        if cycle_time == 0:  # No results yet, not a network problem
+            return set(), 1
+        return set(detected.keys()), skipped_count
+
+    def _scan(self, config_snapshot, data_snapshot, current_time):
+        """Runs the probe, resolve, and liveness stages (or reads them from the scan process) and merges devices from scanner nodes. Returns a tuple with the set of detected MAC addresses and the number of skipped IP addresses."""
+        config = config_snapshot.value
+        if self._scan_process == None:
+            detected, skipped_count = scan(
+                config["general"], self._last_seen_ips, current_time, self._recorder, config_snapshot.view(_get_ip_range))
+            detected.update(probe_missing_devices(config["general"], data_snapshot.view(_get_registered_macs),
+                                                  detected, self._last_seen_ips, self._last_known_ips, current_time))
+            detected_macs = set(detected.values())
+        else:
+            detected_macs, skipped_count = self._read_scan_process(
+                config, data_snapshot.view(_get_registered_macs))
+
+        # Merge devices detected by scanner nodes
+        if self._get_remote_macs != None:
+            detected_macs.update(self._get_remote_macs())
+        return detected_macs, skipped_count
+
+    def _cycle(self, current_time):
+        """Runs a single monitor cycle at the specified time, triggering sign-ins and sign-outs."""
+        config_snapshot = self._config_store.get_snapshot()
+        data_snapshot = self._data_store.get_snapshot()
+        config = config_snapshot.value
+        data = data_snapshot.value
+        if self._recorder != None:
+            self._recorder.record_caches(current_time, config, data)
+
+        try:
+            # Probe and resolve the network
+            detected_macs, skipped_count = self._scan(
+                config_snapshot, data_snapshot, current_time)
+            if self._recorder != None:
+                self._recorder.record_cycle(
+                    current_time, detected_macs, skipped_count)
+
+            # Find people with detected devices
+            device_map = data_snapshot.view(_get_device_map)
+            detected_devices = [
+                y for x in detected_macs if x in device_map for y in device_map[x]]
+            detected_people = set(x["person"] for x in detected_devices)
+
+            # Set status based on device count
+            if len(detected_macs) == 0 and skipped_count == 0:
+                log("No devices found with flood ping. Is there a network problem?")
+                self._set_connection_status(ConnectionStatus.WARNING)
+            else:
+                self._set_connection_status(ConnectionStatus.CONNECTED)
+
+            # Update last seen time for Google
+            for device in detected_devices:
+                if device["last_seen"] == None or datetime.datetime.fromtimestamp(device["last_seen"]).date() != datetime.datetime.fromtimestamp(current_time).date():
+                    self._update_last_seen_callback(
+                        device["person"], device["mac"])
+
+            # Update local list based on active visits from Google
+            with self._visits_lock:
+                active_people_google = set(self._auto_people)
+            for person in active_people_google:  # Add new people
+                if person not in self._last_seen_people.keys():
+                    self._last_seen_people[person] = current_time
+            last_seen_people_keys = list(
+                self._last_seen_people.keys()).copy()
+            for person in last_seen_people_keys:  # Remove old people
+                if person not in active_people_google:
+                    del self._last_seen_people[person]
+
+            # Sign in / update last seen times based on detected people
+            for person in detected_people:
+                if person in self._last_seen_people.keys():  # Already signed in, update time
+                    self._last_seen_people[person] = current_time
+
+                else:  # Not signed in, check for manual grace
+                    with self._visits_lock:
+                        last_manual_sign_out = self._last_manual_sign_outs.get(
+                            person)
+
+                    if last_manual_sign_out == None or current_time - last_manual_sign_out > (config["general"]["auto_grace_period_mins"] * 60):
+                        # Not in manual grace, sign in
+                        self._sign_in_callback(person, current_time)
                         self._last_seen_people[person] = current_time
 
-                    else:  # Not signed in, check for manual grace
-                        last_manual_sign_out = None
-                        for record in data["records"]:
-                            if record["person"] == person and record["end_time"] != None and record["end_manual"]:
-                                last_manual_sign_out = record["end_time"]
-                                break
-
-                        if last_manual_sign_out == None or current_time - last_manual_sign_out > (config["general"]["auto_grace_period_mins"] * 60):
-                            # Not in manual grace, sign in
-                            self._sign_in_callback(person, current_time)
-                            self._last_seen_people[person] = current_time
-
-                # Sign out anyone who hasn't been seen recently
-                for person, last_seen in self._last_seen_people.items():
-                    if current_time - last_seen > (config["general"]["auto_timeout_mins"] * 60):
-                        # Don't remove from local cache, so the request is repeated if it fails
-                        self._sign_out_callback(
-                            person, last_seen + (config["general"]["auto_extension_mins"] * 60))
-
-                # Trigger manual timeouts
-                manual_timeouts = [x for x in data["records"] if x["start_manual"] and x["end_time"] ==
-                                   None and current_time - x["start_time"] > config["general"]["manual_timeout_hours"] * 3600]
-                for record in manual_timeouts:
+            # Sign out anyone who hasn't been seen recently
+            for person, last_seen in self._last_seen_people.items():
+                if current_time - last_seen > (config["general"]["auto_timeout_mins"] * 60):
+                    # Don't remove from local cache, so the request is repeated if it fails
                     self._sign_out_callback(
-                        record["person"], record["start_time"] + (config["general"]["manual_extension_hours"] * 3600))
+                        person, last_seen + (config["general"]["auto_extension_mins"] * 60))
+
+            # Trigger manual timeouts
+            open_visits = data_snapshot.view(get_open_visits)
+            manual_timeouts = [x for x in open_visits if x["start_manual"] and current_time -
+                               x["start_time"] > config["general"]["manual_timeout_hours"] * 3600]
+            for record in manual_timeouts:
+                self._sign_out_callback(
+                    record["person"], record["start_time"] + (config["general"]["manual_extension_hours"] * 3600))
 
-            except:
-                log("Unknown error during monitor cycle")
-                self._set_connection_status(ConnectionStatus.DISCONNECTED)
+        except:
+            log("Unknown error during monitor cycle")
+            self._set_connection_status(ConnectionStatus.DISCONNECTED)
+
+    def _is_config_ready(self):
+        """Returns whether the config cache includes every value used by a cycle (it is empty on the first startup until Google responds)."""
+        general_config = self._config_store.get()["general"]
+        return all(general_config.get(x) != None for x in self._REQUIRED_CONFIG_KEYS)
+
+    def _run(self):
+        """Main thread for scanning the network and triggering sign-ins and sign-outs."""
+        if not self._is_config_ready():
+            log("Waiting for config before starting monitor")
+            while not self._is_config_ready():
+                time.sleep(1)
+        while True:
+            if self._is_config_ready():
+                self._cycle(round(time.time()))
 
             # Wait for next cycle
             delay = 1
-            if "ping_cycle_delay_secs" in self._get_config()["general"]:
-                delay = self._get_config()["general"]["ping_cycle_delay_secs"]
+            if "ping_cycle_delay_secs" in self._config_store.get()["general"]:
+                delay = self._config_store.get()["general"]["ping_cycle_delay_secs"]
             time.sleep(delay)
 
+    def get_cache_state(self):
+        """Returns a JSON-compatible dict with the size of each internal cache."""
+        return {"last_seen_ips": self._last_seen_ips.get_state(), "last_known_ips": self._last_known_ips.get_state(),
+                "last_seen_people": len(self._last_seen_people)}
+
     def start(self):
         """Starts the monitor thread."""
         threading.Thread(target=self._run, daemon=True).start()
@@ -0,0 +1,87 @@
+import threading
+
+from util import *
+
+
+class PendingOperations:
+    """Registry of Google mutations keyed by person, action, and target time (None for actions like sign-ins whose time changes on every attempt), used to suppress duplicate submissions.
+
+    An operation is skipped while an identical one is in flight, for a hold
+    period after it succeeds (until the next data refresh has landed), and
+    until its backoff expires after a failure.
+    """
+
+    _HOLD_SECS = 60  # Longer than the data refresh period
+    _RETRY_BASE_SECS = 5
+    _RETRY_MAX_SECS = 300
+    _EXPIRE_SECS = 3600  # Finished entries are removed after this time
+    _MAX_ENTRIES = 1000  # The oldest finished entries are removed beyond this
+
+    def __init__(self):
+        """Creates a new PendingOperations registry."""
+        self._lock = threading.Lock()
+        self._entries = {}  # Key = (person, action, target time)
+
+    def _prune(self, current_time):
+        """Removes entries that are no longer pending once they expire, or oldest first beyond the size limit."""
+        for key in [x for x, y in self._entries.items() if y["state"] != "pending" and current_time - y["updated"] > self._EXPIRE_SECS]:
+            del self._entries[key]
+        if len(self._entries) > self._MAX_ENTRIES:
+            finished = sorted([x for x, y in self._entries.items() if y["state"] != "pending"],
+                              key=lambda x: self._entries[x]["updated"])
+            for key in finished[:len(self._entries) - self._MAX_ENTRIES]:
+                del self._entries[key]
+
+    def submit(self, person, action, target_time, operation):
+        """Runs the operation (a function returning a boolean for success) unless a duplicate is pending, held, or backing off. Returns whether the operation ran and succeeded."""
+        key = (person, action, target_time)
+        current_time = time.time()
+        with self._lock:
+            self._prune(current_time)
+            entry = self._entries.get(key)
+            if entry != None:
+                if entry["state"] == "pending":
+                    return False
+                if entry["state"] == "succeeded" and current_time < entry["updated"] + self._HOLD_SECS:
+                    return False
+                if entry["state"] == "failed" and current_time < entry["retry_time"]:
+                    return False
+            else:
+                entry = {"attempts": 0, "failures": 0}
+                self._entries[key] = entry
+            entry["state"] = "pending"
+            entry["attempts"] += 1
+            entry["updated"] = current_time
+
+        try:
+            success = operation()
+        except:
+            success = False
+
+        with self._lock:
+            entry["updated"] = time.time()
+            if success:
+                entry["state"] = "succeeded"
+                entry["failures"] = 0
+            else:
+                entry["state"] = "failed"
+                entry["failures"] += 1
+                entry["retry_time"] = entry["updated"] + min(
+                    self._RETRY_BASE_SECS * 2 ** (entry["failures"] - 1), self._RETRY_MAX_SECS)
+                log("Operation \"" + action + "\" for person " + str(person) +
+                    " failed, retrying in " + str(round(entry["retry_time"] - entry["updated"])) + "s")
+        return success
+
+    def get_state(self):
+        """Returns a JSON-compatible list describing each tracked operation."""
+        with self._lock:
+            return [{
+                "person": key[0],
+                "action": key[1],
+                "target_time": key[2],
+                "state": entry["state"],
+                "attempts": entry["attempts"],
+                "failures": entry["failures"],
+                "updated": round(entry["updated"]),
+                "retry_time": round(entry["retry_time"]) if entry["state"] == "failed" else None
+            } for key, entry in self._entries.items()]
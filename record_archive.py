@@ -0,0 +1,132 @@
+import json
+import threading
+
+from util import *
+
+# The data cache only holds the most recent records from Google, so closed
+# visits are also appended to a local JSON lines file as they are seen. Exports
+# stream the full history from this archive. Lines are never rewritten: if a
+# closed record is edited in the sheet, the new version is appended and the
+# last line for each person and start time wins. Only the byte offset of that
+# line is kept in memory, never the records themselves.
+
+
+def _parse_line(line):
+    """Returns the record for a line of the archive, or None if the line is incomplete."""
+    try:
+        person, start_time, end_time, start_manual, end_manual = json.loads(
+            line)
+    except ValueError:  # Partial line from an interrupted write
+        return None
+    return {"person": person, "start_time": start_time, "end_time": end_time,
+            "start_manual": start_manual, "end_manual": end_manual}
+
+
+def _format_line(record):
+    """Returns the archive line for a record."""
+    return (json.dumps([record["person"], record["start_time"], record["end_time"],
+                        record["start_manual"], record["end_manual"]]) + "\n").encode("utf-8")
+
+
+class RecordArchive:
+    """Append-only local archive of closed records."""
+
+    def __init__(self, path):
+        """
+        Creates a new RecordArchive, indexing any existing records in the file.
+
+        Parameters:
+            path: The path of the JSON lines file.
+        """
+
+        self._PATH = path
+        self._lock = threading.Lock()
+        self._offsets = {}  # Key = (person, start time), value = offset of the latest line
+        self._size = 0
+        self._needs_newline = False  # Whether the file ends with a partial line
+
+        try:
+            with open(path, "rb") as file:
+                for line in file:
+                    record = _parse_line(line)
+                    if record != None:
+                        self._offsets[(record["person"],
+                                       record["start_time"])] = self._size
+                    self._size += len(line)
+                    self._needs_newline = not line.endswith(b"\n")
+        except FileNotFoundError:
+            pass
+
+    def _read_record(self, file, offset):
+        """Reads the record at an offset using an open file."""
+        file.seek(offset)
+        return _parse_line(file.readline())
+
+    def add(self, records):
+        """Appends the closed records that are new or changed. Open records are ignored."""
+        with self._lock:
+            new_records = [x for x in records if x["end_time"] != None]
+            if len(new_records) == 0:
+                return
+            try:
+                with open(self._PATH, "a+b") as file:
+                    # Skip records that match their archived line (e.g. the cached records at startup)
+                    lines = []
+                    offsets = {}
+                    for record in new_records:
+                        key = (record["person"], record["start_time"])
+                        offset = self._offsets.get(key)
+                        if offset != None and self._read_record(file, offset) == record:
+                            continue
+                        if self._needs_newline and len(lines) == 0:
+                            lines.append(b"\n")
+                        offsets[key] = self._size + sum(len(x) for x in lines)
+                        lines.append(_format_line(record))
+                    if len(lines) == 0:
+                        return
+                    file.write(b"".join(lines))
+            except:
+                log("Failed to write to record archive")
+                return
+            self._offsets.update(offsets)
+            self._size += sum(len(x) for x in lines)
+            self._needs_newline = False
+
+    def iter_records(self, person=None, start_time=None, end_time=None, recent_records=None):
+        """
+        Yields the archived records oldest first, filtered by person and by start time. Records are read from the file one at a time.
+
+        Parameters:
+            person: Only include records for this person ID.
+            start_time: Only include records that started at or after this time.
+            end_time: Only include records that started before this time.
+            recent_records: An optional RecordTable with recent records (e.g. open visits), included if they aren't archived.
+        """
+
+        def matches(key):
+            return (person == None or key[0] == person) and (start_time == None or key[1] >= start_time) and (end_time == None or key[1] < end_time)
+
+        with self._lock:
+            keys = [x for x in self._offsets.keys() if matches(x)]
+            keys.sort(key=lambda x: x[1])
+            offsets = [self._offsets[x] for x in keys]
+            extra = [] if recent_records == None else [x for x in recent_records
+                                                       if (x["person"], x["start_time"]) not in self._offsets and matches((x["person"], x["start_time"]))]
+        extra.sort(key=lambda x: x["start_time"])
+
+        # Lines are never changed once written, so the file can be read while records are appended
+        index = 0
+        if len(offsets) > 0:
+            with open(self._PATH, "rb") as file:
+                for offset in offsets:
+                    record = self._read_record(file, offset)
+                    while index < len(extra) and extra[index]["start_time"] < record["start_time"]:
+                        yield extra[index]
+                        index += 1
+                    yield record
+        for record in extra[index:]:
+            yield record
+
+    def __len__(self):
+        with self._lock:
+            return len(self._offsets)
@@ -0,0 +1,148 @@
+import array
+import itertools
+
+OPEN_END_TIME = -1  # Sentinel stored in place of the end time for open visits
+
+
+class RecordTable:
+    """Compact columnar storage for visit records, backed by typed arrays.
+
+    Each record uses an int32 person ID, int64 start and end times, and two
+    bit-packed manual flags (about 20 bytes instead of a five-key dict).
+    Indexing and iteration produce dicts with the keys "person", "start_time",
+    "end_time", "start_manual", and "end_manual", matching the format used by
+    the rest of the data cache. Open visits have an end time of None.
+    """
+
+    def __init__(self, records=None):
+        """
+        Creates a new RecordTable.
+
+        Parameters:
+            records: An optional iterable of record dicts to copy into the table.
+        """
+
+        self._person = array.array("i")
+        self._start_time = array.array("q")
+        self._end_time = array.array("q")
+        self._start_manual = bytearray()
+        self._end_manual = bytearray()
+        self._length = 0
+        self._frozen = False
+
+        if records != None:
+            for record in records:
+                self.append(record["person"], record["start_time"], record["end_time"],
+                            record["start_manual"], record["end_manual"])
+
+    @staticmethod
+    def _get_bit(bits, index):
+        """Reads a single flag from a bit-packed bytearray."""
+        return (bits[index >> 3] >> (index & 7)) & 1 == 1
+
+    def append(self, person, start_time, end_time, start_manual, end_manual):
+        """Adds a record to the end of the table. The end time may be None for an open visit."""
+        if self._frozen:
+            raise TypeError("record table is read-only")
+        index = self._length
+        self._person.append(person)
+        self._start_time.append(start_time)
+        self._end_time.append(OPEN_END_TIME if end_time ==
+                              None else end_time)
+        if index & 7 == 0:
+            self._start_manual.append(0)
+            self._end_manual.append(0)
+        if start_manual:
+            self._start_manual[index >> 3] |= 1 << (index & 7)
+        if end_manual:
+            self._end_manual[index >> 3] |= 1 << (index & 7)
+        self._length += 1
+
+    def _get_record(self, index):
+        """Builds the dict representation of the record at a (non-negative) index."""
+        end_time = self._end_time[index]
+        return {
+            "person": self._person[index],
+            "start_time": self._start_time[index],
+            "end_time": None if end_time == OPEN_END_TIME else end_time,
+            "start_manual": self._get_bit(self._start_manual, index),
+            "end_manual": self._get_bit(self._end_manual, index)
+        }
+
+    def freeze(self):
+        """Prevents any further changes to the table."""
+        self._frozen = True
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.select(range(*index.indices(self._length)))
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("record index out of range")
+        return self._get_record(index)
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self._get_record(index)
+
+    def __eq__(self, other):
+        if isinstance(other, RecordTable):
+            return self._length == other._length and self._person == other._person and \
+                self._start_time == other._start_time and self._end_time == other._end_time and \
+                self._start_manual == other._start_manual and self._end_manual == other._end_manual
+        if isinstance(other, list):
+            return self.to_list() == other
+        return NotImplemented
+
+    __hash__ = None  # Mutable until frozen, so not hashable
+
+    def __repr__(self):
+        return "RecordTable(" + str(self._length) + " records)"
+
+    def open_indices(self):
+        """Returns the indices of all open visits (no end time)."""
+        return list(itertools.compress(range(self._length), map(OPEN_END_TIME.__eq__, self._end_time)))
+
+    def person_indices(self, person):
+        """Returns the indices of all records for the specified person."""
+        return [index for index, value in enumerate(self._person) if value == person]
+
+    def open_visits(self):
+        """Returns a list of record dicts for all open visits."""
+        return [self._get_record(x) for x in self.open_indices()]
+
+    def for_person(self, person):
+        """Returns a list of record dicts for the specified person, in table order."""
+        return [self._get_record(x) for x in self.person_indices(person)]
+
+    def open_people(self):
+        """Returns the set of person IDs with at least one open visit."""
+        return set(itertools.compress(self._person, map(OPEN_END_TIME.__eq__, self._end_time)))
+
+    def select(self, indices):
+        """Returns a new RecordTable with the records at the specified indices."""
+        table = RecordTable()
+        for index in indices:
+            table.append(self._person[index], self._start_time[index], self._end_time[index] if self._end_time[index] != OPEN_END_TIME else None,
+                         self._get_bit(self._start_manual, index), self._get_bit(self._end_manual, index))
+        return table
+
+    def to_list(self):
+        """Returns the records as a list of dicts (e.g. for JSON serialization)."""
+        return list(self)
+
+    def get_size_bytes(self):
+        """Returns the approximate number of bytes used by the record storage."""
+        return self._person.buffer_info()[1] * self._person.itemsize + \
+            self._start_time.buffer_info()[1] * self._start_time.itemsize + \
+            self._end_time.buffer_info()[1] * self._end_time.itemsize + \
+            len(self._start_manual) + len(self._end_manual)
+
+
+def get_open_visits(data):
+    """Returns the list of open visits in a data cache (used as a memoized snapshot view)."""
+    return data["records"].open_visits()
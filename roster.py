@@ -0,0 +1,160 @@
+import bisect
+import collections
+import unicodedata
+
+
+def normalize_name(name):
+    """Returns a lowercase version of a name without accents, for matching."""
+    decomposed = unicodedata.normalize("NFKD", name)
+    return "".join(x for x in decomposed if not unicodedata.combining(x)).casefold().strip()
+
+
+def _edit_distance(a, b, limit):
+    """Returns the Levenshtein distance between two strings, or limit + 1 if it exceeds the limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class RosterIndex:
+    """Search index over the people in the config cache, supporting prefix and fuzzy name matching."""
+
+    _DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200  # Larger search pages are rejected by the web server
+
+    def __init__(self, people):
+        """
+        Creates a new RosterIndex.
+
+        Parameters:
+            people: The list of people from the config cache.
+        """
+
+        self._people = {}  # Key = person ID
+        tokens = set()
+        for person in people:
+            name = person["first_name"] + " " + person["last_name"]
+            normalized = normalize_name(name)
+            self._people[person["id"]] = {
+                "id": person["id"],
+                "name": name,
+                "is_active": person["is_active"],
+                "sort_key": normalized
+            }
+            for token in normalized.split() + [normalized]:
+                tokens.add((token, person["id"]))
+        self._tokens = sorted(tokens)  # Sorted (token, ID) pairs for prefix search
+        self._unique_tokens = sorted(set(x[0] for x in self._tokens))
+        self._token_counts = {x: collections.Counter(
+            x) for x in self._unique_tokens}
+        self._sorted_ids = sorted(
+            self._people.keys(), key=lambda x: self._people[x]["sort_key"])
+
+    def get_name(self, person):
+        """Returns the full name of the person with the specified ID, or None if not found."""
+        if person in self._people:
+            return self._people[person]["name"]
+        return None
+
+    def _prefix_ids(self, prefix):
+        """Returns the set of IDs with any name token starting with the prefix."""
+        result = set()
+        index = bisect.bisect_left(self._tokens, (prefix,))
+        while index < len(self._tokens) and self._tokens[index][0].startswith(prefix):
+            result.add(self._tokens[index][1])
+            index += 1
+        return result
+
+    def _fuzzy_ids(self, term):
+        """Returns a dict of ID to the smallest edit distance between the term and any name token (within a limit based on its length)."""
+        if len(term) < 3:  # Too short to match fuzzily
+            return {x: 0 for x in self._prefix_ids(term)}
+        limit = 1 if len(term) < 6 else 2
+        distances = {}
+        term_counts = collections.Counter(term)
+        for token in self._unique_tokens:
+            # Each character missing from the token needs at least one edit
+            if sum((term_counts - self._token_counts[token]).values()) > limit:
+                continue
+            # Compare against the start of longer tokens so partial names still match
+            distance = _edit_distance(term, token[:len(term) + limit], limit)
+            distance = min(distance, _edit_distance(term, token, limit))
+            if distance <= limit:
+                for person in self._prefix_ids(token):
+                    if person not in distances or distance < distances[person]:
+                        distances[person] = distance
+        return distances
+
+    def get_active_people(self):
+        """Returns a list of dicts with the ID and name of every active person, sorted by name."""
+        return [{"id": x, "name": self._people[x]["name"]} for x in self._sorted_ids if self._people[x]["is_active"]]
+
+    def search(self, query, page=0, page_size=None, active_only=False):
+        """Returns a page of people matching the query (all people if it is empty), with prefix matches ranked before fuzzy matches."""
+        page_size = self._DEFAULT_PAGE_SIZE if page_size == None else max(
+            1, min(int(page_size), self.MAX_PAGE_SIZE))
+        page = max(0, int(page))
+        terms = normalize_name(query).split()
+
+        if len(terms) == 0:
+            ranked = list(self._sorted_ids)
+        else:
+            # Prefix matches must match every term
+            prefix_matches = None
+            for term in terms:
+                ids = self._prefix_ids(term)
+                prefix_matches = ids if prefix_matches == None else prefix_matches & ids
+            ranked = sorted(prefix_matches, key=lambda x: (
+                not self._people[x]["sort_key"].startswith(" ".join(terms)), self._people[x]["sort_key"]))
+
+            # Fuzzy matches must be close to every term (only needed if the page isn't full)
+            fuzzy_matches = None if len(ranked) < (page + 1) * page_size else {}
+            for term in terms if fuzzy_matches == None else []:
+                distances = self._fuzzy_ids(term)
+                if fuzzy_matches == None:
+                    fuzzy_matches = distances
+                else:
+                    fuzzy_matches = {x: fuzzy_matches[x] + y for x, y in distances.items()
+                                     if x in fuzzy_matches}
+            ranked += sorted([x for x in fuzzy_matches.keys() if x not in prefix_matches],
+                             key=lambda x: (fuzzy_matches[x], self._people[x]["sort_key"]))
+
+        if active_only:
+            ranked = [x for x in ranked if self._people[x]["is_active"]]
+        results = ranked[page * page_size:(page + 1) * page_size]
+        return {
+            "query": query,
+            "page": page,
+            "page_size": page_size,
+            "total": len(ranked),
+            "results": [{
+                "id": self._people[x]["id"],
+                "name": self._people[x]["name"],
+                "is_active": self._people[x]["is_active"]
+            } for x in results]
+        }
+
+    def join_here_now(self, open_visits):
+        """Returns the here-now list for the open visits, joined with names and sorted with manual sign-ins first, then by name."""
+        here_now = []
+        for visit in open_visits:
+            person = self._people.get(visit["person"])
+            here_now.append({
+                "person": visit["person"],
+                "name": person["name"] if person != None else str(visit["person"]),
+                "manual": visit["start_manual"],
+                "sort_key": person["sort_key"] if person != None else ""
+            })
+        here_now.sort(key=lambda x: (not x["manual"], x["sort_key"]))
+        for entry in here_now:
+            del entry["sort_key"]
+        return here_now
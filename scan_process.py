@@ -0,0 +1,172 @@
+import multiprocessing
+import queue
+import socket
+import struct
+
+from scanner import create_last_known_ips, create_last_seen_ips, probe_missing_devices, scan
+from util import *
+
+
+def _mac_to_int(mac_address):
+    """Packs a MAC address string into a 48-bit integer (never zero for a valid address string)."""
+    return int(mac_address.replace(":", ""), 16) | (1 << 48)
+
+
+def _int_to_mac(value):
+    """Unpacks a MAC address string from the format of _mac_to_int."""
+    digits = "%012x" % (value & ((1 << 48) - 1))
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+class PresenceTable:
+    """Table of last-seen times by MAC and IP address, stored in shared memory.
+
+    Rows are kept in fixed-size arrays (MAC as int64, IPv4 as uint32, last
+    seen as int64) with open addressing by MAC. A single writer process updates
+    the table after each scan and readers copy out the rows they need at
+    decision time, so no per-cycle results are pickled between processes.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        Creates a new PresenceTable.
+
+        Parameters:
+            capacity: The maximum number of MAC addresses to track (the oldest entry is replaced when full).
+        """
+
+        self._CAPACITY = capacity
+        self._macs = multiprocessing.RawArray("q", capacity)
+        self._ips = multiprocessing.RawArray("I", capacity)
+        self._last_seen = multiprocessing.RawArray("q", capacity)
+        self._lock = multiprocessing.Lock()
+        self.skipped_count = multiprocessing.RawValue("q", 0)
+        self.cycle_time = multiprocessing.RawValue("q", 0)
+
+    def _find_slot(self, mac_value):
+        """Returns the slot for the MAC (existing or empty), or None if the table is full."""
+        start = hash(mac_value) % self._CAPACITY
+        for offset in range(self._CAPACITY):
+            slot = (start + offset) % self._CAPACITY
+            if self._macs[slot] == mac_value or self._macs[slot] == 0:
+                return slot
+        return None
+
+    def update(self, detected, current_time, skipped_count=0):
+        """Records the result of a scan cycle: a dict of IP address to MAC address detected at the specified time, and the number of skipped IP addresses."""
+        with self._lock:
+            self.skipped_count.value = skipped_count
+            self.cycle_time.value = current_time
+            for ip_address, mac_address in detected.items():
+                mac_value = _mac_to_int(mac_address)
+                slot = self._find_slot(mac_value)
+                if slot == None:  # Table is full, replace the oldest entry
+                    slot = min(range(self._CAPACITY),
+                               key=lambda x: self._last_seen[x])
+                self._macs[slot] = mac_value
+                try:
+                    self._ips[slot] = struct.unpack(
+                        "!I", socket.inet_aton(ip_address))[0]
+                except (OSError, TypeError):
+                    self._ips[slot] = 0
+                self._last_seen[slot] = current_time
+
+    def get_detected(self, since):
+        """Returns a dict of MAC address to IP address for every entry seen at or after the specified time."""
+        with self._lock:
+            return self._collect(since)
+
+    def _collect(self, since):
+        """Returns the entries seen at or after the specified time (the lock must be held)."""
+        result = {}
+        for slot in range(self._CAPACITY):
+            if self._macs[slot] != 0 and self._last_seen[slot] >= since:
+                result[_int_to_mac(self._macs[slot])] = socket.inet_ntoa(
+                    struct.pack("!I", self._ips[slot])) if self._ips[slot] != 0 else None
+        return result
+
+    def get_last_cycle(self):
+        """Returns a tuple with the dict of MAC address to IP address detected by the latest scan cycle, the number of IP addresses it skipped, and its time (0 if no cycle has finished)."""
+        with self._lock:
+            cycle_time = self.cycle_time.value
+            if cycle_time == 0:
+                return {}, self.skipped_count.value, cycle_time
+            return self._collect(cycle_time), self.skipped_count.value, cycle_time
+
+    def get_last_seen(self, mac_address):
+        """Returns the last seen time for the specified MAC address, or None if it is not in the table."""
+        mac_value = _mac_to_int(mac_address)
+        with self._lock:
+            slot = self._find_slot(mac_value)
+            if slot == None or self._macs[slot] != mac_value:
+                return None
+            return self._last_seen[slot]
+
+
+def _worker_main(table, config_queue):
+    """Entry point of the scan process, which repeatedly runs the probe, resolve, and liveness stages."""
+    general_config = None
+    registered_macs = frozenset()
+    last_seen_ips = create_last_seen_ips()
+    last_known_ips = create_last_known_ips()
+    while True:
+        # Use the newest config and registered devices sent by the monitor
+        try:
+            while True:
+                general_config, registered_macs = config_queue.get(
+                    block=general_config == None)
+        except queue.Empty:
+            pass
+
+        current_time = round(time.time())
+        try:
+            detected, skipped_count = scan(
+                general_config, last_seen_ips, current_time)
+            detected.update(probe_missing_devices(
+                general_config, registered_macs, detected, last_seen_ips, last_known_ips, current_time))
+            table.update(detected, current_time, skipped_count)
+        except:
+            log("Unknown error during scan process cycle")
+
+        delay = 1
+        if "ping_cycle_delay_secs" in general_config:
+            delay = general_config["ping_cycle_delay_secs"]
+        time.sleep(delay)
+
+
+class ScanProcess:
+    """Runs the probe, resolve, and liveness stages in a separate process, publishing results to a PresenceTable."""
+
+    def __init__(self, capacity=1024):
+        """
+        Creates a new ScanProcess.
+
+        Parameters:
+            capacity: The maximum number of MAC addresses to track in the presence table.
+        """
+
+        self.table = PresenceTable(capacity)
+        self._config_queue = multiprocessing.Queue()
+        self._process = None
+        self._general_config = None
+        self._registered_macs = frozenset()
+
+    def update_config(self, general_config, registered_macs=frozenset()):
+        """Sends the general config and the set of registered MAC addresses (for the liveness stage) to the scan process if either has changed."""
+        if general_config != self._general_config or registered_macs != self._registered_macs:
+            self._general_config = general_config
+            self._registered_macs = registered_macs
+            self._config_queue.put((general_config, registered_macs))
+
+    def is_alive(self):
+        """Returns whether the scan process is running."""
+        return self._process != None and self._process.is_alive()
+
+    def start(self):
+        """Starts (or restarts) the scan process."""
+        if self._general_config != None:
+            self._config_queue.put(
+                (self._general_config, self._registered_macs))
+        self._process = multiprocessing.Process(target=_worker_main, args=(
+            self.table, self._config_queue), daemon=True)
+        self._process.start()
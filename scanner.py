@@ -0,0 +1,271 @@
+import asyncio
+import platform
+import socket
+import subprocess
+import time
+
+from arp import get_ipv6_neighbors, get_mac_address, get_reachable_ipv4_neighbors
+from bounded_cache import BoundedCache
+from util import *
+
+_PROBE_CONCURRENCY = 64  # Maximum number of open probe sockets
+_PROBE_DEFAULT_BUDGET_SECS = 2
+_PROBE_RESOLVE_SHARE = 0.25  # Part of the liveness budget kept for reading the neighbor table and resolving MACs
+
+# Limits for the IP addresses last seen by each scanner. Entries only matter
+# within the backoff length, so they can safely expire long before the limit.
+LAST_SEEN_IPS_MAX_SIZE = 4096  # The IPv4 range plus IPv6 neighbors
+LAST_SEEN_IPS_MAX_AGE_SECS = 24 * 3600
+
+
+# Limits for the last known IPv4 address of each MAC, used by the liveness stage
+LAST_KNOWN_IPS_MAX_SIZE = 4096
+LAST_KNOWN_IPS_MAX_AGE_SECS = 24 * 3600  # Devices not seen for a day are no longer probed
+
+
+def create_last_seen_ips():
+    """Returns an empty bounded cache of IP address to last seen time, for use with scan()."""
+    return BoundedCache(LAST_SEEN_IPS_MAX_SIZE, LAST_SEEN_IPS_MAX_AGE_SECS)
+
+
+def create_last_known_ips():
+    """Returns an empty bounded cache of MAC address to last IPv4 address, for use with probe_missing_devices()."""
+    return BoundedCache(LAST_KNOWN_IPS_MAX_SIZE, LAST_KNOWN_IPS_MAX_AGE_SECS)
+
+
+def get_ip_range(general_config):
+    """Returns the list of IPv4 addresses between "ip_range_start" and "ip_range_end" (last octet only)."""
+    all_ips = []
+    ip_range_start = general_config["ip_range_start"]
+    ip_range_end = general_config["ip_range_end"]
+    for i in range(int(ip_range_start.split(".")[-1]), int(ip_range_end.split(".")[-1]) + 1):
+        all_ips.append(
+            ".".join(ip_range_start.split(".")[:-1] + [str(i)]))
+    return all_ips
+
+
+def run_flood_ping(ip_addresses, timeout_secs):
+    """Probe stage: pings all of the IP addresses with fping and returns the list that responded."""
+    if len(ip_addresses) == 0:
+        return []
+    fping = subprocess.Popen(
+        ["fping", "-C", "1", "-r", "0", "-t", str(round(timeout_secs * 1000)), "-q"] + ip_addresses, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    fping_lines = []
+    for line in fping.stderr.readlines():
+        fping_lines.append(line.decode("utf-8")[:-1])
+    fping.wait()
+
+    responding_ips = []
+    for line in fping_lines:
+        line_split = line.split(" : ")
+        if len(line_split) != 2:
+            continue
+        if line_split[1] != "-":
+            responding_ips.append(line_split[0].rstrip())
+    return responding_ips
+
+
+def resolve_mac_addresses(ip_addresses):
+    """Resolve stage: looks up the MAC address for each IP address, returning a dict of IP address to MAC address (unresolved addresses are omitted)."""
+    result = {}
+    for ip_address in ip_addresses:
+        mac_address = get_mac_address(ip_address)
+        if mac_address != None:
+            result[ip_address] = mac_address
+    return result
+
+
+def discover_ipv6_neighbors(interface, timeout_secs):
+    """Pings the all-nodes multicast address (ff02::1) on the interface, then reads the IPv6 neighbor table. Returns a dict of IPv6 address (link-local or global) to MAC address."""
+    target = "ff02::1%" + interface
+    if platform.system() == "Windows":
+        args = ["ping", "-6", "-n", "1", "-w",
+                str(round(timeout_secs * 1000)), target]
+    elif platform.system() == "Darwin":
+        args = ["ping6", "-c", "2", "-i", "1", target]
+    else:
+        args = ["ping", "-6", "-c", "2", "-w",
+                str(max(1, round(timeout_secs))), target]
+    try:
+        subprocess.run(args, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, timeout=timeout_secs + 5)
+    except (subprocess.TimeoutExpired, OSError):
+        pass
+    return get_ipv6_neighbors(interface)
+
+
+def _parse_ports(value):
+    """Returns the list of ports in a comma-separated config value (empty if missing)."""
+    if value == None:
+        return []
+    return [int(x) for x in str(value).replace(" ", "").split(",") if x.isdigit()]
+
+
+class _UdpNudgeProtocol(asyncio.DatagramProtocol):
+    """Records whether a UDP nudge got any reply (including an ICMP port unreachable error)."""
+
+    def __init__(self):
+        self.responded = False
+
+    def datagram_received(self, data, address):
+        self.responded = True
+
+    def error_received(self, exception):
+        if isinstance(exception, ConnectionRefusedError):
+            self.responded = True
+
+
+async def _probe_tcp(ip_address, port, timeout_secs):
+    """Returns whether the host answered a TCP connection attempt (accepted or refused)."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip_address, port), timeout_secs)
+    except ConnectionRefusedError:
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+async def _probe_ip(ip_address, tcp_ports, udp_ports, timeout_secs, semaphore):
+    """Sends UDP nudges and TCP connection attempts to a single host. Returns whether any probe got a reply."""
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        transports = []
+        protocols = []
+        for port in udp_ports:
+            try:
+                transport, protocol = await loop.create_datagram_endpoint(
+                    _UdpNudgeProtocol, remote_addr=(ip_address, port), family=socket.AF_INET)
+            except OSError:
+                continue
+            transport.sendto(b"\x00")
+            transports.append(transport)
+            protocols.append(protocol)
+        try:
+            results = await asyncio.gather(*[_probe_tcp(ip_address, x, timeout_secs) for x in tcp_ports])
+            if len(tcp_ports) == 0:
+                await asyncio.sleep(timeout_secs)  # Wait for UDP replies
+            return any(results) or any(x.responded for x in protocols)
+        finally:
+            for transport in transports:
+                transport.close()
+
+
+async def _probe_all(ip_addresses, tcp_ports, udp_ports, timeout_secs, budget_secs):
+    """Probes every host concurrently, returning the set of IP addresses that replied before the budget expired."""
+    semaphore = asyncio.Semaphore(_PROBE_CONCURRENCY)
+    tasks = {asyncio.ensure_future(_probe_ip(x, tcp_ports, udp_ports, timeout_secs, semaphore)): x
+             for x in ip_addresses}
+    done, pending = await asyncio.wait(tasks.keys(), timeout=budget_secs)
+    for task in pending:
+        task.cancel()
+    if len(pending) > 0:
+        await asyncio.wait(pending)
+    return set(tasks[x] for x in done if not x.cancelled() and x.exception() == None and x.result())
+
+
+def _log_found_devices(detected, method):
+    """Logs one summary line for the devices found by a scan stage. The individual devices are only included in the JSON log file."""
+    log("Found " + str(len(detected)) + " device" + ("" if len(detected) == 1 else "s") + " " + method,
+        details=[{"mac": y, "ip": x} for x, y in detected.items()])
+
+
+def probe_devices(expected_macs, general_config):
+    """Liveness stage for devices that ignore ICMP: sends TCP connection attempts and UDP nudges to the configured ports ("probe_tcp_ports" and "probe_udp_ports"), then reads the neighbor table, all within the time budget ("probe_budget_secs").
+
+    Takes a dict of IP address to the MAC address last seen there. Returns a dict of IP address to MAC address for hosts that replied (or were confirmed reachable by the neighbor table) with the expected MAC address."""
+    tcp_ports = _parse_ports(general_config.get("probe_tcp_ports"))
+    udp_ports = _parse_ports(general_config.get("probe_udp_ports"))
+    if len(expected_macs) == 0 or len(tcp_ports) + len(udp_ports) == 0:
+        return {}
+    budget_secs = general_config.get("probe_budget_secs")
+    budget_secs = _PROBE_DEFAULT_BUDGET_SECS if budget_secs == None or budget_secs == "" else float(
+        budget_secs)
+    deadline = time.monotonic() + budget_secs
+    probe_budget_secs = budget_secs * (1 - _PROBE_RESOLVE_SHARE)
+    timeout_secs = min(general_config["ping_timeout_secs"], probe_budget_secs)
+
+    responding_ips = asyncio.run(_probe_all(
+        list(expected_macs.keys()), tcp_ports, udp_ports, timeout_secs, probe_budget_secs))
+    reachable = get_reachable_ipv4_neighbors(
+        max(0, deadline - time.monotonic()))
+
+    detected = {}
+    for ip_address, expected_mac in expected_macs.items():
+        if ip_address in reachable:
+            mac_address = reachable[ip_address]
+        elif ip_address in responding_ips:
+            remaining_secs = deadline - time.monotonic()
+            if remaining_secs <= 0:
+                continue  # Budget expired, the device can be found next cycle
+            mac_address = get_mac_address(ip_address, remaining_secs)
+        else:
+            continue
+        if mac_address == expected_mac:
+            detected[ip_address] = mac_address
+    if len(detected) > 0:
+        _log_found_devices(detected, "with liveness probe")
+    return detected
+
+
+def probe_missing_devices(general_config, registered_macs, detected, last_seen_ips, last_known_ips, current_time):
+    """Runs the liveness stage for registered devices whose last known IP address was pinged but didn't respond.
+
+    Takes the MAC addresses of registered devices and the dict of IP address to MAC address found by scan(). Returns a dict of IP address to MAC address for the probed devices that replied. The last_seen_ips and last_known_ips caches are updated in place."""
+    for ip_address, mac_address in detected.items():
+        if ":" not in ip_address:
+            last_known_ips[mac_address] = ip_address
+    detected_macs = set(detected.values())
+    expected_macs = {}
+    for mac_address in registered_macs:
+        ip_address = last_known_ips.get(mac_address)
+        if mac_address in detected_macs or ip_address == None or ip_address in detected:
+            continue
+        last_seen = last_seen_ips.get(ip_address)
+        if last_seen != None and current_time - last_seen < general_config["ping_backoff_length_secs"]:
+            continue  # Skipped by the flood ping
+        expected_macs[ip_address] = mac_address
+
+    probed = probe_devices(expected_macs, general_config)
+    for ip_address in probed.keys():
+        last_seen_ips[ip_address] = current_time
+    return probed
+
+
+def scan(general_config, last_seen_ips, current_time, recorder=None, all_ips=None):
+    """Runs the probe and resolve stages for the configured IP range, skipping addresses seen within the backoff length.
+
+    Returns a tuple with the dict of IP address to MAC address for detected devices and the number of skipped addresses. The last_seen_ips dict is updated in place. If a TraceRecorder is provided, the raw probe and neighbor results are captured. The list of IP addresses can be provided if already known."""
+
+    # Determine IP addresses to remove
+    if all_ips == None:
+        all_ips = get_ip_range(general_config)
+    skipped_ips = []
+    for ip_address in all_ips:
+        if ip_address in last_seen_ips.keys():
+            if current_time - last_seen_ips[ip_address] < general_config["ping_backoff_length_secs"]:
+                skipped_ips.append(ip_address)
+
+    # Run flood ping
+    log("Running flood ping with " + str(len(skipped_ips)) +
+        " skipped IP address" + ("" if len(skipped_ips) == 1 else "es"))
+    ping_list = [x for x in all_ips if x not in skipped_ips]
+    responding_ips = run_flood_ping(
+        ping_list, general_config["ping_timeout_secs"])
+
+    # Find successful detections
+    detected = resolve_mac_addresses(responding_ips)
+
+    # Add IPv6 neighbors (one multicast probe for the whole link)
+    ipv6_interface = general_config.get("ipv6_interface")
+    if ipv6_interface != None and ipv6_interface != "":
+        detected.update(discover_ipv6_neighbors(
+            ipv6_interface, general_config["ping_timeout_secs"]))
+    if recorder != None:
+        recorder.record_scan(current_time, responding_ips, detected)
+    for ip_address, mac_address in detected.items():
+        last_seen_ips[ip_address] = current_time
+    _log_found_devices(detected, "with flood ping")
+
+    return detected, len(skipped_ips)
@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import threading
+
+from change_bus import ChangeBus, diff_data
+from monitor import Monitor
+from records import RecordTable
+from snapshot_store import SnapshotStore
+from util import *
+
+# A trace is a JSON lines file with one event per line, written while the
+# server runs and replayed later with a virtual clock:
+#
+#   {"type": "caches", "time": t, "config": {...}, "data": {...}}
+#   {"type": "scan", "time": t, "probe": [ip, ...], "neighbors": {ip: mac}}
+#   {"type": "cycle", "time": t, "macs": [mac, ...], "skipped": n}
+#   {"type": "mutation", "time": t, "action": str, "args": [...]}
+#
+# During replay, the monitor's decisions are simulated again from the recorded
+# scan results, so config changes (e.g. timeouts) can be evaluated. Manual
+# mutations from the kiosk are applied at their recorded times, while the
+# recorded automatic mutations are only used for comparison.
+
+MANUAL_ACTIONS = ["add_device", "remove_device"]
+
+
+class TraceRecorder:
+    """Captures scan results, cache snapshots, and Google mutations to a trace file."""
+
+    def __init__(self, path):
+        """
+        Creates a new TraceRecorder.
+
+        Parameters:
+            path: The path of the trace file (appended if it already exists).
+        """
+
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+        self._last_config = None
+        self._last_data = None
+
+    def _write(self, event):
+        """Writes a single event to the trace."""
+        with self._lock:
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+
+    def record_caches(self, current_time, config, data):
+        """Records the config and data caches if either was replaced since the last call."""
+        if config is self._last_config and data is self._last_data:
+            return
+        self._last_config = config
+        self._last_data = data
+        self._write({
+            "type": "caches",
+            "time": current_time,
+            "config": config,
+            "data": {
+                "devices": data["devices"],
+                "records": data["records"].to_list()
+            }
+        })
+
+    def record_scan(self, current_time, responding_ips, neighbors):
+        """Records the raw probe results and the neighbor table entries for responding addresses."""
+        self._write({"type": "scan", "time": current_time,
+                    "probe": responding_ips, "neighbors": neighbors})
+
+    def record_cycle(self, current_time, detected_macs, skipped_count):
+        """Records the final set of detected MAC addresses for a monitor cycle."""
+        self._write({"type": "cycle", "time": current_time,
+                    "macs": sorted(detected_macs), "skipped": skipped_count})
+
+    def record_mutation(self, action, *args):
+        """Records an outgoing Google mutation."""
+        self._write({"type": "mutation", "time": round(time.time()),
+                    "action": action, "args": list(args)})
+
+
+class FakeGoogleInterface:
+    """In-memory stand-in for GoogleInterface that applies mutations using a virtual clock."""
+
+    def __init__(self, data):
+        """
+        Creates a new FakeGoogleInterface.
+
+        Parameters:
+            data: The initial data cache (the records are copied).
+        """
+
+        self.clock = 0
+        self.mutations = []
+        self._devices = [dict(x) for x in data["devices"]]
+        self._records = data["records"].to_list()
+        self.data_store = SnapshotStore(data)
+
+    def _publish(self):
+        """Publishes a new data cache after a mutation."""
+        self.data_store.publish({"devices": [dict(x) for x in self._devices],
+                                 "records": RecordTable(self._records)})
+
+    def add_sign_in(self, person, is_manual, event_time=None):
+        event_time = self.clock if event_time == None else event_time
+        self.mutations.append(["add_sign_in", person, is_manual, event_time])
+        for record in self._records:
+            if record["person"] == person and record["end_time"] == None:
+                record["start_time"] = event_time
+                record["start_manual"] = is_manual
+                break
+        else:
+            self._records.insert(0, {"person": person, "start_time": event_time,
+                                     "end_time": None, "start_manual": is_manual, "end_manual": False})
+        self._publish()
+        return True
+
+    def add_sign_out(self, person, is_manual, event_time=None):
+        event_time = self.clock if event_time == None else event_time
+        self.mutations.append(["add_sign_out", person, is_manual, event_time])
+        for record in self._records:
+            if record["person"] == person and record["end_time"] == None:
+                record["end_time"] = round(event_time)
+                record["end_manual"] = is_manual
+        self._publish()
+        return True
+
+    def add_device(self, person, mac):
+        if not any(x["person"] == person and x["mac"] == mac for x in self._devices):
+            self._devices.insert(
+                0, {"person": person, "mac": mac, "last_seen": None})
+            self._publish()
+        return True
+
+    def remove_device(self, person, mac):
+        self._devices = [x for x in self._devices if not (
+            x["person"] == person and x["mac"] == mac)]
+        self._publish()
+        return True
+
+    def update_device_last_seen(self, person, mac):
+        midnight = round(datetime.datetime.combine(
+            datetime.datetime.fromtimestamp(self.clock), datetime.time.min).timestamp())
+        for device in self._devices:
+            if device["person"] == person and device["mac"] == mac:
+                device["last_seen"] = midnight
+        self._publish()
+        return True
+
+    def get_visits(self):
+        """Returns all visits, oldest first."""
+        return list(reversed(self._records))
+
+
+class ReplayMonitor(Monitor):
+    """Monitor that takes its scan results from a trace instead of the network."""
+
+    next_scan = (set(), 0)
+
+    def _scan(self, config_snapshot, data_snapshot, current_time):
+        return self.next_scan
+
+
+def _percentile(values, percentile):
+    """Returns the percentile of a list of values (nearest rank)."""
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def replay(trace_path, config_overrides={}):
+    """Replays a trace through the monitor logic with a virtual clock. Returns a dict describing the results."""
+    events = [json.loads(x) for x in open(trace_path) if x.strip() != ""]
+    initial = next((x for x in events if x["type"] == "caches"), None)
+    if initial == None:
+        raise ValueError("Trace does not include a cache snapshot")
+
+    config_store = SnapshotStore(None)
+
+    def set_config(new_config):
+        config = dict(new_config)
+        config["general"] = dict(new_config["general"], **config_overrides)
+        config_store.publish(config)
+
+    set_config(initial["config"])
+    google = FakeGoogleInterface({"devices": initial["data"]["devices"],
+                                  "records": RecordTable(initial["data"]["records"])})
+    monitor = ReplayMonitor(config_store,
+                            google.data_store,
+                            ChangeBus(google.data_store, diff_data),
+                            lambda status: None,
+                            lambda person, event_time: google.add_sign_in(
+                                person, False, event_time),
+                            lambda person, event_time: google.add_sign_out(
+                                person, False, event_time),
+                            lambda person, mac: google.update_device_last_seen(person, mac))
+
+    # Run events with a virtual clock
+    latencies = []
+    recorded_auto_mutations = 0
+    wall_start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for event in events:
+            google.clock = event["time"]
+            if event["type"] == "caches":
+                set_config(event["config"])
+
+            elif event["type"] == "mutation":
+                action = event["action"]
+                args = event["args"]
+                if action in ["add_sign_in", "add_sign_out"]:
+                    if args[1]:
+                        getattr(google, action)(
+                            args[0], True, args[2] if args[2] != None else event["time"])
+                    else:
+                        recorded_auto_mutations += 1
+                elif action in MANUAL_ACTIONS:
+                    getattr(google, action)(*args)
+
+            elif event["type"] == "cycle":
+                monitor.next_scan = (set(event["macs"]), event["skipped"])
+                cycle_start = time.perf_counter()
+                monitor._cycle(event["time"])
+                latencies.append(time.perf_counter() - cycle_start)
+    wall_secs = time.perf_counter() - wall_start
+
+    virtual_secs = events[-1]["time"] - events[0]["time"]
+    visits = google.get_visits()
+    return {
+        "cycles": len(latencies),
+        "virtual_secs": virtual_secs,
+        "wall_secs": wall_secs,
+        "speedup": virtual_secs / wall_secs if wall_secs > 0 else None,
+        "decision_latency_ms": {
+            "p50": _percentile(latencies, 50) * 1000,
+            "p99": _percentile(latencies, 99) * 1000,
+            "max": max(latencies) * 1000 if len(latencies) > 0 else 0
+        },
+        "auto_mutations": {
+            "recorded": recorded_auto_mutations,
+            "simulated": len([x for x in google.mutations if not x[2]])
+        },
+        "visits": visits
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay an AdvantageTrack trace with a virtual clock")
+    parser.add_argument("trace")
+    parser.add_argument("--set", nargs="+", default=[], metavar="KEY=VALUE",
+                        help="override numeric general config values (e.g. auto_timeout_mins=20)")
+    parser.add_argument("--visits", metavar="PATH",
+                        help="write the resulting visits to a JSON file")
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.set:
+        key, value = item.split("=", 1)
+        overrides[key] = float(value)
+
+    result = replay(args.trace, overrides)
+    log_writer.flush(5)  # Print the summary after any queued log messages
+    if args.visits != None:
+        json.dump(result["visits"], open(args.visits, "w"), indent=2)
+    print("Replayed " + str(result["cycles"]) + " cycles (" + str(round(result["virtual_secs"] / 3600, 1)) + " hours) in " +
+          str(round(result["wall_secs"], 2)) + "s" + (" (" + str(round(result["speedup"])) + "x real time)" if result["speedup"] != None else ""))
+    print("Decision latency: p50 " + str(round(result["decision_latency_ms"]["p50"], 3)) + " ms, p99 " + str(round(
+        result["decision_latency_ms"]["p99"], 3)) + " ms, max " + str(round(result["decision_latency_ms"]["max"], 3)) + " ms")
+    print("Automatic mutations: " + str(result["auto_mutations"]["simulated"]) +
+          " simulated, " + str(result["auto_mutations"]["recorded"]) + " recorded")
+    print("Visits: " + str(len(result["visits"])) + " (" +
+          str(len([x for x in result["visits"] if x["end_time"] == None])) + " open)")
@@ -0,0 +1,141 @@
+import threading
+
+from records import RecordTable
+
+
+class FrozenDict(dict):
+    """Dict that raises an error on modification (still compares and serializes like a dict)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("snapshot data is read-only")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """List that raises an error on modification (still compares and serializes like a list)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("snapshot data is read-only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = clear = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def freeze(value):
+    """Returns a deeply read-only copy of a cache value made of dicts, lists, and RecordTables."""
+    if isinstance(value, dict):
+        return FrozenDict((x, freeze(y)) for x, y in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(x) for x in value)
+    if isinstance(value, RecordTable):
+        value.freeze()
+    return value
+
+
+class Snapshot:
+    """A single published version of a cache, with memoized derived views."""
+
+    def __init__(self, version, value):
+        self.version = version
+        self.value = value
+        self._views = {}  # Key = view function
+        self._lock = threading.Lock()
+
+    def view(self, function):
+        """Returns the result of calling the function with this snapshot's value, computed at most once per snapshot. The result must be treated as read-only."""
+        try:
+            return self._views[function]
+        except KeyError:
+            pass
+        with self._lock:
+            if function not in self._views:
+                self._views[function] = function(self.value)
+            return self._views[function]
+
+
+class SnapshotStore:
+    """Publishes frozen, versioned snapshots of a cache.
+
+    Readers get the current snapshot without locking (publishing swaps a
+    single reference). Derived views are memoized on each snapshot, so every
+    thread shares a single computation per version.
+    """
+
+    def __init__(self, value):
+        """
+        Creates a new SnapshotStore.
+
+        Parameters:
+            value: The initial value of the cache (frozen as version 0).
+        """
+
+        self._snapshot = Snapshot(0, freeze(value))
+        self._publish_lock = threading.Lock()
+        self._subscribers = []
+
+    def get(self):
+        """Returns the current (read-only) value."""
+        return self._snapshot.value
+
+    def get_snapshot(self):
+        """Returns the current Snapshot, for reading a value and its views consistently."""
+        return self._snapshot
+
+    def get_version(self):
+        """Returns the version of the current snapshot."""
+        return self._snapshot.version
+
+    def view(self, function):
+        """Returns the memoized result of the function for the current snapshot."""
+        return self._snapshot.view(function)
+
+    def subscribe(self, callback):
+        """Registers a function that accepts the new Snapshot, called after every publish."""
+        self._subscribers.append(callback)
+
+    def publish(self, value):
+        """Freezes the value and publishes it as a new version, then notifies subscribers."""
+        with self._publish_lock:
+            snapshot = Snapshot(self._snapshot.version + 1, freeze(value))
+            self._snapshot = snapshot
+        for callback in self._subscribers:
+            callback(snapshot)
+        return snapshot
+
+
+class CombinedView:
+    """Derived view over several stores, recomputed only when any of their versions change."""
+
+    def __init__(self, stores, function):
+        """
+        Creates a new CombinedView.
+
+        Parameters:
+            stores: The list of SnapshotStores the view depends on.
+            function: A function that accepts the current Snapshot of each store.
+        """
+
+        self._stores = stores
+        self._function = function
+        self._cached = None  # Tuple of the versions and the result
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the view for the current snapshots."""
+        snapshots = [x.get_snapshot() for x in self._stores]
+        versions = tuple(x.version for x in snapshots)
+        cached = self._cached
+        if cached != None and cached[0] == versions:
+            return cached[1]
+        with self._lock:
+            cached = self._cached
+            if cached == None or cached[0] != versions:
+                cached = (versions, self._function(*snapshots))
+                self._cached = cached
+            return cached[1]
@@ -0,0 +1,70 @@
+import unittest
+
+from records import RecordTable, get_open_visits
+
+
+def _record(person, start_time, end_time=None, start_manual=False, end_manual=False):
+    return {"person": person, "start_time": start_time, "end_time": end_time,
+            "start_manual": start_manual, "end_manual": end_manual}
+
+
+class RecordTableTest(unittest.TestCase):
+    """Tests for the columnar record storage."""
+
+    def setUp(self):
+        self.records = [
+            _record(1, 300),
+            _record(2, 200, 250, True, False),
+            _record(1, 100, 150, False, True),
+            _record(3, 50)
+        ]
+        self.table = RecordTable(self.records)
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.table), 4)
+        self.assertEqual(self.table.to_list(), self.records)
+        self.assertEqual(self.table[1], self.records[1])
+        self.assertEqual(self.table[-1], self.records[-1])
+        with self.assertRaises(IndexError):
+            self.table[4]
+
+    def test_many_flags(self):
+        records = [_record(x, x, x + 1, x % 3 == 0, x % 5 == 0)
+                   for x in range(20)]
+        self.assertEqual(RecordTable(records).to_list(), records)
+
+    def test_slice(self):
+        sliced = self.table[1:3]
+        self.assertIsInstance(sliced, RecordTable)
+        self.assertEqual(sliced.to_list(), self.records[1:3])
+
+    def test_open_visits(self):
+        self.assertEqual(self.table.open_indices(), [0, 3])
+        self.assertEqual(self.table.open_people(), {1, 3})
+        self.assertEqual(get_open_visits({"records": self.table}), [
+                         self.records[0], self.records[3]])
+
+    def test_person_indices(self):
+        self.assertEqual(self.table.person_indices(1), [0, 2])
+        self.assertEqual(self.table.for_person(2), [self.records[1]])
+        self.assertEqual(self.table.person_indices(4), [])
+
+    def test_person_indices_wrong_type(self):
+        self.assertEqual(self.table.person_indices("1"), [])
+        self.assertEqual(self.table.person_indices(None), [])
+
+    def test_equality(self):
+        self.assertEqual(self.table, RecordTable(self.records))
+        self.assertEqual(self.table, self.records)
+        self.assertNotEqual(self.table, RecordTable(self.records[1:]))
+        with self.assertRaises(TypeError):
+            hash(self.table)
+
+    def test_freeze(self):
+        self.table.freeze()
+        with self.assertRaises(TypeError):
+            self.table.append(4, 400, None, False, False)
+
+
+if __name__ == "__main__":
+    unittest.main()
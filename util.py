@@ -1,17 +1,18 @@
 from ntpath import join
+import json
 import os
 import time
 from enum import Enum
 
+from log_writer import LogWriter
 
-def log(output, before_text=""):
-    """Log the output with a timestamp."""
+log_writer = LogWriter()
 
-    if before_text == "":
-        print(time.strftime("[%d/%b/%Y:%H:%M:%S] ") + output)
-    else:
-        print(before_text +
-              time.strftime(" - - [%d/%b/%Y:%H:%M:%S] ") + output)
+
+def log(output, before_text="", details=None):
+    """Log the output with a timestamp. The message is written by a background thread, so this never blocks. Details are only included in the JSON log file."""
+
+    log_writer.write(output, None if before_text == "" else before_text, details)
 
 
 def get_absolute_path(*path):
@@ -22,6 +23,37 @@ def get_absolute_path(*path):
     return os.path.abspath(joined_path)
 
 
+def write_json_atomic(path, data):
+    """Writes JSON data to a temporary file, then renames it over the target so readers never see a partial file."""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+_import_time = time.perf_counter()  # Imported by the first modules loaded, so close to process start
+
+
+class PhaseTimer:
+    """Records how long each startup phase took, relative to when this module was first imported."""
+
+    def __init__(self):
+        self._start = _import_time
+        self._phases = []
+
+    def mark(self, phase):
+        """Records and logs that a phase has completed."""
+        elapsed_ms = round((time.perf_counter() - self._start) * 1000)
+        self._phases.append({"phase": phase, "elapsed_ms": elapsed_ms})
+        log("Startup: " + phase + " after " + str(elapsed_ms) + " ms")
+
+    def get_phases(self):
+        """Returns a list of dicts with the name and elapsed time of each completed phase."""
+        return list(self._phases)
+
+
 class ConnectionStatus(Enum):
     """The connection status of a single module."""
 
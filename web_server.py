@@ -1,3 +1,4 @@
+import hmac
 import json
 import random
 import threading
@@ -9,43 +10,102 @@ from ws4py.server.cherrypyserver import WebSocketPlugin, WebSocketTool
 from ws4py.websocket import WebSocket
 
 from arp import *
+from change_bus import PEOPLE_CHANGE_TYPES, ChangeType
+from client_queue import ClientQueue
+from export import generate_csv, generate_parquet, is_parquet_available, iter_records, parse_date_range
+from federation import FEDERATION_KEY_HEADER
+from records import get_open_visits
+from roster import RosterIndex
+from snapshot_store import CombinedView
 from util import *
 
 
+def _get_roster_index(config):
+    """Returns the search index for a config cache (used as a memoized snapshot view)."""
+    return RosterIndex(config["people"])
+
+
+def _get_here_now(config_snapshot, data_snapshot):
+    """Returns the data sent to clients, with devices and the joined here-now list (used as a combined view)."""
+    return {
+        "devices": data_snapshot.value["devices"],
+        "here_now": config_snapshot.view(_get_roster_index).join_here_now(data_snapshot.view(get_open_visits))
+    }
+
+
+def _is_int(value):
+    """Returns whether a JSON value is an integer (booleans excluded)."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _validate_search(data):
+    """Returns a description of the problem with the data of a "search" query, or None if it is valid."""
+    if not isinstance(data, dict):
+        return "data is not an object"
+    if not isinstance(data.get("query", ""), str):
+        return "query is not a string"
+    if not _is_int(data.get("page", 0)) or data.get("page", 0) < 0:
+        return "page is not a non-negative integer"
+    page_size = data.get("page_size")
+    if page_size != None and (not _is_int(page_size) or page_size < 1 or page_size > RosterIndex.MAX_PAGE_SIZE):
+        return "page_size is not between 1 and " + str(RosterIndex.MAX_PAGE_SIZE)
+    if not isinstance(data.get("active_only", False), bool):
+        return "active_only is not a boolean"
+    return None
+
+
 class WebServer:
     """Manages the CherryPy server (HTTP and WebSocket)."""
 
     _PORT = 8000
     _IP_MONITOR_PERIOD_SECS = 5
+    _CLIENT_MAX_LAG_SECS = 30  # Clients with older unsent messages are disconnected
+    _CLIENT_LAG_CHECK_PERIOD_SECS = 5
+    _CLIENT_CLOSE_TIMEOUT_SECS = 5  # Sockets are closed forcefully if the close frame can't be sent
+    _LAGGING_CLOSE_CODE = 4008  # Application-defined WebSocket close code
 
     _monitor_status = ConnectionStatus.DISCONNECTED
     _google_status = ConnectionStatus.DISCONNECTED
     _ip_address = "127.0.0.1"
     _auto_add_person = None
 
-    def __init__(self, data_folder, background_cache_folder, get_config, get_data, sign_in_callback, sign_out_callback, add_device_callback, remove_device_callback):
+    def __init__(self, data_folder, background_cache_folder, config_store, data_store, sign_in_callback, sign_out_callback, add_device_callback, remove_device_callback, federation_aggregator=None, get_debug_state=None, memory_monitor=None, record_archive=None, export_key=""):
         """
         Creates a new WebServer.
 
         Parameters:
             data_folder: The name of the local folder where data is stored.
             background_cache_folder: The name of the local folder to store backgrounds.
-            get_config: A function that returns the current config cache.
-            get_data: A function that returns the current data cache.
+            config_store: The SnapshotStore for the config cache.
+            data_store: The SnapshotStore for the data cache.
             sign_in_callback: A function that accepts a person ID.
             sign_out_callback: A function that accepts a person ID.
             add_device_callback: A function that accepts a person ID and MAC address.
             remove_device_callback: A function that accepts a person ID and MAC address.
+            federation_aggregator: An optional FederationAggregator that receives batches from scanner nodes.
+            get_debug_state: An optional function that returns a JSON-compatible dict of internal state for "/debug".
+            memory_monitor: An optional MemoryMonitor for "/debug/memory".
+            record_archive: An optional RecordArchive with the full history for "/export" (otherwise only cached records are exported).
+            export_key: The key required by "/export" as the "key" parameter ("/export" is disabled if empty).
         """
 
         self._DATA_FOLDER = data_folder
         self._BACKGROUND_CACHE_FOLDER = background_cache_folder
-        self._get_config = get_config
-        self._get_data = get_data
+        self._config_store = config_store
+        self._data_store = data_store
+        self._here_now = CombinedView(
+            [config_store, data_store], _get_here_now)
         self._sign_in_callback = sign_in_callback
         self._sign_out_callback = sign_out_callback
         self._add_device_callback = add_device_callback
         self._remove_device_callback = remove_device_callback
+        self._federation_aggregator = federation_aggregator
+        self._get_debug_state = get_debug_state
+        self._memory_monitor = memory_monitor
+        self._record_archive = record_archive
+        self._EXPORT_KEY = export_key
+        self._clients = set()
+        self._clients_lock = threading.RLock()
 
         self.Root.set_parent(self)
         self.WebSocketHandler.set_parent(self)
@@ -88,9 +148,95 @@ class WebServer:
                     html = html.replace("$(RESULT)", "SUCCESS")
             return html
 
+        @cherrypy.expose
+        def debug(self, section=None, action=None, limit=20):
+            # Internal state for debugging (only from the local machine)
+            if cherrypy.request.remote.ip not in ["127.0.0.1", "::1"]:
+                raise cherrypy.NotFound()
+            if section == None and self._parent._get_debug_state != None:
+                state = self._parent._get_debug_state()
+            elif section == "memory" and self._parent._memory_monitor != None:
+                # "/debug/memory?action=diff" starts tracemalloc, then compares to the previous snapshot
+                memory_monitor = self._parent._memory_monitor
+                if action == "diff":
+                    try:
+                        limit = int(limit)
+                    except ValueError:
+                        raise cherrypy.HTTPError(400, "Invalid limit")
+                    if limit < 1:
+                        raise cherrypy.HTTPError(400, "Invalid limit")
+                    state = memory_monitor.get_snapshot_diff(limit)
+                elif action == "stop":
+                    memory_monitor.stop_tracing()
+                    state = memory_monitor.get_state()
+                else:
+                    state = memory_monitor.get_state()
+            else:
+                raise cherrypy.NotFound()
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps(state, indent=2).encode("utf-8")  # Only text types are encoded automatically
+
+        @cherrypy.expose
+        @cherrypy.config(**{"response.stream": True})
+        def export(self, format="csv", person=None, start=None, end=None, key=""):
+            # Streams records from the local archive and data snapshot (never calls Google, requires the export key)
+            if self._parent._EXPORT_KEY == "":
+                raise cherrypy.NotFound()
+            if not hmac.compare_digest(self._parent._EXPORT_KEY.encode("utf-8"), str(key).encode("utf-8")):
+                log("Rejected export with an invalid key",
+                    before_text=cherrypy.request.remote.ip)
+                raise cherrypy.HTTPError(403)
+            try:
+                person = int(person) if person != None and person != "" else None
+                start_time, end_time = parse_date_range(start, end)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Invalid person or date")
+            if format == "csv":
+                generator = generate_csv
+                content_type = "text/csv; charset=utf-8"
+            elif format == "parquet":
+                if not is_parquet_available():
+                    raise cherrypy.HTTPError(
+                        501, "Parquet exports require pyarrow")
+                generator = generate_parquet
+                content_type = "application/vnd.apache.parquet"
+            else:
+                raise cherrypy.HTTPError(400, "Unknown format")
+
+            recent_records = self._parent._data_store.get()["records"]
+            if self._parent._record_archive != None:
+                records = self._parent._record_archive.iter_records(
+                    person, start_time, end_time, recent_records)
+            else:
+                records = iter_records(
+                    recent_records, person, start_time, end_time)
+            roster = self._parent._get_roster()
+            log("Exporting " + format + " records", before_text=cherrypy.request.remote.ip)
+            cherrypy.response.headers["Content-Type"] = content_type
+            cherrypy.response.headers["Content-Disposition"] = "attachment; filename=\"advantagetrack_records." + format + "\""
+            return generator(records, roster.get_name)
+
+        @cherrypy.expose
+        def federation(self):
+            # Receives batches from scanner nodes (POST) and shares the general config (GET)
+            aggregator = self._parent._federation_aggregator
+            if aggregator == None:
+                raise cherrypy.NotFound()
+            key = cherrypy.request.headers.get(FEDERATION_KEY_HEADER, "")
+            if not aggregator.check_key(key):
+                raise cherrypy.HTTPError(403)
+            if cherrypy.request.method == "POST":
+                if not aggregator.receive(cherrypy.request.body.read(), key):
+                    raise cherrypy.HTTPError(400)
+                return ""
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps(self._parent._config_store.get()["general"]).encode("utf-8")
+
     class WebSocketHandler(WebSocket):
         """WebSocket handler for each connection."""
 
+        queue = None  # ClientQueue, created once the connection opens
+
         @classmethod
         def set_parent(cls, parent):
             cls._parent = parent
@@ -103,7 +249,10 @@ class WebServer:
             log("Received query \"" + query + "\"",
                 before_text=self.peer_address[0])
 
-            if query == "sign_in":
+            if query in ["sign_in", "sign_out"] and not _is_int(data):
+                log("Ignoring \"" + query + "\" with an invalid person ID",
+                    before_text=self.peer_address[0])
+            elif query == "sign_in":
                 self._parent._sign_in_callback(data)
             elif query == "sign_out":
                 self._parent._sign_out_callback(data)
@@ -112,22 +261,104 @@ class WebServer:
             elif query == "remove_device":
                 self._parent._remove_device_callback(
                     data["person"], data["mac"])
+            elif query == "search":
+                error = _validate_search(data)
+                if error != None:
+                    log("Ignoring \"search\" (" + error + ")",
+                        before_text=self.peer_address[0])
+                    results = {"query": data.get("query") if isinstance(data, dict) else None,
+                               "error": error}
+                else:
+                    results = self._parent._get_roster().search(data.get("query", ""), data.get("page", 0),
+                                                                data.get("page_size"), data.get("active_only", False))
+                self._parent._enqueue(self, "search_results", json.dumps({
+                    "query": "search_results",
+                    "data": results
+                }))
 
         def opened(self):
             log("WebSocket connection opened",
                 before_text=self.peer_address[0])
-            self.send(TextMessage(
-                self._parent._generate_message("monitor_status")))
-            self.send(TextMessage(
-                self._parent._generate_message("google_status")))
-            self.send(TextMessage(self._parent._generate_message("add_address")))
-            self.send(TextMessage(self._parent._generate_message("config")))
-            self.send(TextMessage(self._parent._generate_message("data")))
-            self.send(TextMessage(self._parent._generate_message("backgrounds")))
+            self.queue = ClientQueue()
+            threading.Thread(target=self._send_loop, daemon=True).start()
+            with self._parent._clients_lock:  # Broadcasts can't be queued before the initial messages
+                self._parent._clients.add(self)
+                for query in ["monitor_status", "google_status", "add_address", "config", "data", "backgrounds"]:
+                    self._parent._enqueue(
+                        self, query, self._parent._generate_message(query))
 
         def closed(self, code, _):
             log("WebSocket connection closed (" + str(code) + ")",
                 before_text=self.peer_address[0])
+            with self._parent._clients_lock:
+                self._parent._clients.discard(self)
+            if self.queue != None:
+                self.queue.close()
+
+        def _send_loop(self):
+            """Sends queued messages until the queue is closed (so a slow client never blocks a broadcast)."""
+            while True:
+                text = self.queue.get()
+                if text == None:
+                    return
+                try:
+                    self.send(TextMessage(text))
+                except:
+                    self.queue.close()
+                    return
+                self.queue.done()
+
+    def _enqueue(self, client, query, text):
+        """Queues a message for a client (ignored if its queue is already closed)."""
+        client.queue.put(query, text)
+
+    def _check_client_lag(self):
+        """Periodically disconnects clients whose oldest unsent message is too old, even if nothing new is queued."""
+        while True:
+            time.sleep(self._CLIENT_LAG_CHECK_PERIOD_SECS)
+            with self._clients_lock:
+                clients = list(self._clients)
+            for client in clients:
+                if client.queue.get_lag_secs() > self._CLIENT_MAX_LAG_SECS:
+                    self._disconnect_client(client, "Client is too slow")
+
+    def _disconnect_client(self, client, reason):
+        """Closes the connection to a lagging client without blocking the caller."""
+        with self._clients_lock:
+            if client not in self._clients:
+                return
+            self._clients.discard(client)
+        log("Disconnecting WebSocket client: " + reason + " (" + json.dumps(client.queue.get_state()) + ")",
+            before_text=client.peer_address[0])
+        client.queue.close()
+
+        def close():
+            try:
+                client.close(self._LAGGING_CLOSE_CODE, reason)
+            except:
+                pass
+        threading.Thread(target=close, daemon=True).start()
+        timer = threading.Timer(
+            self._CLIENT_CLOSE_TIMEOUT_SECS, client.close_connection)
+        timer.daemon = True
+        timer.start()
+
+    def _broadcast(self, query):
+        """Generates the message for the query once and queues it for every client."""
+        with self._clients_lock:
+            text = self._generate_message(query)
+            for client in list(self._clients):
+                self._enqueue(client, query, text)
+
+    def get_client_state(self):
+        """Returns a JSON-compatible list with the queue state of each connected client."""
+        with self._clients_lock:
+            clients = list(self._clients)
+        return [dict(client.queue.get_state(), address=client.peer_address[0]) for client in clients]
+
+    def _get_roster(self):
+        """Returns the search index for the current config cache."""
+        return self._config_store.view(_get_roster_index)
 
     def _generate_message(self, query):
         """Generates the text message to send for the specified query."""
@@ -140,27 +371,17 @@ class WebServer:
             data = "http://" + self._ip_address + \
                 ":" + str(self._PORT) + "/add"
         elif query == "config":
-            config_cache = self._get_config()
+            config_snapshot = self._config_store.get_snapshot()
+            config_cache = config_snapshot.value
             welcome_message = ""
             if "welcome_message" in config_cache["general"]:
                 welcome_message = config_cache["general"]["welcome_message"]
             data = {
                 "welcome_message": welcome_message,
-                "people": [{
-                    "id": x["id"],
-                    "name": x["first_name"] + " " + x["last_name"],
-                    "is_active": x["is_active"]
-                } for x in config_cache["people"]]
+                "people": config_snapshot.view(_get_roster_index).get_active_people()  # For signing in, others are paged through "search"
             }
         elif query == "data":
-            data_cache = self._get_data()
-            data = {
-                "devices": data_cache["devices"],
-                "here_now": [{
-                    "person": x["person"],
-                    "manual": x["start_manual"]
-                } for x in data_cache["records"] if x["end_time"] == None]
-            }
+            data = self._here_now.get()
         elif query == "backgrounds":
             is_default = False
             files = os.listdir(get_absolute_path(
@@ -185,29 +406,27 @@ class WebServer:
     def new_monitor_status(self, status):
         """Sets the monitor status."""
         self._monitor_status = status
-        cherrypy.engine.publish("websocket-broadcast",
-                                TextMessage(self._generate_message("monitor_status")))
+        self._broadcast("monitor_status")
 
     def new_google_status(self, status):
         """Sets the Google status."""
         self._google_status = status
-        cherrypy.engine.publish("websocket-broadcast",
-                                TextMessage(self._generate_message("google_status")))
-
-    def new_config(self):
-        """Tells the server that the config cache was updated."""
-        cherrypy.engine.publish("websocket-broadcast",
-                                TextMessage(self._generate_message("config")))
+        self._broadcast("google_status")
 
     def new_data(self):
         """Tells the server that the data cache was updated."""
-        cherrypy.engine.publish("websocket-broadcast",
-                                TextMessage(self._generate_message("data")))
+        self._broadcast("data")
+
+    def config_changed(self, events):
+        """Change subscriber for the config cache, broadcasting only the messages that include the changed values."""
+        if any(x.type != ChangeType.CONFIG_KEY_CHANGED or x.key == "welcome_message" for x in events):
+            self._broadcast("config")
+        if any(x.type in PEOPLE_CHANGE_TYPES for x in events):
+            self.new_data()  # Names in the here-now list may have changed
 
     def new_backgrounds(self):
         """Tells the server that a new set of backgrounds is available."""
-        cherrypy.engine.publish("websocket-broadcast",
-                                TextMessage(self._generate_message("backgrounds")))
+        self._broadcast("backgrounds")
 
     def _run_server(self):
         """Starts the server and runs forever."""
@@ -254,12 +473,20 @@ class WebServer:
             if new_ip_address != self._ip_address:
                 log("Found server IP address: " + new_ip_address)
                 self._ip_address = new_ip_address
-                cherrypy.engine.publish("websocket-broadcast",
-                                        TextMessage(self._generate_message("add_address")))
+                self._broadcast("add_address")
 
             time.sleep(self._IP_MONITOR_PERIOD_SECS)
 
-    def start(self):
-        """Starts the web server and IP address monitor in a separate threads."""
+    def _wait_for_ready(self, ready_callback):
+        """Waits until the server is accepting connections, then calls the callback."""
+        cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+        ready_callback()
+
+    def start(self, ready_callback=None):
+        """Starts the web server and IP address monitor in a separate threads. The optional callback is called once the server is accepting connections."""
         threading.Thread(target=self._run_server, daemon=True).start()
         threading.Thread(target=self._monitor_ip, daemon=True).start()
+        threading.Thread(target=self._check_client_lag, daemon=True).start()
+        if ready_callback != None:
+            threading.Thread(target=self._wait_for_ready, args=(
+                ready_callback,), daemon=True).start()
@@ -13,7 +13,6 @@ export class HereNow {
     #connected = false;
 
     constructor() {
-        document.addEventListener("configupdate", () => this.#updateTable());
         document.addEventListener("dataupdate", () => this.#updateTable());
         document.addEventListener("statusupdate", () => this.#updateStatus());
     }
@@ -23,41 +22,25 @@ export class HereNow {
         while (this.#tableBody.firstChild) {
             this.#tableBody.removeChild(this.#tableBody.firstChild);
         }
-        window.dataCache["here_now"]
-            .map((x) => {
-                return {
-                    name: window.configCache["people"].find((y) => y["id"] == x["person"])["name"],
-                    person: x["person"],
-                    manual: x["manual"]
-                };
-            })
-            .sort((a, b) => {
-                if (a["manual"] == b["manual"]) {
-                    return a["name"].localeCompare(b["name"]);
-                } else if (a["manual"]) {
-                    return -1;
-                } else {
-                    return 1;
+        // Entries are joined with names and sorted by the server
+        window.dataCache["here_now"].forEach((person, index) => {
+            if (index % this.#columns == 0) {
+                this.#tableBody.appendChild(document.createElement("tr"));
+            }
+            let cell = document.createElement("td");
+            cell.innerText = person["name"];
+            if (!person["manual"]) cell.classList.add("auto");
+            cell.addEventListener("click", () => {
+                if (this.#connected) {
+                    document.dispatchEvent(
+                        new CustomEvent("sendsignout", {
+                            detail: person["person"]
+                        })
+                    );
                 }
-            })
-            .forEach((person, index) => {
-                if (index % this.#columns == 0) {
-                    this.#tableBody.appendChild(document.createElement("tr"));
-                }
-                let cell = document.createElement("td");
-                cell.innerText = person["name"];
-                if (!person["manual"]) cell.classList.add("auto");
-                cell.addEventListener("click", () => {
-                    if (this.#connected) {
-                        document.dispatchEvent(
-                            new CustomEvent("sendsignout", {
-                                detail: person["person"]
-                            })
-                        );
-                    }
-                });
-                this.#tableBody.lastElementChild.appendChild(cell);
             });
+            this.#tableBody.lastElementChild.appendChild(cell);
+        });
     }
 
     /** Updates the connection warning based on the current status. */
@@ -27,6 +27,8 @@ export class PopupMenu {
     // Constants
     #slideTransition = "transform 0.3s";
     #peopleColumns = 4;
+    #searchPageSize = 50;
+    #loadMoreMarginPx = 300; // Distance from the bottom of the devices table that loads the next page
     #thanksTimeoutLengthMs = 3000;
 
     // Variables
@@ -35,13 +37,21 @@ export class PopupMenu {
     #thanksTimeout = null;
     #lastDeviceDetailsPerson = null;
     #qrCodeManager = null;
+    #lastDeviceDetailsName = null;
+    #devicesPeople = []; // All people (including inactive), paged in through search queries as the table is scrolled
+    #devicesPeopleTotal = 0;
+    #devicesPeopleLoading = false;
 
     constructor() {
         document.addEventListener("configupdate", () => this.#updateTables());
-        document.addEventListener("configupdate", () => this.#updateDeviceDetails(null));
+        document.addEventListener("configupdate", () => {
+            if (this.#state == 2) this.#requestDevicesPeople(0);
+        });
         document.addEventListener("dataupdate", () => this.#updateTables());
         document.addEventListener("dataupdate", () => this.#updateDeviceDetails(null));
         document.addEventListener("statusupdate", () => this.#updateStatus());
+        document.addEventListener("searchresultsupdate", () => this.#handleSearchResults());
+        this.#menuDivs[2].addEventListener("scroll", () => this.#loadMoreDevicesPeople());
         Array.from(this.#menu.getElementsByClassName("close-button")).forEach((button) => {
             button.firstElementChild.addEventListener("click", () => this.setState(-1));
         });
@@ -72,6 +82,11 @@ export class PopupMenu {
         if (this.#state != -1) this.#menuDivs[this.#state].style.opacity = 1;
         if (newState != -1) this.#menuDivs[newState].style.opacity = 1;
 
+        // Load the people for managing devices
+        if (newState == 2 && this.#state != 2) {
+            this.#requestDevicesPeople(0);
+        }
+
         // Switch page
         switch (newState) {
             case 0:
@@ -112,6 +127,45 @@ export class PopupMenu {
         this.#state = newState;
     }
 
+    /** Requests a page of all people for the devices table. */
+    #requestDevicesPeople(page) {
+        this.#devicesPeopleLoading = true;
+        document.dispatchEvent(
+            new CustomEvent("sendsearch", {
+                detail: {
+                    query: "",
+                    page: page,
+                    page_size: this.#searchPageSize
+                }
+            })
+        );
+    }
+
+    /** Adds a page of search results to the devices table. */
+    #handleSearchResults() {
+        const results = window.searchResults;
+        if (results["query"] != "") return;
+        this.#devicesPeopleLoading = false;
+        if ("error" in results) {
+            console.error("Search failed: " + results["error"]);
+            return;
+        }
+        if (results["page"] == 0) this.#devicesPeople = [];
+        this.#devicesPeople = this.#devicesPeople.concat(results["results"]);
+        this.#devicesPeopleTotal = results["total"];
+        this.#updateTables();
+        this.#loadMoreDevicesPeople(); // In case the table doesn't fill the page yet
+    }
+
+    /** Requests the next page of people if the devices table is scrolled near the bottom. */
+    #loadMoreDevicesPeople() {
+        if (this.#state != 2 || this.#devicesPeopleLoading || this.#devicesPeople.length >= this.#devicesPeopleTotal) return;
+        const div = this.#menuDivs[2];
+        if (div.scrollTop + div.clientHeight >= div.scrollHeight - this.#loadMoreMarginPx) {
+            this.#requestDevicesPeople(Math.floor(this.#devicesPeople.length / this.#searchPageSize));
+        }
+    }
+
     /** Updates the list of names in the tables. */
     #updateTables() {
         while (this.#signInPeopleTableBody.firstChild) {
@@ -121,20 +175,18 @@ export class PopupMenu {
             this.#devicesPeopleTableBody.removeChild(this.#devicesPeopleTableBody.firstChild);
         }
 
-        const allPeople = window.configCache["people"].sort((a, b) => {
-            return a["name"].localeCompare(b["name"]);
-        });
+        // Active people are sent sorted by the server
         var hereNowLookup = {}; // Key = person ID, value = manual
         window.dataCache["here_now"].forEach((x) => {
             hereNowLookup[x["person"]] = x["manual"];
         });
-        const signInPeople = allPeople.filter((x) => {
-            return x["is_active"] && !(x["id"] in hereNowLookup && hereNowLookup[x["id"]]);
+        const signInPeople = window.configCache["people"].filter((x) => {
+            return !(x["id"] in hereNowLookup && hereNowLookup[x["id"]]);
         });
 
         Array(
             [signInPeople, this.#signInPeopleTableBody, true],
-            [allPeople, this.#devicesPeopleTableBody, false]
+            [this.#devicesPeople, this.#devicesPeopleTableBody, false]
         ).forEach((entry) => {
             let peopleList = entry[0];
             let tableBody = entry[1];
@@ -160,7 +212,7 @@ export class PopupMenu {
                                 })
                             );
                         } else {
-                            this.#updateDeviceDetails(person["id"]);
+                            this.#updateDeviceDetails(person["id"], person["name"]);
                             this.setState(3);
                             document.dispatchEvent(
                                 new CustomEvent("sendautoadd", {
@@ -206,20 +258,22 @@ export class PopupMenu {
         this.#qrCodeManager.makeCode(window.addAddress);
     }
 
-    /** Updates the device details page based on a person ID. */
-    #updateDeviceDetails(person) {
+    /** Updates the device details page based on a person ID and name. */
+    #updateDeviceDetails(person, name) {
         if (person == null) {
             // If not specified, update last person
             person = this.#lastDeviceDetailsPerson;
+            name = this.#lastDeviceDetailsName;
             if (person == null) {
                 // No one selected yet
                 return;
             }
         }
         this.#lastDeviceDetailsPerson = person;
+        this.#lastDeviceDetailsName = name;
 
         // Update title
-        this.#deviceDetailsName.innerText = window.configCache["people"].find((x) => x["id"] == person)["name"];
+        this.#deviceDetailsName.innerText = name;
 
         // Get list of devices
         const devices = window.dataCache["devices"]
@@ -22,6 +22,7 @@ export class ServerInterface {
         document.addEventListener("sendsignout", (event) => this.#sendData(event));
         document.addEventListener("sendautoadd", (event) => this.#sendData(event));
         document.addEventListener("sendremovedevice", (event) => this.#sendData(event));
+        document.addEventListener("sendsearch", (event) => this.#sendData(event));
     }
 
     /** Called when the WebSocket is opened successfully. */
@@ -71,6 +72,10 @@ export class ServerInterface {
             case "backgrounds":
                 window.backgroundData = data;
                 document.dispatchEvent(new Event("backgroundupdate"));
+                break;
+            case "search_results":
+                window.searchResults = data;
+                document.dispatchEvent(new Event("searchresultsupdate"));
         }
     }
 
@@ -80,7 +85,8 @@ export class ServerInterface {
             sendsignin: "sign_in",
             sendsignout: "sign_out",
             sendautoadd: "auto_add",
-            sendremovedevice: "remove_device"
+            sendremovedevice: "remove_device",
+            sendsearch: "search"
         }[event.type];
 
         if (window.serverStatus == 2) {